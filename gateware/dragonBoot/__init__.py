@@ -18,14 +18,33 @@ def cli():
 		description = 'dragonBoot')
 	parser.add_argument('--verbose', '-v', action = 'store_true', help = 'Enable debugging output')
 
-	# Create action subparsers for building and simulation
+	# Create action subparsers for building, simulation, estimating programming times, compressing images and
+	# decoding traces
 	actions = parser.add_subparsers(dest = 'action', required = True)
 	buildAction = actions.add_parser('build', help = 'build the dragonBoot DFU gateware')
 	actions.add_parser('sim', help = 'Simulate and test the gateware components')
+	estimateAction = actions.add_parser('estimate', help = 'Estimate how long programming an image over DFU takes')
+	compressAction = actions.add_parser('compress', help = 'Compress an image for downloading to a bootloader built with dfuCompression')
+	traceAction = actions.add_parser('trace', help = 'Turn a trace read back from a bootloader built with dfuTrace into a timeline')
 
 	# Populate the possible build targets
 	platforms = listPlatforms()
 	buildAction.add_argument('--target', action = 'store', required = True, choices = platforms.keys())
+	estimateAction.add_argument('--target', action = 'store', required = True, choices = platforms.keys())
+	estimateAction.add_argument('--image', action = 'store', required = True,
+		help = 'The image file to estimate the programming time of')
+	estimateAction.add_argument('--slot', action = 'store', type = int, default = 1,
+		help = 'The boot slot the image is to be programmed into (default 1)')
+	estimateAction.add_argument('--transfer-size', action = 'store', type = int,
+		help = 'The number of bytes the host sends per download request (default the wTransferSize the bootloader advertises)')
+	compressAction.add_argument('--image', action = 'store', required = True,
+		help = 'The image file to compress')
+	compressAction.add_argument('--output', action = 'store',
+		help = 'The file to write the compressed image to (default the image with a .dbz suffix)')
+	traceAction.add_argument('--dump', action = 'store', required = True,
+		help = 'The file holding the trace entries read back from the bootloader')
+	traceAction.add_argument('--output', action = 'store',
+		help = 'The file to write the Chrome trace JSON timeline to (default the dump with a .json suffix)')
 
 	# Allow the user to pick a seed if their toolchain is not giving good nextpnr runs
 	buildAction.add_argument('--seed', action = 'store', type = int, default = 0,
@@ -52,3 +71,49 @@ def cli():
 		platform = platforms[args.target]()
 		platform.build(DragonBoot(), name = 'dragonBoot', pnrSeed = args.seed)
 		return 0
+	elif args.action == 'estimate':
+		from logging import info, error
+		from pathlib import Path
+		from .estimate import estimateProgramming, stripDFUSuffix
+
+		platform = platforms[args.target]()
+		image = stripDFUSuffix(Path(args.image).read_bytes())
+		try:
+			estimate = estimateProgramming(platform, len(image), slot = args.slot, transferSize = args.transfer_size)
+		except ValueError as e:
+			error(str(e))
+			return 1
+		for line in estimate.report():
+			info(line)
+		return 0
+	elif args.action == 'compress':
+		from logging import info
+		from pathlib import Path
+		from .estimate import stripDFUSuffix
+		from .compression import compressImage
+
+		imagePath = Path(args.image)
+		outputPath = Path(args.output) if args.output is not None else imagePath.with_suffix('.dbz')
+		image = stripDFUSuffix(imagePath.read_bytes())
+		compressed = compressImage(image)
+		outputPath.write_bytes(compressed)
+		info(f'Compressed {len(image)} bytes to {len(compressed)} ({len(image) / max(len(compressed), 1):.2f}:1), '
+			f'written to {outputPath}')
+		return 0
+	elif args.action == 'trace':
+		from logging import info, error
+		from json import dump
+		from pathlib import Path
+		from .trace import traceToChrome
+
+		dumpPath = Path(args.dump)
+		outputPath = Path(args.output) if args.output is not None else dumpPath.with_suffix('.json')
+		try:
+			timeline = traceToChrome(dumpPath.read_bytes())
+		except ValueError as e:
+			error(str(e))
+			return 1
+		with outputPath.open('w') as file:
+			dump(timeline, file)
+		info(f'Timeline written to {outputPath}, which can be opened in Perfetto or chrome://tracing')
+		return 0
@@ -1,12 +1,15 @@
 # SPDX-License-Identifier: BSD-3-Clause
 from torii.hdl import Elaboratable, Module, Signal, ClockDomain, ResetSignal
 from torii.build import Platform
+from typing import Tuple
 from torii_usb.usb2 import USBDevice
+from torii_usb.usb.usb2.endpoints.stream import USBStreamOutEndpoint
 from torii_usb.usb.request.windows import WindowsRequestHandler
 from usb_construct.emitters.descriptors.standard import (
 	DeviceDescriptorCollection, LanguageIDs, DeviceClassCodes, InterfaceClassCodes,
 	ApplicationSubclassCodes, DFUProtocolCodes
 )
+from usb_construct.types import USBTransferType
 from usb_construct.types.descriptors.dfu import *
 from usb_construct.contextmgrs.descriptors.dfu import *
 from usb_construct.types.descriptors.microsoft import *
@@ -19,8 +22,30 @@ from .timeout import ConnectTimeout
 
 __all__ = (
 	'DragonBoot',
+	'flashBus',
 )
 
+def flashBus(platform : Platform) -> Tuple[Tuple[str, int], int]:
+	""" Works out which resource the Flash bus should be run over for the given platform, and with how many data lanes.
+
+	Parameters
+	----------
+	platform
+		The platform the gateware is for.
+
+	Returns
+	-------
+	Tuple[Tuple[str, int], int]
+		The name and number of the Flash bus resource, and the number of data lanes to use on it.
+	"""
+	# If the platform wires up the Flash's IO2 and IO3 lines and describes this with a QSPI resource, use that
+	# unless the bus is to be run by a hard SB_SPI block which can only make use of a single data lane
+	if ('flash_qspi', 0) in platform.resources and getattr(platform, 'flashHardSPI', None) is None:
+		flashResource = ('flash_qspi', 0)
+		dataLanes = next(io for io in platform.lookup(*flashResource).ios if io.name == 'dq')
+		return flashResource, len(dataLanes.ios[0].names)
+	return ('flash_spi', 0), 1
+
 class DragonBoot(Elaboratable):
 	""" The top-level of the dragonBoot gateware and implementation of the descriptors and SOL USB device.
 
@@ -38,6 +63,10 @@ class DragonBoot(Elaboratable):
 	USB LS/FS interface even on a device such as the Lattice iCE40UP5K which is unable to work at ULPI speeds.
 	We configure by default for the :py:class:`sol.gateware.usb.usb2.device.USBDevice` to connect in high speed
 	mode and define the :code:`usb` clock domain, while SOL handles setting up clocking that domain appropriately.
+
+	If the platform sets dfuStreaming, a second, vendor-specific, interface is added with a bulk OUT endpoint
+	(endpoint 1) whose data is fed to the DFU request handler for the :py:attr:`dragonBoot.dfu.VendorRequests.streamSlot`
+	request. Its packets are 512 bytes when the device can run at high speed over ULPI, and 64 bytes otherwise.
 	"""
 	def elaborate(self, platform: Platform) -> Module:
 		""" Describes the specific gateware needed to provide the descriptors and handlers and device logic to talk USB.
@@ -57,6 +86,12 @@ class DragonBoot(Elaboratable):
 			m.domains.usb = ClockDomain()
 			ulpiInterface = platform.request('ulpi', 0)
 			m.submodules.device = device = USBDevice(bus = ulpiInterface, handle_clocking = True)
+			streamPacketSize = 512
+			# The ULPI PHY only clocks the USB domain, so any Flash domain must come from the platform's PLL
+			if getattr(platform, 'flashClockFreq', None) is not None:
+				if not hasattr(platform, 'pll_type'):
+					raise AssertionError('Platform does not define an implementation for a PLL to clock the Flash with')
+				m.submodules.clocking = platform.pll_type()
 		elif ('usb', 0) in platform.resources:
 			if not hasattr(platform, 'pll_type'):
 				raise AssertionError('Platform does not define an implementation for a PLL to clock it')
@@ -64,9 +99,11 @@ class DragonBoot(Elaboratable):
 			m.submodules.clocking = pllType()
 			usbInterface = platform.request('usb', 0)
 			m.submodules.device = device = USBDevice(bus = usbInterface, handle_clocking = False)
+			streamPacketSize = 64
 		else:
 			raise AssertionError('Platform fails to define any valid USB resources!')
 		m.submodules.warmboot = warmboot = Warmboot()
+		streaming = getattr(platform, 'dfuStreaming', False)
 
 		descriptors = DeviceDescriptorCollection()
 		with descriptors.DeviceDescriptor() as deviceDesc:
@@ -100,10 +137,24 @@ class DragonBoot(Elaboratable):
 
 					with FunctionalDescriptor(interfaceDesc) as functionalDesc:
 						functionalDesc.bmAttributes = (
-							DFUWillDetach.YES | DFUManifestationTolerant.NO | DFUCanUpload.NO | DFUCanDownload.YES
+							DFUWillDetach.YES | DFUManifestationTolerant.YES | DFUCanDownload.YES |
+							(DFUCanUpload.YES if DFURequestHandler.canUpload(platform) else DFUCanUpload.NO)
 						)
 						functionalDesc.wDetachTimeOut = 1000
-						functionalDesc.wTransferSize = platform.flash.erasePageSize
+						functionalDesc.wTransferSize = DFURequestHandler.transferSize(platform)
+
+			if streaming:
+				with configDesc.InterfaceDescriptor() as interfaceDesc:
+					interfaceDesc.bInterfaceNumber = 1
+					interfaceDesc.bInterfaceClass = InterfaceClassCodes.VENDOR
+					interfaceDesc.bInterfaceSubclass = 0
+					interfaceDesc.bInterfaceProtocol = 0
+					interfaceDesc.iInterface = 'Image streaming interface'
+
+					with interfaceDesc.EndpointDescriptor() as endpointDesc:
+						endpointDesc.bEndpointAddress = 0x01
+						endpointDesc.bmAttributes = USBTransferType.BULK
+						endpointDesc.wMaxPacketSize = streamPacketSize
 
 		platformDescriptors = PlatformDescriptorCollection()
 		with descriptors.BOSDescriptor() as bos:
@@ -122,11 +173,29 @@ class DragonBoot(Elaboratable):
 									compatID.CompatibleID = 'WINUSB'
 									compatID.SubCompatibleID = ''
 
+							if streaming:
+								with subsetConfig.SubsetHeaderFunction() as subsetFunc:
+									subsetFunc.bFirstInterface = 1
+
+									with subsetFunc.FeatureCompatibleID() as compatID:
+										compatID.CompatibleID = 'WINUSB'
+										compatID.SubCompatibleID = ''
+
 		descriptors.add_language_descriptor((LanguageIDs.ENGLISH_US, ))
 		ep0 = device.add_standard_control_endpoint(descriptors)
 
-		dfuRequestHandler = DFURequestHandler(configuration = 1, interface = 0, resource = ('flash_spi', 0))
+		flashResource, flashLanes = flashBus(platform)
+		dfuRequestHandler = DFURequestHandler(
+			configuration = 1, interface = 0, resource = flashResource, lanes = flashLanes,
+			clockFreq = device.data_clock
+		)
 		ep0.add_request_handler(dfuRequestHandler)
+		m.d.comb += dfuRequestHandler.busReset.eq(device.reset_detected)
+
+		if streaming:
+			streamEndpoint = USBStreamOutEndpoint(endpoint_number = 1, max_packet_size = streamPacketSize)
+			device.add_endpoint(streamEndpoint)
+			m.d.comb += dfuRequestHandler.streamData.stream_eq(streamEndpoint.stream)
 
 		ep0.add_request_handler(WindowsRequestHandler(platformDescriptors))
 
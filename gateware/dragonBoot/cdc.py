@@ -0,0 +1,287 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from torii.hdl import Elaboratable, Module, Signal, Cat
+from torii.lib.cdc import FFSynchronizer, PulseSynchronizer
+
+from .flash import SPIFlash
+
+__all__ = (
+	'BusSynchronizer',
+	'SPIFlashSynchronizer',
+)
+
+class BusSynchronizer(Elaboratable):
+	""" Synchronises a multi-bit value from one clock domain into another.
+
+	Attributes
+	----------
+	i : Signal(width), input
+		The value to synchronise, in the input domain.
+	o : Signal(width), output
+		The last value sampled from i, in the output domain.
+
+	Notes
+	-----
+	Unlike a :py:class:`torii.lib.cdc.FFSynchronizer` on each bit, this never produces a value that mixes bits from
+	before and after i changes. The input domain samples i into a holding register and toggles a request bit over to
+	the output domain, which copies the holding register (which can't be changing at that point) into o and toggles
+	an acknowledgement bit back. Only once that acknowledgement arrives is i sampled again, so o follows i with a
+	latency of a few cycles of each domain, and changes to i that last less than that may not be seen at all.
+	"""
+	def __init__(self, width : int, *, i_domain : str, o_domain : str):
+		"""
+		Parameters
+		----------
+		width
+			The width of the value to synchronise.
+		i_domain
+			The clock domain i is in.
+		o_domain
+			The clock domain o is to be in.
+		"""
+		self._i_domain = i_domain
+		self._o_domain = o_domain
+
+		self.i = Signal(width)
+		self.o = Signal(width)
+
+	def elaborate(self, platform) -> Module:
+		""" Describes the gateware needed to synchronise the value.
+
+		Parameters
+		----------
+		platform
+			The Amaranth platform for which the gateware will be synthesised.
+
+		Returns
+		-------
+		:py:class:`torii.hdl.dsl.Module`
+			A complete description of the gateware behaviour required.
+		"""
+		m = Module()
+		holding = Signal.like(self.i)
+		request = Signal()
+		requestSync = Signal()
+		acknowledge = Signal()
+		acknowledgeSync = Signal()
+
+		m.submodules.requestSync = FFSynchronizer(request, requestSync, o_domain = self._o_domain)
+		m.submodules.acknowledgeSync = FFSynchronizer(acknowledge, acknowledgeSync, o_domain = self._i_domain)
+
+		# Once the last sample has been taken by the output domain, take the next
+		with m.If(acknowledgeSync == request):
+			m.d[self._i_domain] += [
+				holding.eq(self.i),
+				request.eq(~request),
+			]
+
+		with m.If(requestSync != acknowledge):
+			m.d[self._o_domain] += [
+				self.o.eq(holding),
+				acknowledge.eq(requestSync),
+			]
+		return m
+
+class SPIFlashSynchronizer(Elaboratable):
+	""" Bridges the control interface of a :py:class:`dragonBoot.flash.SPIFlash` run in its own clock domain over
+	into the domain of the logic controlling it.
+
+	The attributes mirror those of the same name on :py:class:`dragonBoot.flash.SPIFlash`, so this can be controlled
+	just as the SPI Flash engine would be if it were in the controlling domain.
+
+	Attributes
+	----------
+	ready : Signal(), output
+		Held high once the SPI Flash engine has finished configuring the Flash.
+	start : Signal(), input
+		Strobe that starts an erase-and-program operation of byteCount bytes.
+	done : Signal(), output
+		Strobe indicating the operation in progress has completed.
+	finish : Signal(), input
+		Ignored, as each operation is finished in the SPI Flash engine's domain as soon as it completes.
+	resetAddrs : Signal(), input
+		Strobe that resets the SPI Flash engine's addresses to beginAddr, and its end address to endAddr.
+	seek : Signal(), input
+		Strobe that moves the SPI Flash engine's write address to seekAddr.
+	beginAddr : Signal(addressWidth), input
+	endAddr : Signal(addressWidth), input
+		The bounds of the slot, taken when resetAddrs is passed on to the SPI Flash engine.
+	seekAddr : Signal(addressWidth), input
+	seekEnd : Signal(addressWidth), input
+		The bounds of the data to be written after a seek, taken when seek is passed on to the SPI Flash engine.
+	byteCount : Signal(24), input
+		The length of the operation requested by start, taken in the same cycle as start.
+	eraseStart : Signal(), input
+		Strobe that starts an erase of the rest of the slot.
+	readStart : Signal(), input
+		Strobe that starts a read of readCount bytes into the read FIFO.
+	readCount : Signal(24), input
+		The length of the read requested by readStart, taken in the same cycle as readStart.
+	readAddr : Signal(addressWidth), output
+		The address the next read will start from.
+	verifyFailed : Signal(), output
+		Whether the last operation to complete failed to verify.
+	outOfRange : Signal(), output
+		Whether the last operation to complete was refused for running past endAddr.
+	busyEstimate : Signal(16), output
+		The SPI Flash engine's estimate of how long is left of the operation in progress.
+	erasing : Signal(), output
+	programming : Signal(), output
+	starved : Signal(), output
+		What the SPI Flash engine is doing, as reported by it.
+
+	Notes
+	-----
+	The strobes that start operations are held as pending in the controlling domain, and passed on one at a time
+	(resetAddrs first, then seek) as single cycle strobes in the SPI Flash engine's domain, with the next only passed on once
+	the last has been acknowledged. Each is passed on along with the values to be taken with it, which are held
+	steady till the acknowledgement comes back, and a strobe given while another is still to be passed on is
+	queued up behind it rather than lost - as happens when resetAddrs is followed immediately by eraseStart.
+	Only one of each strobe may be pending at a time, which the controlling logic guarantees by not starting
+	another operation until the last is done.
+
+	The completion of an operation is passed back as a single done strobe, with verifyFailed and outOfRange (which
+	are set before done and held until the next operation starts) synchronised alongside it. The read address is
+	tracked in the controlling domain from resetAddrs and the readCount of each readStart in the same way the SPI
+	Flash engine does, so needs no synchronisation, and busyEstimate goes through a :py:class:`BusSynchronizer`.
+	The erasing, programming and starved flags are each synchronised on their own, so are only good for timing how
+	long the SPI Flash engine spends in each.
+
+	The SPI Flash engine's FIFOs must be asynchronous FIFOs with their SPI Flash engine side in its domain.
+	"""
+	def __init__(self, flash : SPIFlash, *, domain : str, flashDomain : str):
+		"""
+		Parameters
+		----------
+		flash
+			The SPI Flash engine to bridge to.
+		domain
+			The clock domain of the logic controlling the SPI Flash engine.
+		flashDomain
+			The clock domain the SPI Flash engine runs in.
+		"""
+		self._flash = flash
+		self._domain = domain
+		self._flashDomain = flashDomain
+
+		self.ready = Signal()
+		self.start = Signal()
+		self.done = Signal()
+		self.finish = Signal()
+		self.resetAddrs = Signal()
+		self.seek = Signal()
+		self.beginAddr = Signal.like(flash.beginAddr)
+		self.endAddr = Signal.like(flash.endAddr)
+		self.seekAddr = Signal.like(flash.seekAddr)
+		self.seekEnd = Signal.like(flash.seekEnd)
+		self.byteCount = Signal.like(flash.byteCount)
+		self.eraseStart = Signal()
+		self.readStart = Signal()
+		self.readCount = Signal.like(flash.readCount)
+
+		self.readAddr = Signal.like(flash.readAddr)
+		self.verifyFailed = Signal()
+		self.outOfRange = Signal()
+		self.busyEstimate = Signal.like(flash.busyEstimate)
+		self.erasing = Signal()
+		self.programming = Signal()
+		self.starved = Signal()
+
+	def elaborate(self, platform) -> Module:
+		""" Describes the gateware needed to bridge the two domains.
+
+		Parameters
+		----------
+		platform
+			The Amaranth platform for which the gateware will be synthesised.
+
+		Returns
+		-------
+		:py:class:`torii.hdl.dsl.Module`
+			A complete description of the gateware behaviour required.
+		"""
+		m = Module()
+		flash = self._flash
+		domain = self._domain
+		flashDomain = self._flashDomain
+
+		# The strobes in the order they're passed on in
+		strobes = (self.resetAddrs, self.seek, self.start, self.eraseStart, self.readStart)
+		flashStrobes = (flash.resetAddrs, flash.seek, flash.start, flash.eraseStart, flash.readStart)
+
+		pending = Signal(len(strobes))
+		command = Signal(len(strobes))
+		byteCount = Signal.like(self.byteCount)
+		readCount = Signal.like(self.readCount)
+		request = Signal()
+		requestSync = Signal()
+		acknowledge = Signal()
+		acknowledgeSync = Signal()
+		configured = Signal()
+
+		m.submodules.requestSync = FFSynchronizer(request, requestSync, o_domain = flashDomain)
+		m.submodules.acknowledgeSync = FFSynchronizer(acknowledge, acknowledgeSync, o_domain = domain)
+
+		# Queue up strobes, taking the values that go with them, and pass them on one at a time, lowest first
+		with m.If(self.start):
+			m.d[domain] += byteCount.eq(self.byteCount)
+		with m.If(self.readStart):
+			m.d[domain] += readCount.eq(self.readCount)
+		nextPending = pending | Cat(*strobes)
+		with m.If((acknowledgeSync == request) & (pending != 0)):
+			nextCommand = pending & -pending
+			m.d[domain] += [
+				command.eq(nextCommand),
+				pending.eq(nextPending & ~nextCommand),
+				request.eq(~request),
+			]
+			with m.If(nextCommand[0]):
+				m.d[domain] += [
+					flash.beginAddr.eq(self.beginAddr),
+					flash.endAddr.eq(self.endAddr),
+				]
+			with m.If(nextCommand[1]):
+				m.d[domain] += [
+					flash.seekAddr.eq(self.seekAddr),
+					flash.seekEnd.eq(self.seekEnd),
+				]
+		with m.Else():
+			m.d[domain] += pending.eq(nextPending)
+
+		# Pass on each command as a strobe, alongside the values held for it
+		m.d.comb += [
+			flash.byteCount.eq(byteCount),
+			flash.readCount.eq(readCount),
+		]
+		with m.If(requestSync != acknowledge):
+			m.d.comb += Cat(*flashStrobes).eq(command)
+			m.d[flashDomain] += acknowledge.eq(requestSync)
+
+		# Track the read address as the SPI Flash engine does
+		with m.If(self.resetAddrs):
+			m.d[domain] += self.readAddr.eq(self.beginAddr)
+		with m.Elif(self.readStart):
+			m.d[domain] += self.readAddr.eq(self.readAddr + self.readCount)
+
+		# Finish operations straight away, passing back that they're done
+		m.submodules.doneSync = doneSync = PulseSynchronizer(i_domain = flashDomain, o_domain = domain)
+		m.d.comb += [
+			flash.finish.eq(flash.done),
+			doneSync.i.eq(flash.done),
+			self.done.eq(doneSync.o),
+		]
+		with m.If(flash.ready):
+			m.d[flashDomain] += configured.eq(1)
+		m.submodules.readySync = FFSynchronizer(configured, self.ready, o_domain = domain)
+		m.submodules.verifyFailedSync = FFSynchronizer(flash.verifyFailed, self.verifyFailed, o_domain = domain)
+		m.submodules.outOfRangeSync = FFSynchronizer(flash.outOfRange, self.outOfRange, o_domain = domain)
+		m.submodules.erasingSync = FFSynchronizer(flash.erasing, self.erasing, o_domain = domain)
+		m.submodules.programmingSync = FFSynchronizer(flash.programming, self.programming, o_domain = domain)
+		m.submodules.starvedSync = FFSynchronizer(flash.starved, self.starved, o_domain = domain)
+		m.submodules.busyEstimateSync = busyEstimateSync = BusSynchronizer(
+			len(self.busyEstimate), i_domain = flashDomain, o_domain = domain
+		)
+		m.d.comb += [
+			busyEstimateSync.i.eq(flash.busyEstimate),
+			self.busyEstimate.eq(busyEstimateSync.o),
+		]
+		return m
@@ -0,0 +1,334 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from torii.hdl import Elaboratable, Module, Signal, Memory, Const, Cat, Mux, ResetInserter
+from torii.lib.stream.simple import StreamInterface
+from typing import Dict, List
+
+__all__ = (
+	'compressedMagic',
+	'compressImage',
+	'decompressImage',
+	'StreamDecompressor',
+)
+
+compressedMagic = b'dBZ1'
+""" The 4 bytes a compressed image starts with, which tell the bootloader the image is to be decompressed. """
+
+# The size of the window LZ matches can reach back into, and the limits on each of the token types
+windowSize = 512
+maxLiteral = 128
+maxRun = 16384
+minMatch = 3
+maxMatch = 34
+# The number of candidates checked for each LZ match, most recent first
+matchCandidates = 32
+
+def compressImage(image : bytes) -> bytes:
+	""" Compresses an image into the format understood by :py:class:`StreamDecompressor`.
+
+	The compressed image is :py:data:`compressedMagic` followed by a series of tokens, each starting with a control
+	byte:
+
+	* :code:`0nnnnnnn` is a literal run - the next :math:`n + 1` bytes are copied to the output as-is.
+	* :code:`10nnnnnn` is a byte run - the next byte holds the bottom 8 bits of :math:`n`, and the byte after that is
+	  repeated :math:`n + 1` times in the output.
+	* :code:`11nnnnnd` is an LZ match - the next byte holds the bottom 8 bits of :math:`d`, and the :math:`n + 3`
+	  bytes starting :math:`d + 1` bytes back in the output are copied to it.
+
+	Matches can reach back up to 512 bytes, and may overlap the bytes they produce. The image is parsed greedily,
+	taking whichever of a byte run or the longest match found covers the most of the image at each point, and
+	falling back to literals where neither saves anything.
+
+	Parameters
+	----------
+	image
+		The raw image, as built into :code:`build/<name>.bin`.
+
+	Returns
+	-------
+	bytes
+		The compressed image.
+	"""
+	result = bytearray(compressedMagic)
+	literals = bytearray()
+	chains : Dict[bytes, List[int]] = {}
+	length = len(image)
+
+	def flushLiterals():
+		for offset in range(0, len(literals), maxLiteral):
+			chunk = literals[offset:offset + maxLiteral]
+			result.append(len(chunk) - 1)
+			result.extend(chunk)
+		literals.clear()
+
+	position = 0
+	while position < length:
+		byte = image[position]
+		run = 1
+		while run < maxRun and position + run < length and image[position + run] == byte:
+			run += 1
+
+		# Look for the longest match amongst the most recent places the next 3 bytes were seen
+		bestLength = 0
+		bestDistance = 0
+		for candidate in reversed(chains.get(image[position:position + minMatch], [])[-matchCandidates:]):
+			distance = position - candidate
+			if distance > windowSize:
+				break
+			matchLength = minMatch
+			while (matchLength < maxMatch and position + matchLength < length and
+				image[candidate + matchLength] == image[position + matchLength]):
+				matchLength += 1
+			if matchLength > bestLength:
+				bestLength = matchLength
+				bestDistance = distance
+				if matchLength == maxMatch:
+					break
+
+		# A byte run costs 3 bytes and a match 2, so only take a run where it covers more than the match does
+		if run > max(bestLength, minMatch):
+			flushLiterals()
+			result.extend((0x80 | ((run - 1) >> 8), (run - 1) & 0xFF, byte))
+			step = run
+		elif bestLength >= minMatch:
+			flushLiterals()
+			code = ((bestLength - minMatch) << 1) | ((bestDistance - 1) >> 8)
+			result.extend((0xC0 | code, (bestDistance - 1) & 0xFF))
+			step = bestLength
+		else:
+			literals.append(byte)
+			step = 1
+
+		for offset in range(position, min(position + step, length - minMatch + 1)):
+			chains.setdefault(image[offset:offset + minMatch], []).append(offset)
+		position += step
+	flushLiterals()
+	return bytes(result)
+
+def decompressImage(data : bytes) -> bytes:
+	""" Decompresses an image produced by :py:func:`compressImage`, as the bootloader does.
+
+	Parameters
+	----------
+	data
+		The image to decompress. If this does not start with :py:data:`compressedMagic`, it is returned as-is.
+
+	Returns
+	-------
+	bytes
+		The decompressed image.
+	"""
+	if not data.startswith(compressedMagic):
+		return bytes(data)
+	result = bytearray()
+	position = len(compressedMagic)
+	while position < len(data):
+		control = data[position]
+		position += 1
+		if control < 0x80:
+			count = control + 1
+			result.extend(data[position:position + count])
+			position += count
+		elif control < 0xC0:
+			count = (((control & 0x3F) << 8) | data[position]) + 1
+			result.extend(data[position + 1:position + 2] * count)
+			position += 2
+		else:
+			count = ((control >> 1) & 0x1F) + minMatch
+			distance = (((control & 1) << 8) | data[position]) + 1
+			position += 1
+			for _ in range(count):
+				result.append(result[-distance])
+	return bytes(result)
+
+class StreamDecompressor(Elaboratable):
+	""" Decompresses images in the format produced by :py:func:`compressImage` as they stream through.
+
+	Attributes
+	----------
+	start : Signal(), input
+		Strobe that starts a new image, which is checked for :py:data:`compressedMagic` to decide whether to
+		decompress it or pass it through as-is.
+	sink : StreamInterface(), input stream
+		The image data coming in.
+	source : StreamInterface(), output stream
+		The decompressed image data going out.
+	busy : Signal(), output
+		Whether the decompressor has data to output that does not depend on any more input.
+
+	Notes
+	-----
+	The first 4 bytes of each image are compared to :py:data:`compressedMagic` as they come in. If they match, the
+	rest of the image is decoded token by token. Otherwise, the bytes that matched so far are replayed from the
+	magic, followed by the one that didn't match, and the rest of the image is passed straight through.
+
+	Each byte output is also written into a 512 byte history memory, which LZ matches are copied back out of. The
+	history is read one cycle ahead of the output, from the address the output will be at in the next cycle, with
+	the read being transparent so that a match can copy from the byte being output in the same cycle. Together,
+	this lets byte runs and matches be output at one byte per cycle for as long as the source is ready, with a
+	single cycle spent on each control byte and length or distance byte, and one more to start each match.
+	"""
+	def __init__(self):
+		self.start = Signal()
+		self.sink = StreamInterface()
+		self.source = StreamInterface()
+		self.busy = Signal()
+
+	def elaborate(self, platform) -> Module:
+		""" Describes the gateware needed to decompress the image stream.
+
+		Parameters
+		----------
+		platform
+			The Amaranth platform for which the gateware will be synthesised.
+
+		Returns
+		-------
+		:py:class:`torii.hdl.dsl.Module`
+			A complete description of the gateware behaviour required.
+		"""
+		m = Module()
+		sink = self.sink
+		source = self.source
+
+		history = Memory(width = 8, depth = windowSize)
+		m.submodules.historyWrite = historyWrite = history.write_port()
+		m.submodules.historyRead = historyRead = history.read_port(transparent = True)
+
+		magic = Const(int.from_bytes(compressedMagic, byteorder = 'little'), 8 * len(compressedMagic))
+		headerPos = Signal(range(len(compressedMagic)))
+		replayPos = Signal.like(headerPos)
+		heldByte = Signal(8)
+		count = Signal(range(maxRun))
+		runByte = Signal(8)
+		matchDistance = Signal(range(windowSize))
+		outputPos = Signal(range(windowSize))
+		advance = Signal()
+
+		# Record everything output into the history, reading ahead from where the next byte output will be
+		m.d.comb += [
+			advance.eq(source.valid & source.ready),
+			historyWrite.addr.eq(outputPos),
+			historyWrite.data.eq(source.data),
+			historyWrite.en.eq(advance),
+			historyRead.addr.eq(outputPos + advance - matchDistance - 1),
+		]
+		with m.If(advance):
+			m.d.sync += outputPos.eq(outputPos + 1)
+
+		with m.FSM(name = 'decompress'):
+			# HEADER -- Check whether the image starts with the magic
+			with m.State('HEADER'):
+				m.d.comb += sink.ready.eq(1)
+				with m.If(sink.valid):
+					with m.If(sink.data == magic.word_select(headerPos, 8)):
+						m.d.sync += headerPos.eq(headerPos + 1)
+						with m.If(headerPos == len(compressedMagic) - 1):
+							m.next = 'TOKEN'
+					with m.Else():
+						m.d.sync += [
+							heldByte.eq(sink.data),
+							replayPos.eq(0),
+						]
+						m.next = 'REPLAY'
+
+			# REPLAY -- Output the bytes taken while checking for the magic, as the image is not compressed
+			with m.State('REPLAY'):
+				m.d.comb += [
+					source.valid.eq(1),
+					source.data.eq(Mux(replayPos == headerPos, heldByte, magic.word_select(replayPos, 8))),
+					self.busy.eq(1),
+				]
+				with m.If(source.ready):
+					m.d.sync += replayPos.eq(replayPos + 1)
+					with m.If(replayPos == headerPos):
+						m.next = 'RAW'
+
+			# RAW -- Pass the rest of an uncompressed image straight through
+			with m.State('RAW'):
+				m.d.comb += [
+					source.valid.eq(sink.valid),
+					source.data.eq(sink.data),
+					sink.ready.eq(source.ready),
+				]
+
+			# TOKEN -- Decode the next control byte
+			with m.State('TOKEN'):
+				m.d.comb += sink.ready.eq(1)
+				with m.If(sink.valid):
+					with m.If(~sink.data[7]):
+						m.d.sync += count.eq(sink.data[0:7])
+						m.next = 'LITERAL'
+					with m.Elif(~sink.data[6]):
+						m.d.sync += count.eq(Cat(Const(0, 8), sink.data[0:6]))
+						m.next = 'RUN_LENGTH'
+					with m.Else():
+						m.d.sync += [
+							count.eq(sink.data[1:6] + (minMatch - 1)),
+							matchDistance[8].eq(sink.data[0]),
+						]
+						m.next = 'MATCH_DISTANCE'
+
+			# LITERAL -- Copy bytes from the input to the output
+			with m.State('LITERAL'):
+				m.d.comb += [
+					source.valid.eq(sink.valid),
+					source.data.eq(sink.data),
+					sink.ready.eq(source.ready),
+				]
+				with m.If(advance):
+					m.d.sync += count.eq(count - 1)
+					with m.If(count == 0):
+						m.next = 'TOKEN'
+
+			# RUN_LENGTH -- Take the bottom 8 bits of a byte run's length
+			with m.State('RUN_LENGTH'):
+				m.d.comb += sink.ready.eq(1)
+				with m.If(sink.valid):
+					m.d.sync += count[0:8].eq(sink.data)
+					m.next = 'RUN_BYTE'
+
+			# RUN_BYTE -- Take the byte to repeat for a byte run
+			with m.State('RUN_BYTE'):
+				m.d.comb += sink.ready.eq(1)
+				with m.If(sink.valid):
+					m.d.sync += runByte.eq(sink.data)
+					m.next = 'RUN'
+
+			# RUN -- Repeat the byte till the run is complete
+			with m.State('RUN'):
+				m.d.comb += [
+					source.valid.eq(1),
+					source.data.eq(runByte),
+					self.busy.eq(1),
+				]
+				with m.If(source.ready):
+					m.d.sync += count.eq(count - 1)
+					with m.If(count == 0):
+						m.next = 'TOKEN'
+
+			# MATCH_DISTANCE -- Take the bottom 8 bits of an LZ match's distance
+			with m.State('MATCH_DISTANCE'):
+				m.d.comb += sink.ready.eq(1)
+				with m.If(sink.valid):
+					m.d.sync += matchDistance[0:8].eq(sink.data)
+					m.next = 'MATCH_START'
+
+			# MATCH_START -- Wait for the history to read back the first byte of the match
+			with m.State('MATCH_START'):
+				m.d.comb += self.busy.eq(1)
+				m.next = 'MATCH'
+
+			# MATCH -- Copy bytes from the history till the match is complete
+			with m.State('MATCH'):
+				m.d.comb += [
+					source.valid.eq(1),
+					source.data.eq(historyRead.data),
+					self.busy.eq(1),
+				]
+				with m.If(source.ready):
+					m.d.sync += count.eq(count - 1)
+					with m.If(count == 0):
+						m.next = 'TOKEN'
+
+		# Starting a new image puts everything back to checking for the magic
+		return ResetInserter(self.start)(m)
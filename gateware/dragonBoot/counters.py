@@ -0,0 +1,95 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from enum import IntEnum, unique
+from struct import calcsize, unpack
+from torii.hdl import Elaboratable, Module, Signal
+from typing import Dict, List
+
+__all__ = (
+	'PerformanceCounter',
+	'PerformanceCounters',
+	'counterFormat',
+	'unpackCounters',
+)
+
+@unique
+class PerformanceCounter(IntEnum):
+	""" An enumeration of the performance counters kept by the DFU request handler, in the order they are read back. """
+	flashEraseCycles = 0
+	""" USB clock cycles the SPI Flash engine spent erasing the Flash. """
+	flashProgramCycles = 1
+	""" USB clock cycles the SPI Flash engine spent programming pages, including waiting for their data. """
+	flashStarvedCycles = 2
+	""" USB clock cycles page programs were held up waiting for the bitstream FIFO to hold the page's data. """
+	flashIdleCycles = 3
+	""" USB clock cycles the SPI Flash engine sat idle during a download, waiting on the host for more data. """
+	bytesReceived = 4
+	""" Bytes of image data received, from download requests or streaming. """
+	downloadRequests = 5
+	""" DFU download requests received, including the zero length one that completes a download. """
+	getStatusRequests = 6
+	""" DFU GET_STATUS requests received. """
+	stalls = 7
+	""" Control requests stalled by the handler. """
+
+counterFormat = f'<{len(PerformanceCounter)}I'
+""" The :py:mod:`struct` format the counters are read back in - each as a 32-bit little endian value. """
+
+def unpackCounters(data : bytes) -> Dict[PerformanceCounter, int]:
+	""" Unpacks the counters read back by a :py:attr:`dragonBoot.dfu.VendorRequests.readCounters` request.
+
+	Parameters
+	----------
+	data
+		The data returned by the request.
+
+	Returns
+	-------
+	Dict[PerformanceCounter, int]
+		The value of each counter.
+	"""
+	if len(data) != calcsize(counterFormat):
+		raise ValueError(f'Performance counters are {calcsize(counterFormat)} bytes long, got {len(data)}')
+	return dict(zip(PerformanceCounter, unpack(counterFormat, data)))
+
+class PerformanceCounters(Elaboratable):
+	""" A block of counters, one per :py:class:`PerformanceCounter`, counting the cycles on which their event occurs.
+
+	Attributes
+	----------
+	events : Signal(len(PerformanceCounter)), input
+		The events to count, one bit per counter with bit :code:`n` being that of counter :code:`n`.
+	clear : Signal(), input
+		Strobe that sets all of the counters back to 0.
+	freeze : Signal(), input
+		Holds the counters at their current values while asserted, so they can be read out a byte at a time without
+		changing part way through. Events that occur while frozen are not counted.
+	counts : List[Signal(32)], output
+		The value of each of the counters, which wrap around once they reach their maximum.
+	"""
+	def __init__(self):
+		self.events = Signal(len(PerformanceCounter))
+		self.clear = Signal()
+		self.freeze = Signal()
+		self.counts : List[Signal] = [Signal(32, name = f'{counter.name}Count') for counter in PerformanceCounter]
+
+	def elaborate(self, platform) -> Module:
+		""" Describes the gateware needed to count the events.
+
+		Parameters
+		----------
+		platform
+			The Amaranth platform for which the gateware will be synthesised.
+
+		Returns
+		-------
+		:py:class:`torii.hdl.dsl.Module`
+			A complete description of the gateware behaviour required.
+		"""
+		m = Module()
+
+		for counter, count in zip(PerformanceCounter, self.counts):
+			with m.If(self.clear):
+				m.d.sync += count.eq(0)
+			with m.Elif(self.events[counter] & ~self.freeze):
+				m.d.sync += count.inc()
+		return m
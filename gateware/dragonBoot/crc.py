@@ -0,0 +1,63 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from torii.hdl import Elaboratable, Module, Signal, Mux
+
+__all__ = (
+	'CRC32',
+)
+
+class CRC32(Elaboratable):
+	""" Byte-at-a-time CRC-32 (as used by zlib and Ethernet) calculation gateware.
+
+	Attributes
+	----------
+	reset : Signal(), input
+		Strobe that restarts the calculation, discarding all data seen so far.
+	valid : Signal(), input
+		Strobe indicating data holds the next byte to fold into the CRC.
+	data : Signal(8), input
+		The next byte of data to fold into the CRC.
+	value : Signal(32), output
+		The CRC-32 of all the bytes seen since the last reset.
+
+	Notes
+	-----
+	This uses the reflected form of the polynomial 0x04C11DB7, with an initial value of 0xFFFFFFFF and the final
+	value inverted, so the result matches that from :py:func:`zlib.crc32`. A whole byte is folded in per cycle.
+	"""
+	polynomial = 0xEDB88320
+
+	def __init__(self):
+		self.reset = Signal()
+		self.valid = Signal()
+		self.data = Signal(8)
+		self.value = Signal(32)
+
+	def elaborate(self, platform) -> Module:
+		""" Describes the gateware needed to calculate the CRC.
+
+		Parameters
+		----------
+		platform
+			The Amaranth platform for which the gateware will be synthesised.
+
+		Returns
+		-------
+		:py:class:`torii.hdl.dsl.Module`
+			A complete description of the gateware behaviour required.
+		"""
+		m = Module()
+		crc = Signal(32, reset = 0xFFFFFFFF)
+
+		# Unroll the bit-serial form of the calculation for all 8 bits of the byte, least significant first
+		nextCRC = crc
+		for bit in range(8):
+			feedback = nextCRC[0] ^ self.data[bit]
+			nextCRC = nextCRC.shift_right(1) ^ Mux(feedback, self.polynomial, 0)
+
+		with m.If(self.reset):
+			m.d.sync += crc.eq(crc.reset)
+		with m.Elif(self.valid):
+			m.d.sync += crc.eq(nextCRC)
+
+		m.d.comb += self.value.eq(~crc)
+		return m
@@ -1,6 +1,6 @@
 # SPDX-License-Identifier: BSD-3-Clause
-from torii.hdl import Module, Signal, DomainRenamer, Cat, Memory, Const
-from torii.lib.fifo import AsyncFIFO
+from torii.hdl import Module, Signal, DomainRenamer, Cat, Memory, Const, Mux
+from torii.lib.stream.simple import StreamInterface
 from usb_construct.types import USBRequestType, USBRequestRecipient, USBStandardRequests
 from usb_construct.types.descriptors.dfu import DFURequests
 from torii_usb.usb.usb2.request import (
@@ -10,14 +10,20 @@ from torii_usb.usb.stream import USBInStreamInterface, USBOutStreamInterface
 from torii_usb.stream.generator import StreamSerializer
 from enum import IntEnum, unique
 from struct import pack as structPack, unpack as structUnpack
-from typing import Tuple
+from typing import Optional, Tuple
 import logging
 
 from .platform import Flash
 from .flash import SPIFlash
+from .fifo import RewindFIFO
+from .cdc import SPIFlashSynchronizer
+from .compression import StreamDecompressor
+from .counters import PerformanceCounter, PerformanceCounters
+from .trace import TraceEvent, TraceBuffer, traceEntrySize
 
 __all__ = (
 	'DFURequestHandler',
+	'VendorRequests',
 )
 
 @unique
@@ -28,9 +34,14 @@ class DFUState(IntEnum):
 	downloadSync = 3
 	""" The engine has just finished processing a download request and is awaiting a status request. """
 	downloadBusy = 4
-	""" The engine is processing a download request. """
+	""" The engine is processing a download request, or erasing the selected slot ahead of one. """
 	downloadIdle = 5
 	""" The engine has processed at least one download request but is currently idle. """
+	manifestSync = 6
+	""" The engine has received the zero length download request that ends a download and is awaiting a status
+	request. """
+	manifest = 7
+	""" The engine is finalising the slot downloaded into, finishing off programming the last of the data. """
 	uploadIdle = 9
 	""" The engine has processed at least one upload request but is currently idle. """
 	error = 10
@@ -41,6 +52,33 @@ class DFUStatus(IntEnum):
 	""" An enumeration of the status states the DFU request handler engine can be in. """
 	ok = 0
 	""" The engine is not in error and all is in order. """
+	errVERIFY = 7
+	""" The Flash did not read back the same as what was programmed into it. """
+	errADDRESS = 8
+	""" The host asked for data to be written outside of the selected slot. """
+
+@unique
+class VendorRequests(IntEnum):
+	""" An enumeration of the vendor-specific requests the DFU request handler accepts on its interface. """
+	eraseSlot = 0
+	""" Erase the whole of the currently selected slot in the background, so a download into it need only program
+	the Flash. This request is only accepted when no download or upload is in progress and carries no data. """
+	streamSlot = 1
+	""" Select the slot given in wValue, as SET_INTERFACE would, and stream data from the bulk OUT endpoint into it.
+	The request's data phase carries 8 bytes: the offset into the slot to start at, which must be a multiple of the
+	sector size, then the number of bytes to stream, each as a 32-bit little endian value. This request is only
+	accepted when the handler is built with streaming, the DFU state is dfuIdle and no download is in progress. """
+	readCounters = 2
+	""" Read back the performance counters, as described by :py:class:`dragonBoot.counters.PerformanceCounter` and
+	packed as :py:data:`dragonBoot.counters.counterFormat`. This request is only accepted when the handler is built
+	with counters. """
+	resetCounters = 3
+	""" Set all of the performance counters back to 0. This request carries no data, and is only accepted when the
+	handler is built with counters. """
+	readTrace = 4
+	""" Read back trace entries, as described by :py:class:`dragonBoot.trace.TraceBuffer`, starting from the entry
+	given in wValue. As much as a packet's worth of entries may be read by each request. This request is only
+	accepted when the handler is built with tracing. """
 
 class DFUConfig:
 	""" A tracking type for the current state and status of the DFU request handler engine.
@@ -68,11 +106,51 @@ class DFURequestHandler(USBRequestHandler):
 	resource
 		The fully qualified identifier for the platform resource defining the SPI bus to use to access
 		the configuration Flash.
+	lanes
+		The number of data lanes the SPI bus resource provides - 1 for a standard SPI resource, or 2 or 4
+		for a Dual or Quad SPI resource.
+	maxPacketSize
+		The maximum packet size of the control endpoint the handler is attached to.
+	doubleBuffer
+		Whether to buffer two download requests' worth of data so the next can be received while the SPI Flash
+		engine programs the last. If not given, this is taken from the platform's dfuDoubleBuffer attribute.
+	preErase
+		Whether selecting a slot other than slot 0 with SET_INTERFACE also starts an erase of the whole slot, as the
+		eraseSlot vendor request does. If not given, this is taken from the platform's dfuPreErase attribute. Upload
+		requests are not supported when pre-erasing.
+	streaming
+		Whether to accept the :py:attr:`VendorRequests.streamSlot` vendor request and take the data for it from
+		streamData. If not given, this is taken from the platform's dfuStreaming attribute.
+	compression
+		Whether to pass downloaded data through a :py:class:`dragonBoot.compression.StreamDecompressor`. If not
+		given, this is taken from the platform's dfuCompression attribute. An image that expands past the end of the
+		slot has the rest thrown away and ends in error with a status of errADDRESS.
+	addressed
+		Whether to place each download request's data in the slot by its block number, rather than straight after
+		the last request's. If not given, this is taken from the platform's dfuAddressed attribute. This cannot be
+		used along with compression.
+	counters
+		Whether to keep the :py:class:`dragonBoot.counters.PerformanceCounters`, and accept the vendor requests to
+		read and reset them. If not given, this is taken from the platform's dfuCounters attribute.
+	trace
+		Whether to record events into a :py:class:`dragonBoot.trace.TraceBuffer`, and accept the vendor request to
+		read it back. If not given, this is taken from the platform's dfuTrace attribute.
+	clockFreq
+		The frequency of the USB clock domain the handler runs in. If not given, this is taken to be the
+		frequency of the platform's default clock.
+	flashClockFreq
+		The frequency of the :code:`flash` clock domain to run the SPI Flash engine in. If not given, this is
+		taken from the platform's flashClockFreq attribute, and if that is not set either, the SPI Flash engine
+		is run in the USB clock domain along with the handler.
 
 	Attributes
 	----------
 	triggerReboot : Signal(), output
 		A signal indicating if the bootloader should trigger a reboot into the main gateware slot.
+	streamData : StreamInterface(), input stream
+		The data received on the bulk OUT endpoint, to be written to the Flash when streaming.
+	busReset : Signal(), input
+		Strobe from the USB device marking a bus reset, recorded when tracing.
 
 	Notes
 	-----
@@ -87,11 +165,11 @@ class DFURequestHandler(USBRequestHandler):
 	* The length of the request is checked and if 0, we then enter the :code:`HANDLE_DOWNLOAD_COMPLETE` state.
 
 	 	* Once in the new state we wait for the status phase where we respond with a ZLP,
-		  and change the DFU state back to dfuIdle.
+		  and change the DFU state to manifestSync to start the manifestation phase.
 		* After completion of the status phase with the resulting acknowledgment returning to us,
 		  we enter :code:`IDLE` again.
 
-	* If the length of the request is non-zero but less than the Flash sector erase page size, we enter
+	* If the length of the request is non-zero but no more than the transfer size, we enter
 	  :code:`HANDLE_DOWNLOAD_DATA` where the following steps are performed:
 
 		* We first trigger the secondary download state machine which handles pulling the payload bytes
@@ -102,30 +180,91 @@ class DFURequestHandler(USBRequestHandler):
 		* Then transitions back to :code:`IDLE`, resetting the trigger on the download state machine,
 		  when the ACK comes back from the host.
 
-	* If the length of the request exceeds the Flash device's sector erase page size, then we send the host
+	* If the length of the request exceeds the transfer size, then we send the host
 	  a stall response to indicate failure, and return to :code:`IDLE` - this should technically be impossible
 	  in a conforming implementation of DFU on the host, but we have to act defensively.
 
 	It is of particular note that the download state machine pushes the payload bytes to the bitstream FIFO
 	which is also passed through to the SPI Flash interface. This FIFO is created with enough entires
-	to store a complete Flash sector erase page of data, and re-entry into the :code:`HANDLE_DOWNLOAD` state
+	to store a complete request of data, and re-entry into the :code:`HANDLE_DOWNLOAD` state
 	is gated using the DFU protocol's status system through which we indicate to a host that Flash operations
 	are busy till not only is the FIFO exhausted, but the SPI Flash engine reports it has completed getting
 	the data written back to the configuration Flash.
 
+	The transfer size defaults to the Flash's sector erase page size, but may be made larger with dfuTransferSize,
+	in which case each request is still handed to the SPI Flash engine a sector at a time.
+
+	When double buffering, the bitstream FIFO holds two requests' worth of data, so a request that arrives while
+	the SPI Flash engine is busy with the last is queued up and the state only goes to downloadBusy while both are taken.
+
+	While in downloadBusy, status requests report the SPI Flash engine's estimate of how long it has left as the
+	bwPollTimeout, so the host sleeps rather than repeatedly polling.
+
+	The :py:attr:`VendorRequests.eraseSlot` vendor request, and SET_INTERFACE to a slot other than slot 0 when
+	pre-erasing, erase the whole slot in the background, with the state in downloadBusy till it completes.
+
 	If a DFU implementation tries to send a download request before we tell it we're ready for another,
 	it would be considered non-conforming, however this should not hurt us as while it will corrupt
 	the data written to the Flash, the FIFO can correctly handle exhaustion so should still allow operations
 	to complete. Therefore we have not attempted to further handle this other than "well just don't do that then".
+
+	Upload requests read back the selected slot, continuing from where the last upload request left off, and are
+	handled as follows:
+
+	* First we enter the :code:`HANDLE_UPLOAD` state where the length of the request is clamped to the data
+	  remaining in the slot and the SPI Flash engine is asked to stream that many bytes into the upload FIFO.
+	* We then enter :code:`HANDLE_UPLOAD_DATA`, answering each IN token of the data phase with a packet from the
+	  upload FIFO, or a NAK if the FIFO doesn't yet hold the whole packet. The FIFO's reads are only committed
+	  when the host acknowledges a packet, so if the host asks for a packet again the FIFO is rewound to resend it.
+	* Once the status phase completes we enter :code:`HANDLE_UPLOAD_FLUSH` which discards anything left of the
+	  read should the host have cut the data phase short, then return to :code:`IDLE`.
+
+	As per the DFU specification, an upload request returning less data than was asked for (including none)
+	indicates the end of the slot and returns the DFU state to dfuIdle. Upload is not supported when the Flash
+	is run through a hard SB_SPI block, in which case upload requests are stalled.
+
+	When the SPI Flash engine is given its own :code:`flash` clock domain, it is controlled through a
+	:py:class:`dragonBoot.cdc.SPIFlashSynchronizer`, with the bitstream and upload FIFOs crossing between the domains.
+
+	When streaming, the data for a :py:attr:`VendorRequests.streamSlot` request is taken from streamData and written
+	at the offset given into the slot, with the state in downloadBusy till the last of it is programmed.
+
+	When addressed, the block number in wValue of each download request places its data in the slot at the block
+	number times the transfer size, and a request that would run past the end of the slot ends in errADDRESS.
+
+	As the handler is manifestation tolerant, the slot is finalised during manifestation and the state then returns
+	to dfuIdle, so further slots may be selected and downloaded into before a single detach.
+
+	When built with counters or tracing, the vendor requests in :py:class:`VendorRequests` read back the
+	:py:class:`dragonBoot.counters.PerformanceCounters` or the :py:class:`dragonBoot.trace.TraceBuffer`.
 	"""
-	def __init__(self, *, configuration : int, interface : int, resource : Tuple[str, int]):
+	def __init__(
+		self, *, configuration : int, interface : int, resource : Tuple[str, int], lanes : int = 1,
+		maxPacketSize : int = 64, doubleBuffer : Optional[bool] = None, preErase : Optional[bool] = None,
+		clockFreq : Optional[float] = None, flashClockFreq : Optional[float] = None, streaming : Optional[bool] = None,
+		compression : Optional[bool] = None, addressed : Optional[bool] = None, counters : Optional[bool] = None,
+		trace : Optional[bool] = None
+	):
 		super().__init__()
 
 		self._configuration = configuration
 		self._interface = interface
 		self._flashResource = resource
+		self._flashLanes = lanes
+		self._maxPacketSize = maxPacketSize
+		self._doubleBuffer = doubleBuffer
+		self._preErase = preErase
+		self._clockFreq = clockFreq
+		self._flashClockFreq = flashClockFreq
+		self._streaming = streaming
+		self._compression = compression
+		self._addressed = addressed
+		self._counters = counters
+		self._trace = trace
 
 		self.triggerReboot = Signal()
+		self.streamData = StreamInterface()
+		self.busReset = Signal()
 
 	def elaborate(self, platform) -> Module:
 		""" Describes the specific gateware needed to implement DFU and its handling on USB EP0.
@@ -150,21 +289,125 @@ class DFURequestHandler(USBRequestHandler):
 		receiverCount = Signal.like(setup.length)
 		receiverConsumed = Signal.like(setup.length)
 		slot = Signal(8)
+		flashBusy = Signal()
+		pendingCount = Signal.like(setup.length)
+		blockRemaining = Signal.like(setup.length)
+		blockLength = Signal.like(setup.length)
+		requestSeek = Signal()
+		counterEvents = Signal(len(PerformanceCounter))
+		lastState = Signal(8)
+		downloadActive = Signal()
+		eraseSlot = Signal()
+		erasing = Signal()
+		# Whether the DFU state is downloadBusy for a slot erase alone, with no download having arrived since
+		eraseOnly = Signal()
+		# Whether the last GET_STATUS reported downloadSync, rather than downloadBusy before the Flash caught up
+		reportedSync = Signal()
+		streamParams = Signal(64)
+		streamOffset = streamParams[0:32]
+		streamLength = streamParams[32:64]
+		streamPending = Signal()
+		streamActive = Signal()
+		downloadReceiving = Signal()
+		flushing = Signal()
+		manifesting = Signal()
 
 		_flash : Flash = platform.flash
 		config = DFUConfig()
 		self.printSlotInfo(_flash)
 
-		m.submodules.bitstreamFIFO = bitstreamFIFO = AsyncFIFO(
-			width = 8, depth = _flash.erasePageSize, r_domain = 'usb', w_domain = 'usb'
+		doubleBuffer = self._doubleBuffer
+		if doubleBuffer is None:
+			doubleBuffer = getattr(platform, 'dfuDoubleBuffer', False)
+		bufferCount = 2 if doubleBuffer else 1
+		transferSize = self.transferSize(platform)
+		preErase = self._preErase
+		if preErase is None:
+			preErase = getattr(platform, 'dfuPreErase', False)
+		streaming = self._streaming
+		if streaming is None:
+			streaming = getattr(platform, 'dfuStreaming', False)
+		compression = self._compression
+		if compression is None:
+			compression = getattr(platform, 'dfuCompression', False)
+		addressed = self._addressed
+		if addressed is None:
+			addressed = getattr(platform, 'dfuAddressed', False)
+		counters = self._counters
+		if counters is None:
+			counters = getattr(platform, 'dfuCounters', False)
+		trace = self._trace
+		if trace is None:
+			trace = getattr(platform, 'dfuTrace', False)
+		if addressed and compression:
+			raise ValueError(
+				'Addressed downloads cannot be used with compression, as the block numbers would be of the compressed image'
+			)
+
+		flashClockFreq = self._flashClockFreq
+		if flashClockFreq is None:
+			flashClockFreq = getattr(platform, 'flashClockFreq', None)
+		flashDomain = 'usb' if flashClockFreq is None else 'flash'
+
+		# When decompressing, requests are buffered ahead of the decompressor, so the bitstream FIFO need only hold
+		# the sector the SPI Flash engine is working on
+		m.submodules.bitstreamFIFO = bitstreamFIFO = RewindFIFO(
+			width = 8, depth = (_flash.erasePageSize if compression else transferSize) * bufferCount,
+			r_domain = flashDomain, w_domain = 'usb'
 		)
-		flash : SPIFlash = DomainRenamer(sync = 'usb')(
-			SPIFlash(resource = self._flashResource, fifo = bitstreamFIFO)
+		if compression:
+			m.submodules.downloadFIFO = downloadFIFO = RewindFIFO(
+				width = 8, depth = transferSize, r_domain = 'usb', w_domain = 'usb'
+			)
+			m.submodules.decompressor = decompressor = DomainRenamer(sync = 'usb')(StreamDecompressor())
+		else:
+			downloadFIFO = bitstreamFIFO
+		# Pre-erasing would wipe any slot selected to be uploaded, so uploads are not offered alongside it
+		canUpload = self.canUpload(platform) and not preErase
+		if canUpload:
+			# This must hold more than a packet so the Flash can keep reading while a packet awaits its ACK
+			m.submodules.uploadFIFO = uploadFIFO = RewindFIFO(
+				width = 8, depth = max(_flash.pageSize, self._maxPacketSize * 2), r_domain = 'usb', w_domain = flashDomain
+			)
+		else:
+			uploadFIFO = None
+		flash : SPIFlash = DomainRenamer(sync = flashDomain)(
+			SPIFlash(
+				resource = self._flashResource, fifo = bitstreamFIFO, lanes = self._flashLanes,
+				readFIFO = uploadFIFO, maxReadLength = transferSize,
+				clockFreq = self._clockFreq if flashClockFreq is None else flashClockFreq,
+				addressWidth = _flash.addressWidth
+			)
 		)
 		m.submodules.flash = flash
+		streamRemaining = Signal(len(flash.endAddr) + 1)
+		streamReceive = Signal(len(flash.endAddr) + 1)
+		streamBlock = Signal.like(flash.byteCount)
+		produced = Signal(range(bitstreamFIFO.depth + 1))
+		producedBlock = Signal.like(flash.byteCount)
+		producedStart = Signal()
+		producedWrite = Signal()
+		# How much decompressed data has been produced since the Flash addressing was last reset
+		producedTotal = Signal.like(flash.endAddr)
+		producedOverflow = Signal()
+		# Where in the Flash the download request being handled, and any queued up behind it, start
+		requestBegin = Signal(max(len(flash.endAddr), len(setup.value) + transferSize.bit_length() - 1) + 1)
+		requestEnd = Signal(len(requestBegin) + 1)
+		requestAddr = Signal.like(flash.seekAddr)
+		pendingAddr = Signal.like(flash.seekAddr)
+		# When in its own domain, the SPI Flash engine is controlled through a bridge into the USB domain
+		if flashDomain != 'usb':
+			m.submodules.flashSync = flash = SPIFlashSynchronizer(flash, domain = 'usb', flashDomain = flashDomain)
 		m.submodules.transmitter = transmitter = StreamSerializer(
 			data_length = 6, domain = 'usb', stream_type = USBInStreamInterface, max_length_width = 3
 		)
+		if counters:
+			m.submodules.counters = perfCounters = DomainRenamer(sync = 'usb')(PerformanceCounters())
+			m.d.comb += perfCounters.events.eq(counterEvents)
+		if trace:
+			m.submodules.trace = traceBuffer = DomainRenamer(sync = 'usb')(TraceBuffer(
+				clockFreq = self._clockFreq if self._clockFreq is not None else platform.default_clk_constraint.frequency
+			))
 		slotROM = self.generateROM(_flash)
 		m.submodules.slots = slots = slotROM.read_port(domain = 'usb', transparent = False)
 
@@ -172,8 +415,18 @@ class DFURequestHandler(USBRequestHandler):
 			flash.start.eq(0),
 			flash.finish.eq(0),
 			flash.resetAddrs.eq(0),
+			flash.seek.eq(0),
+			flash.readStart.eq(0),
+			flash.eraseStart.eq(0),
+			manifesting.eq((config.state == DFUState.manifestSync) | (config.state == DFUState.manifest)),
+			# Hand the SPI Flash engine everything left of the download while the slot is finalised
+			flushing.eq(manifesting),
 		]
 
+		# Once the slot is finalised, wait for the host to ask for the status to finish manifestation
+		with m.If((config.state == DFUState.manifest) & ~downloadActive & (pendingCount == 0)):
+			m.d.usb += config.state.eq(DFUState.manifestSync)
+
 		with m.FSM(domain = 'usb', name = 'dfu'):
 			# RESET -- do initial setup of the DFU handler state
 			with m.State('RESET'):
@@ -194,8 +447,21 @@ class DFURequestHandler(USBRequestHandler):
 							with m.Case(DFURequests.DETACH):
 								m.next = 'HANDLE_DETACH'
 							with m.Case(DFURequests.DOWNLOAD):
+								m.d.comb += counterEvents[PerformanceCounter.downloadRequests].eq(1)
 								m.next = 'HANDLE_DOWNLOAD'
+							if canUpload:
+								with m.Case(DFURequests.UPLOAD):
+									m.next = 'HANDLE_UPLOAD'
 							with m.Case(DFURequests.GET_STATUS):
+								m.d.comb += counterEvents[PerformanceCounter.getStatusRequests].eq(1)
+								# While manifesting, the status reports whether the slot is finalised yet, and
+								# once it is goes back to dfuIdle with the Flash addressing back at the slot's start
+								with m.If(manifesting):
+									with m.If(downloadActive | (pendingCount != 0)):
+										m.d.usb += config.state.eq(DFUState.manifest)
+									with m.Else():
+										m.d.comb += flash.resetAddrs.eq(1)
+										m.d.usb += config.state.eq(DFUState.dfuIdle)
 								m.next = 'HANDLE_GET_STATUS'
 							with m.Case(DFURequests.CLR_STATUS):
 								m.next = 'HANDLE_CLR_STATUS'
@@ -212,31 +478,80 @@ class DFURequestHandler(USBRequestHandler):
 								m.next = 'SET_INTERFACE'
 							with m.Default():
 								m.next = 'UNHANDLED'
-					# If the underlying Flash operation is complete, signal this by going downloadSync
-					with m.If(flash.done):
-						m.d.comb += flash.finish.eq(1)
-						m.d.usb += config.state.eq(DFUState.downloadSync)
+					with m.Elif(setup.type == USBRequestType.VENDOR):
+						with m.Switch(setup.request):
+							with m.Case(VendorRequests.eraseSlot):
+								m.next = 'HANDLE_ERASE_SLOT'
+							if streaming:
+								with m.Case(VendorRequests.streamSlot):
+									m.next = 'HANDLE_STREAM'
+							if counters:
+								with m.Case(VendorRequests.readCounters):
+									m.next = 'HANDLE_READ_COUNTERS'
+								with m.Case(VendorRequests.resetCounters):
+									m.next = 'HANDLE_RESET_COUNTERS'
+							if trace:
+								with m.Case(VendorRequests.readTrace):
+									m.next = 'HANDLE_READ_TRACE'
+							with m.Default():
+								m.next = 'UNHANDLED'
 
 			# HANDLE_DETACH -- The host wishes us to reboot into run mode
 			with m.State('HANDLE_DETACH'):
-				with m.If(interface.status_requested):
-					m.d.comb += self.send_zlp()
+				# Rebooting while the slot is being finalised would leave it part programmed
+				with m.If(manifesting):
+					m.next = 'UNHANDLED'
+				with m.Else():
+					with m.If(interface.status_requested):
+						m.d.comb += self.send_zlp()
 
-				with m.If(interface.handshakes_in.ack):
-					m.d.usb += self.triggerReboot.eq(1)
+					with m.If(interface.handshakes_in.ack):
+						m.d.usb += self.triggerReboot.eq(1)
 
 			# HANDLE_DOWNLOAD -- The host is trying to send us some data to program
 			with m.State('HANDLE_DOWNLOAD'):
-				with m.If(setup.is_in_request | (setup.length > _flash.erasePageSize)):
+				with m.If(setup.is_in_request | (setup.length > transferSize) | streamActive | manifesting):
 					m.next = 'UNHANDLED'
+				if addressed:
+					# Requests whose block would not fit in the slot are refused
+					with m.Elif((setup.length != 0) & (requestEnd > flash.endAddr)):
+						m.d.usb += [
+							config.status.eq(DFUStatus.errADDRESS),
+							config.state.eq(DFUState.error),
+						]
+						m.next = 'UNHANDLED'
 				with m.Elif(setup.length):
-					m.d.comb += [
-						flash.start.eq(1),
-						flash.byteCount.eq(setup.length),
-					]
-					m.d.usb += config.state.eq(DFUState.downloadBusy)
+					if compression:
+						# The data goes through the decompressor, which is started afresh for each download
+						with m.If((config.state == DFUState.dfuIdle) | eraseOnly):
+							m.d.comb += decompressor.start.eq(1)
+						m.d.usb += [
+							downloadReceiving.eq(1),
+							config.state.eq(DFUState.downloadBusy),
+						]
+					else:
+						# If the Flash is still busy with the last request, queue this one up behind it
+						with m.If(downloadActive | (pendingCount != 0)):
+							m.d.usb += [
+								pendingCount.eq(setup.length),
+								pendingAddr.eq(requestBegin),
+								config.state.eq(DFUState.downloadBusy),
+							]
+						with m.Else():
+							m.d.usb += [
+								blockRemaining.eq(setup.length),
+								requestAddr.eq(requestBegin),
+								requestSeek.eq(addressed),
+							]
+							# If there's still a buffer free, the host can go straight on to the next request
+							if doubleBuffer:
+								m.d.usb += config.state.eq(DFUState.downloadSync)
+							else:
+								m.d.usb += config.state.eq(DFUState.downloadBusy)
+					m.d.usb += eraseOnly.eq(0)
 					m.next = 'HANDLE_DOWNLOAD_DATA'
 				with m.Else():
+					m.d.usb += eraseOnly.eq(0)
 					m.next = 'HANDLE_DOWNLOAD_COMPLETE'
 
 			with m.State('HANDLE_DOWNLOAD_DATA'):
@@ -250,23 +565,60 @@ class DFURequestHandler(USBRequestHandler):
 				with m.If(interface.status_requested):
 					m.d.comb += self.send_zlp()
 				with m.If(self.interface.handshakes_in.ack):
-					m.d.usb += rxTriggered.eq(0)
+					m.d.usb += [
+						rxTriggered.eq(0),
+						downloadReceiving.eq(0),
+					]
 					m.next = 'IDLE'
 
 			with m.State('HANDLE_DOWNLOAD_COMPLETE'):
+				# Hand whatever is left of the decompressed data to the SPI Flash engine, even if not a whole sector
+				m.d.comb += flushing.eq(1)
+				# The slot is finalised in the manifestation phase that follows, while the host polls the status
 				with m.If(interface.status_requested):
-					m.d.usb += config.state.eq(DFUState.dfuIdle)
+					m.d.usb += config.state.eq(DFUState.manifestSync)
 					m.d.comb += self.send_zlp()
 				with m.If(interface.handshakes_in.ack):
 					m.next = 'IDLE'
 
+			if canUpload:
+				self._elaborateUpload(m, flash, uploadFIFO, config, downloadActive, transferSize)
+
+			# HANDLE_ERASE_SLOT -- The host wants the selected slot erased ahead of downloading into it
+			with m.State('HANDLE_ERASE_SLOT'):
+				with m.If(setup.is_in_request | (setup.length != 0) | (config.state != DFUState.dfuIdle) | downloadActive):
+					m.next = 'UNHANDLED'
+				with m.Else():
+					m.next = 'ERASE_SLOT'
+
+			with m.State('ERASE_SLOT'):
+				with m.If(interface.status_requested):
+					m.d.comb += self.send_zlp()
+				# Once the host has seen the request accepted, go back to the start of the slot and erase it
+				with m.If(interface.handshakes_in.ack):
+					m.d.usb += eraseSlot.eq(1)
+					m.next = 'READ_SLOT_DATA'
+
+			if streaming:
+				self._elaborateStream(m, config, slot, streamParams, streamPending, downloadActive, _flash.slots)
+			if counters:
+				self._elaborateCounters(m, perfCounters)
+			if trace:
+				self._elaborateTrace(m, traceBuffer)
+
 			with m.State('HANDLE_GET_STATUS'):
 				# Hook up the transmitter ...
 				m.d.comb += [
 					transmitter.stream.attach(interface.tx),
 					transmitter.max_length.eq(6),
 					transmitter.data[0].eq(config.status),
-					Cat(transmitter.data[1:4]).eq(0),
+					# While busy, tell the host how long it should wait for the Flash before asking again
+					Cat(transmitter.data[1:4]).eq(
+						Mux(
+							(config.state == DFUState.downloadBusy) | (config.state == DFUState.manifest) | erasing,
+							flash.busyEstimate, 0
+						)
+					),
 					transmitter.data[4].eq(Cat(config.state, 0)),
 					transmitter.data[5].eq(0),
 				]
@@ -275,6 +627,7 @@ class DFURequestHandler(USBRequestHandler):
 				with m.If(self.interface.data_requested):
 					with m.If(setup.length == 6):
 						m.d.comb += transmitter.start.eq(1)
+						m.d.usb += reportedSync.eq(config.state == DFUState.downloadSync)
 					with m.Else():
 						m.d.comb += interface.handshakes_out.stall.eq(1)
 						m.next = 'IDLE'
@@ -282,7 +635,7 @@ class DFURequestHandler(USBRequestHandler):
 				# ... and ACK our status stage.
 				with m.If(interface.status_requested):
 					m.d.comb += interface.handshakes_out.ack.eq(1)
-					with m.If(config.state == DFUState.downloadSync):
+					with m.If((config.state == DFUState.downloadSync) & reportedSync):
 						m.d.usb += config.state.eq(DFUState.downloadIdle)
 					m.next = 'IDLE'
 
@@ -350,14 +703,22 @@ class DFURequestHandler(USBRequestHandler):
 
 			# SET_INTERFACE -- The host is trying to switch to one of our interface alt-modes
 			with m.State('SET_INTERFACE'):
-				# Provide a response to the status stage
-				with m.If(interface.status_requested):
-					m.d.comb += self.send_zlp()
+				# The next slot may only be selected once the last has been finalised
+				with m.If(manifesting):
+					m.next = 'UNHANDLED'
+				with m.Else():
+					# Provide a response to the status stage
+					with m.If(interface.status_requested):
+						m.d.comb += self.send_zlp()
 
-				# Copy the value once we get back an ACK from the ZLP
-				with m.If(interface.handshakes_in.ack):
-					m.d.usb += slot.eq(setup.value[0:8])
-					m.next = 'READ_SLOT_DATA'
+					# Copy the value once we get back an ACK from the ZLP
+					with m.If(interface.handshakes_in.ack):
+						m.d.usb += [
+							slot.eq(setup.value[0:8]),
+							# Slot 0 holds the bootloader itself, so is never erased just by being selected
+							eraseSlot.eq(Const(preErase) & (setup.value[0:8] != 0)),
+						]
+						m.next = 'READ_SLOT_DATA'
 
 			# UNHANDLED -- we've received a request we don't know how to handle
 			with m.State('UNHANDLED'):
@@ -378,18 +739,267 @@ class DFURequestHandler(USBRequestHandler):
 				m.d.usb += flash.beginAddr.eq(slots.data)
 				m.next = 'READ_SLOT_END'
 
-			# READ_SLOT_BEGIN -- Read the end address for the newly selected slot
+			# READ_SLOT_END -- Read the end address for the newly selected slot
 			with m.State('READ_SLOT_END'):
 				m.d.usb += flash.endAddr.eq(slots.data)
-				m.d.comb += flash.resetAddrs.eq(1)
+				# A stream must first be checked to fit in the slot, and then resets the Flash addressing itself
+				if streaming:
+					with m.If(streamPending):
+						m.next = 'STREAM_CHECK'
+				# The Flash addressing can only be reset once the Flash has finished with any operation in progress
+				with m.If(~streamPending & ~downloadActive & (pendingCount == 0)):
+					m.d.comb += flash.resetAddrs.eq(1)
+					m.next = 'START_ERASE'
+
+			# START_ERASE -- Start erasing the whole of the newly selected slot if asked to
+			with m.State('START_ERASE'):
+				with m.If(eraseSlot):
+					m.d.comb += flash.eraseStart.eq(1)
+					m.d.usb += [
+						flashBusy.eq(1),
+						erasing.eq(1),
+						eraseSlot.eq(0),
+					]
+					# Report the erase as busy so the host knows to wait, unless something else is already in hand
+					with m.If(config.state == DFUState.dfuIdle):
+						m.d.usb += [
+							config.state.eq(DFUState.downloadBusy),
+							eraseOnly.eq(1),
+						]
 				m.next = 'IDLE'
 
+			if streaming:
+				# STREAM_CHECK -- Check the stream fits in the newly selected slot
+				with m.State('STREAM_CHECK'):
+					m.d.usb += streamPending.eq(0)
+					with m.If(
+						(streamOffset[:_flash.erasePageSize.bit_length() - 1] == 0) & (streamLength != 0) &
+						(flash.beginAddr + streamOffset + streamLength <= flash.endAddr)
+					):
+						m.d.usb += config.state.eq(DFUState.downloadBusy)
+					with m.Else():
+						m.d.usb += [
+							config.status.eq(DFUStatus.errADDRESS),
+							config.state.eq(DFUState.error),
+						]
+					m.next = 'STREAM_START'
+
+				# STREAM_START -- Reset the Flash addressing and, if the stream fit, start taking its data
+				with m.State('STREAM_START'):
+					m.d.comb += flash.resetAddrs.eq(1)
+					with m.If(config.state == DFUState.downloadBusy):
+						m.d.usb += [
+							streamActive.eq(1),
+							streamReceive.eq(streamLength),
+						]
+						m.next = 'STREAM_SEEK'
+					with m.Else():
+						m.next = 'IDLE'
+
+				# STREAM_SEEK -- Move the SPI Flash engine to the offset, leaving the slot's start where it is
+				with m.State('STREAM_SEEK'):
+					m.d.comb += flash.seek.eq(1)
+					m.d.usb += streamRemaining.eq(streamLength)
+					m.next = 'IDLE'
+
+		# Requests are handed to the SPI Flash engine a sector at a time, so each can be compared or skipped on its own
+		m.d.comb += [
+			blockLength.eq(Mux(blockRemaining < _flash.erasePageSize, blockRemaining, _flash.erasePageSize)),
+			streamBlock.eq(Mux(streamRemaining < _flash.erasePageSize, streamRemaining, _flash.erasePageSize)),
+		]
+		if not compression:
+			m.d.comb += downloadActive.eq(flashBusy | (blockRemaining != 0) | streamActive)
+		else:
+			m.d.comb += [
+				producedBlock.eq(Mux(produced < _flash.erasePageSize, produced, _flash.erasePageSize)),
+				producedWrite.eq(decompressor.source.valid & decompressor.source.ready & ~producedOverflow),
+				downloadActive.eq(
+					flashBusy | streamActive | (produced != 0) | downloadFIFO.r_rdy | decompressor.busy
+				),
+			]
+			m.d.usb += produced.eq(produced + producedWrite - Mux(producedStart, producedBlock, 0))
+
+			# A small compressed image can expand past the end of the slot, so anything that would is thrown away
+			m.d.comb += producedOverflow.eq(producedTotal >= flash.endAddr - flash.beginAddr)
+			with m.If(flash.resetAddrs):
+				m.d.usb += producedTotal.eq(0)
+			with m.Elif(producedWrite):
+				m.d.usb += producedTotal.eq(producedTotal + 1)
+
+			# A request is dealt with once all of its data has made it through the decompressor
+			with m.If(
+				(config.state == DFUState.downloadBusy) & ~streamActive & ~downloadReceiving & ~downloadFIFO.r_rdy &
+				~decompressor.busy
+			):
+				m.d.usb += config.state.eq(DFUState.downloadSync)
+			with m.If(decompressor.source.valid & producedOverflow):
+				m.d.usb += [
+					config.status.eq(DFUStatus.errADDRESS),
+					config.state.eq(DFUState.error),
+				]
+
 		m.d.comb += [
-			bitstreamFIFO.w_en.eq(0),
-			bitstreamFIFO.w_data.eq(rxStream.data),
+			requestBegin.eq(flash.beginAddr + (setup.value << (transferSize.bit_length() - 1))),
+			requestEnd.eq(requestBegin + setup.length),
 		]
+		if streaming:
+			# These are held for the whole stream, as the seek may only be passed on once the addressing is reset
+			with m.If(streamActive):
+				m.d.comb += [
+					flash.seekAddr.eq(flash.beginAddr + streamOffset),
+					flash.seekEnd.eq(flash.beginAddr + streamOffset + streamLength),
+				]
+
+		# When decompressing, requests are finished with as soon as they've been decompressed, not programmed
+		requestProgrammed = Const(0) if compression else (blockRemaining == 0)
+
+		# If the underlying Flash operation is complete and it was the last of the request, signal this by going
+		# downloadSync (unless verification of what was programmed failed, in which case go into error), then start
+		# on the rest of the request or any request queued up behind it
+		with m.If(flash.done):
+			m.d.comb += flash.finish.eq(1)
+			m.d.usb += [
+				flashBusy.eq(0),
+				erasing.eq(0),
+				eraseOnly.eq(0),
+			]
+			with m.If(streamRemaining == 0):
+				m.d.usb += streamActive.eq(0)
+			with m.If(flash.verifyFailed):
+				m.d.usb += [
+					config.status.eq(DFUStatus.errVERIFY),
+					config.state.eq(DFUState.error),
+				]
+			with m.Elif(flash.outOfRange):
+				m.d.usb += [
+					config.status.eq(DFUStatus.errADDRESS),
+					config.state.eq(DFUState.error),
+				]
+			# A stream is done once its last sector has been programmed
+			with m.Elif(streamActive):
+				with m.If(streamRemaining == 0):
+					m.d.usb += config.state.eq(DFUState.dfuIdle)
+			# With no download behind it, a slot erase goes back to idle
+			with m.Elif(eraseOnly):
+				m.d.usb += config.state.eq(DFUState.dfuIdle)
+			with m.Elif((config.state == DFUState.downloadBusy) & requestProgrammed):
+				# A download queued behind a slot erase holds the only buffer till it has been programmed
+				if doubleBuffer:
+					m.d.usb += config.state.eq(DFUState.downloadSync)
+				else:
+					with m.If(~erasing | (pendingCount == 0)):
+						m.d.usb += config.state.eq(DFUState.downloadSync)
+		if addressed:
+			# Before starting on a request, move the SPI Flash engine to where the request's data goes
+			with m.Elif(~flashBusy & requestSeek):
+				m.d.comb += [
+					flash.seek.eq(1),
+					flash.seekAddr.eq(requestAddr),
+					flash.seekEnd.eq(requestAddr + blockRemaining),
+				]
+				m.d.usb += requestSeek.eq(0)
+		with m.Elif(~flashBusy & (blockRemaining != 0)):
+			m.d.comb += [
+				flash.start.eq(1),
+				flash.byteCount.eq(blockLength),
+			]
+			m.d.usb += [
+				flashBusy.eq(1),
+				blockRemaining.eq(blockRemaining - blockLength),
+			]
+		with m.Elif(~flashBusy & (pendingCount != 0)):
+			m.d.usb += [
+				blockRemaining.eq(pendingCount),
+				pendingCount.eq(0),
+				requestAddr.eq(pendingAddr),
+				requestSeek.eq(addressed),
+			]
+		with m.Elif(~flashBusy & (streamRemaining != 0)):
+			m.d.comb += [
+				flash.start.eq(1),
+				flash.byteCount.eq(streamBlock),
+			]
+			m.d.usb += [
+				flashBusy.eq(1),
+				streamRemaining.eq(streamRemaining - streamBlock),
+			]
+		if compression:
+			# Decompressed data is handed to the SPI Flash engine a sector at a time as it is produced
+			with m.Elif(~flashBusy & (
+				(produced >= _flash.erasePageSize) |
+				(flushing & (produced != 0) & ~downloadFIFO.r_rdy & ~decompressor.busy)
+			)):
+				m.d.comb += [
+					flash.start.eq(1),
+					flash.byteCount.eq(producedBlock),
+					producedStart.eq(1),
+				]
+				m.d.usb += flashBusy.eq(1)
+
+		m.d.comb += [
+			downloadFIFO.w_en.eq(0),
+			downloadFIFO.w_data.eq(rxStream.data),
+		]
+		if compression:
+			m.d.comb += [
+				decompressor.sink.valid.eq(downloadFIFO.r_rdy),
+				decompressor.sink.data.eq(downloadFIFO.r_data),
+				downloadFIFO.r_en.eq(decompressor.sink.ready),
+				bitstreamFIFO.w_en.eq(decompressor.source.valid & ~producedOverflow),
+				bitstreamFIFO.w_data.eq(decompressor.source.data),
+				decompressor.source.ready.eq(bitstreamFIFO.w_rdy | producedOverflow),
+			]
+		if streaming:
+			# Take the stream's data into the bitstream FIFO, leaving the endpoint to NAK the host while it's full
+			with m.If(streamReceive != 0):
+				m.d.comb += [
+					self.streamData.ready.eq(bitstreamFIFO.w_rdy),
+					bitstreamFIFO.w_data.eq(self.streamData.data),
+					bitstreamFIFO.w_en.eq(self.streamData.valid),
+				]
+				with m.If(self.streamData.valid & bitstreamFIFO.w_rdy):
+					m.d.usb += streamReceive.eq(streamReceive - 1)
+			# Throw away anything sent when there's no stream to take it
+			with m.Else():
+				m.d.comb += self.streamData.ready.eq(1)
 		receiverContinue = (receiverConsumed < receiverCount)
 
+		# Note what is going on for the performance counters
+		bytesReceived = downloadFIFO.w_en & downloadFIFO.w_rdy
+		if compression and streaming:
+			# The stream's data goes straight into the bitstream FIFO rather than through the decompressor
+			bytesReceived = bytesReceived | (bitstreamFIFO.w_en & bitstreamFIFO.w_rdy & (streamReceive != 0))
+		m.d.comb += [
+			counterEvents[PerformanceCounter.flashEraseCycles].eq(flash.erasing),
+			counterEvents[PerformanceCounter.flashProgramCycles].eq(flash.programming),
+			counterEvents[PerformanceCounter.flashStarvedCycles].eq(flash.starved),
+			counterEvents[PerformanceCounter.flashIdleCycles].eq(~flashBusy & (
+				(config.state == DFUState.downloadSync) | (config.state == DFUState.downloadBusy) |
+				(config.state == DFUState.downloadIdle)
+			)),
+			counterEvents[PerformanceCounter.bytesReceived].eq(bytesReceived),
+			counterEvents[PerformanceCounter.stalls].eq(interface.handshakes_out.stall),
+		]
+
+		# Record what is going on in the trace
+		if trace:
+			stateNow = Cat(config.state, config.status)
+			m.d.usb += lastState.eq(stateNow)
+			m.d.comb += [
+				traceBuffer.events[TraceEvent.dfuState].eq(stateNow != lastState),
+				traceBuffer.data[TraceEvent.dfuState].eq(stateNow),
+				traceBuffer.events[TraceEvent.setup].eq(setup.received),
+				traceBuffer.data[TraceEvent.setup].eq(Cat(setup.request, setup.type, setup.is_in_request, setup.value)),
+				traceBuffer.events[TraceEvent.flashStart].eq(flash.start),
+				traceBuffer.data[TraceEvent.flashStart].eq(flash.byteCount),
+				traceBuffer.events[TraceEvent.flashErase].eq(flash.eraseStart),
+				traceBuffer.events[TraceEvent.flashRead].eq(flash.readStart),
+				traceBuffer.data[TraceEvent.flashRead].eq(flash.readCount),
+				traceBuffer.events[TraceEvent.flashDone].eq(flash.done),
+				traceBuffer.data[TraceEvent.flashDone].eq(flash.verifyFailed),
+				traceBuffer.events[TraceEvent.busReset].eq(self.busReset),
+			]
+
 		with m.FSM(domain = 'usb', name = 'download'):
 			# IDLE -- we're not actively receiving
 			with m.State('IDLE'):
@@ -403,7 +1013,7 @@ class DFURequestHandler(USBRequestHandler):
 			with m.State('STREAMING'):
 				# If the current data byte becomes valid, store it and move to the next
 				with m.If(rxStream.valid & rxStream.next):
-					m.d.comb += bitstreamFIFO.w_en.eq(1)
+					m.d.comb += downloadFIFO.w_en.eq(1)
 
 					# Update the counter if we need to continue
 					with m.If(receiverContinue):
@@ -414,6 +1024,300 @@ class DFURequestHandler(USBRequestHandler):
 
 		return m
 
+	def _elaborateUpload(
+		self, m : Module, flash : SPIFlash, uploadFIFO : RewindFIFO, config : DFUConfig, flashBusy : Signal,
+		transferSize : int
+	):
+		""" Describes the states needed to handle an upload request, reading data back from the current slot. """
+		interface = self.interface
+		setup = interface.setup
+		tx = interface.tx
+		maxPacketSize = self._maxPacketSize
+
+		slotRemaining = Signal.like(flash.endAddr)
+		uploadLength = Signal.like(setup.length)
+		uploadCount = Signal.like(setup.length)
+		uploadSent = Signal.like(setup.length)
+		uploadShort = Signal()
+		packetLength = Signal(range(maxPacketSize + 1))
+		packetPosition = Signal(range(maxPacketSize))
+		expectingAck = Signal()
+		remaining = Signal.like(setup.length)
+
+		m.d.comb += [
+			slotRemaining.eq(flash.endAddr - flash.readAddr),
+			uploadLength.eq(Mux(setup.length < slotRemaining, setup.length, slotRemaining)),
+			remaining.eq(uploadCount - uploadSent),
+			packetLength.eq(Mux(remaining < maxPacketSize, remaining, maxPacketSize)),
+			uploadFIFO.r_en.eq(0),
+			# Reads from the upload FIFO are only committed once the host acknowledges the packet they were sent in
+			uploadFIFO.r_commit.eq(0),
+		]
+
+		with m.State('HANDLE_UPLOAD'):
+			with m.If(~setup.is_in_request | (setup.length > transferSize) | flashBusy |
+				((config.state != DFUState.dfuIdle) & (config.state != DFUState.uploadIdle))
+			):
+				m.next = 'UNHANDLED'
+			with m.Else():
+				m.d.usb += [
+					uploadCount.eq(uploadLength),
+					uploadSent.eq(0),
+					uploadShort.eq(uploadLength != setup.length),
+					expectingAck.eq(0),
+					interface.tx_data_pid.eq(1),
+				]
+				with m.If(uploadLength != 0):
+					m.d.comb += [
+						flash.readStart.eq(1),
+						flash.readCount.eq(uploadLength),
+					]
+				m.next = 'HANDLE_UPLOAD_DATA'
+
+		with m.State('HANDLE_UPLOAD_DATA'):
+			with m.If(interface.data_requested):
+				# The host didn't see our last packet, so go back and send it again once it asks again
+				with m.If(expectingAck):
+					m.d.comb += [
+						uploadFIFO.r_rewind.eq(1),
+						interface.handshakes_out.nak.eq(1),
+					]
+					m.d.usb += expectingAck.eq(0)
+				# A zero length packet ends a data phase that's come up short on a packet boundary
+				with m.Elif(packetLength == 0):
+					m.d.comb += self.send_zlp()
+					m.d.usb += expectingAck.eq(1)
+				# Only start a packet once all of it is to hand as the packet can't be paused once started
+				with m.Elif(uploadFIFO.r_level >= packetLength):
+					m.d.usb += [
+						packetPosition.eq(0),
+						expectingAck.eq(1),
+					]
+					m.next = 'HANDLE_UPLOAD_PACKET'
+				with m.Else():
+					m.d.comb += interface.handshakes_out.nak.eq(1)
+
+			with m.If(interface.handshakes_in.ack & expectingAck):
+				m.d.comb += uploadFIFO.r_commit.eq(1)
+				m.d.usb += [
+					uploadSent.eq(uploadSent + packetLength),
+					interface.tx_data_pid.eq(~interface.tx_data_pid),
+					expectingAck.eq(0),
+				]
+
+			with m.If(interface.status_requested):
+				m.d.comb += [
+					interface.handshakes_out.ack.eq(1),
+					uploadFIFO.r_rewind.eq(1),
+				]
+				m.d.usb += config.state.eq(Mux(uploadShort, DFUState.dfuIdle, DFUState.uploadIdle))
+				m.next = 'HANDLE_UPLOAD_FLUSH'
+
+		with m.State('HANDLE_UPLOAD_PACKET'):
+			m.d.comb += [
+				tx.valid.eq(1),
+				tx.data.eq(uploadFIFO.r_data),
+				tx.first.eq(packetPosition == 0),
+				tx.last.eq(packetPosition == packetLength - 1),
+			]
+			with m.If(tx.ready):
+				m.d.comb += uploadFIFO.r_en.eq(1)
+				m.d.usb += packetPosition.eq(packetPosition + 1)
+				with m.If(tx.last):
+					m.next = 'HANDLE_UPLOAD_DATA'
+
+		with m.State('HANDLE_UPLOAD_FLUSH'):
+			# Throw away whatever the host didn't take, which means waiting for the Flash to finish reading it
+			with m.If(uploadSent == uploadCount):
+				m.next = 'IDLE'
+			with m.Elif(uploadFIFO.r_rdy):
+				m.d.comb += [
+					uploadFIFO.r_en.eq(1),
+					uploadFIFO.r_commit.eq(1),
+				]
+				m.d.usb += uploadSent.eq(uploadSent + 1)
+
+	def _elaborateCounters(self, m : Module, perfCounters : PerformanceCounters):
+		""" Describes the states needed to handle the vendor requests that read and reset the performance counters. """
+		interface = self.interface
+		setup = interface.setup
+		counterLength = len(PerformanceCounter) * 4
+
+		m.submodules.counterTransmitter = transmitter = StreamSerializer(
+			data_length = counterLength, domain = 'usb', stream_type = USBInStreamInterface,
+			max_length_width = counterLength.bit_length()
+		)
+
+		# HANDLE_READ_COUNTERS -- The host wants to read back the performance counters
+		with m.State('HANDLE_READ_COUNTERS'):
+			m.d.comb += perfCounters.freeze.eq(1)
+			with m.If(~setup.is_in_request | (setup.length == 0)):
+				m.next = 'UNHANDLED'
+			with m.Else():
+				m.next = 'READ_COUNTERS'
+
+		# READ_COUNTERS -- Send as much of the counters as the host asked for, holding them still while doing so
+		with m.State('READ_COUNTERS'):
+			m.d.comb += [
+				perfCounters.freeze.eq(1),
+				transmitter.stream.attach(interface.tx),
+				transmitter.max_length.eq(Mux(setup.length < counterLength, setup.length, counterLength)),
+			]
+			for counter, count in zip(PerformanceCounter, perfCounters.counts):
+				m.d.comb += Cat(transmitter.data[counter * 4:(counter + 1) * 4]).eq(count)
+
+			with m.If(interface.data_requested):
+				m.d.comb += transmitter.start.eq(1)
+			with m.If(interface.status_requested):
+				m.d.comb += interface.handshakes_out.ack.eq(1)
+				m.next = 'IDLE'
+
+		# HANDLE_RESET_COUNTERS -- The host wants the performance counters set back to 0
+		with m.State('HANDLE_RESET_COUNTERS'):
+			with m.If(setup.is_in_request | (setup.length != 0)):
+				m.next = 'UNHANDLED'
+			with m.Else():
+				m.next = 'RESET_COUNTERS'
+
+		with m.State('RESET_COUNTERS'):
+			with m.If(interface.status_requested):
+				m.d.comb += self.send_zlp()
+			with m.If(interface.handshakes_in.ack):
+				m.d.comb += perfCounters.clear.eq(1)
+				m.next = 'IDLE'
+
+	def _elaborateTrace(self, m : Module, traceBuffer : TraceBuffer):
+		""" Describes the states needed to handle the vendor request that reads back the trace. """
+		interface = self.interface
+		setup = interface.setup
+		tx = interface.tx
+		maxPacketSize = self._maxPacketSize
+
+		traceBase = Signal.like(traceBuffer.readAddr)
+		tracePosition = Signal(range(maxPacketSize))
+		advance = Signal()
+
+		# Read each entry from the buffer a cycle ahead of when its first byte is to be sent
+		m.d.comb += [
+			advance.eq(tx.valid & tx.ready),
+			traceBuffer.readAddr.eq(traceBase + ((tracePosition + advance) >> (traceEntrySize.bit_length() - 1))),
+		]
+
+		# HANDLE_READ_TRACE -- The host wants to read back trace entries, which must fit in a single packet
+		with m.State('HANDLE_READ_TRACE'):
+			with m.If(~setup.is_in_request | (setup.length == 0) | (setup.length > maxPacketSize)):
+				m.next = 'UNHANDLED'
+			with m.Else():
+				m.d.usb += [
+					traceBase.eq(setup.value),
+					tracePosition.eq(0),
+					interface.tx_data_pid.eq(1),
+				]
+				m.next = 'READ_TRACE'
+
+		# READ_TRACE -- Wait for the host to ask for the entries, sending them again should it ask again
+		with m.State('READ_TRACE'):
+			with m.If(interface.data_requested):
+				m.next = 'READ_TRACE_PACKET'
+			with m.If(interface.status_requested):
+				m.d.comb += interface.handshakes_out.ack.eq(1)
+				m.next = 'IDLE'
+
+		# READ_TRACE_PACKET -- Send the entries a byte at a time
+		with m.State('READ_TRACE_PACKET'):
+			m.d.comb += [
+				tx.valid.eq(1),
+				tx.data.eq(traceBuffer.readData.word_select(tracePosition[0:traceEntrySize.bit_length() - 1], 8)),
+				tx.first.eq(tracePosition == 0),
+				tx.last.eq(tracePosition == setup.length - 1),
+			]
+			with m.If(tx.ready):
+				m.d.usb += tracePosition.eq(tracePosition + 1)
+				# Go back to the first entry, ready should the host ask for them again
+				with m.If(tx.last):
+					m.d.usb += tracePosition.eq(0)
+					m.next = 'READ_TRACE'
+
+	def _elaborateStream(
+		self, m : Module, config : DFUConfig, slot : Signal, streamParams : Signal, streamPending : Signal,
+		downloadActive : Signal, slotCount : int
+	):
+		""" Describes the states needed to handle the streamSlot vendor request, taking the offset and length of
+		the stream from its data phase before selecting the slot it is for. """
+		interface = self.interface
+		setup = interface.setup
+
+		# HANDLE_STREAM -- The host wants to stream data into a slot over the bulk endpoint
+		with m.State('HANDLE_STREAM'):
+			with m.If(setup.is_in_request | (setup.length != 8) | (setup.value >= slotCount) |
+				(config.state != DFUState.dfuIdle) | downloadActive
+			):
+				m.next = 'UNHANDLED'
+			with m.Else():
+				m.next = 'STREAM_SETUP'
+
+		# STREAM_SETUP -- Take the stream's offset and length from the data phase
+		with m.State('STREAM_SETUP'):
+			with m.If(interface.rx.valid & interface.rx.next):
+				m.d.usb += streamParams.eq(Cat(streamParams[8:], interface.rx.data))
+
+			with m.If(interface.rx_ready_for_response):
+				m.d.comb += interface.handshakes_out.ack.eq(1)
+			with m.If(interface.status_requested):
+				m.d.comb += self.send_zlp()
+			# Once the host has seen the request accepted, select the slot and check the stream fits in it
+			with m.If(interface.handshakes_in.ack):
+				m.d.usb += [
+					slot.eq(setup.value[0:8]),
+					streamPending.eq(1),
+				]
+				m.next = 'READ_SLOT_DATA'
+
+	@staticmethod
+	def canUpload(platform) -> bool:
+		""" Determines whether upload requests can be supported on the given platform.
+
+		Parameters
+		----------
+		platform
+			The platform for which the gateware will be synthesised.
+
+		Returns
+		-------
+		bool
+			Whether the platform's Flash bus allows the data to be read back for upload requests, which is
+			not the case when it is run through a hard SB_SPI block, and whether selecting a slot leaves its data
+			in place to be read back, which is not the case when pre-erasing.
+		"""
+		return getattr(platform, 'flashHardSPI', None) is None and not getattr(platform, 'dfuPreErase', False)
+
+	@staticmethod
+	def transferSize(platform) -> int:
+		""" Determines the largest download or upload request the handler accepts on the given platform.
+
+		Parameters
+		----------
+		platform
+			The platform for which the gateware will be synthesised.
+
+		Returns
+		-------
+		int
+			The platform's dfuTransferSize if it sets one, otherwise its Flash's sector erase size. This is what is
+			advertised to the host as the DFU functional descriptor's wTransferSize.
+		"""
+		sectorSize = platform.flash.erasePageSize
+		transferSize = getattr(platform, 'dfuTransferSize', None)
+		if transferSize is None:
+			return sectorSize
+		# The buffer must be a power of 2 in size, and requests can be no longer than the 16-bit wLength allows
+		if transferSize < sectorSize or transferSize & (transferSize - 1) or transferSize > 32768:
+			raise ValueError(
+				f'DFU transfer size must be a power of 2 between the {sectorSize} byte sector size and 32KiB, '
+				f'got {transferSize}'
+			)
+		return transferSize
+
 	def handler_condition(self, setup : SetupPacket):
 		""" Defines the setup packet conditions under which the request handler will operate.
 
@@ -434,14 +1338,16 @@ class DFURequestHandler(USBRequestHandler):
 		-----
 		The condition for the operation of this handler is defined as being either:
 
-		* A Standard request to the handler's interface, or
-		* A Class-specific (ie, DFU) request to the handler's interface.
+		* A Standard request to the handler's interface,
+		* A Class-specific (ie, DFU) request to the handler's interface, or
+		* A Vendor-specific request to the handler's interface.
 
 		This is as well as the current device configuration matching the one for this handler.
 		"""
 		return (
 			(self.interface.active_config == self._configuration) &
-			((setup.type == USBRequestType.CLASS) | (setup.type == USBRequestType.STANDARD)) &
+			((setup.type == USBRequestType.CLASS) | (setup.type == USBRequestType.STANDARD) |
+				(setup.type == USBRequestType.VENDOR)) &
 			(setup.recipient == USBRequestRecipient.INTERFACE) &
 			(setup.index == self._interface)
 		)
@@ -487,10 +1393,10 @@ class DFURequestHandler(USBRequestHandler):
 		-------
 		:py:class:`torii.hdl.mem.Memory`
 			A Memory object defining the Flash slot address layout as described above.
-			The memory object uses 24-bit entries as the Flash addresses are 24-bit,
+			The memory object uses entries as wide as the Flash's addresses (:py:attr:`Flash.addressWidth`),
 			and has :math:`flash.slots * 2` entries.
 		"""
-		# 4 bytes per address, 2 addresses per slot (but the highest byte of each address will get truncated off)
+		# 4 bytes per address, 2 addresses per slot (but the highest byte of 24-bit addresses will get truncated off)
 		totalSize = flash.slots * 8
 		rom = bytearray(totalSize)
 		romAddress = 0
@@ -502,4 +1408,4 @@ class DFURequestHandler(USBRequestHandler):
 
 		romEntries = (rom[i:i + 4] for i in range(0, totalSize, 4))
 		initialiser = [structUnpack('>I', romEntry)[0] for romEntry in romEntries]
-		return Memory(width = 24, depth = flash.slots * 2, init = initialiser)
+		return Memory(width = flash.addressWidth, depth = flash.slots * 2, init = initialiser)
@@ -0,0 +1,320 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from math import ceil
+from typing import Dict, List, Optional
+
+from torii.build import Platform
+
+from .platform import Flash
+from .bootloader import flashBus
+from .dfu import DFURequestHandler
+
+__all__ = (
+	'USBSpeed',
+	'ProgrammingEstimate',
+	'estimateProgramming',
+	'stripDFUSuffix',
+)
+
+class USBSpeed:
+	""" The characteristics of a USB bus speed that govern how quickly DFU requests can move data. """
+	def __init__(self, *, name : str, bitRate : float, frameTime : float, packetOverhead : int, clockFreq : float):
+		"""
+		Parameters
+		----------
+		name
+			The name of the bus speed
+		bitRate
+			The signalling rate of the bus in bits per second
+		frameTime
+			The length of a (micro)frame in seconds, which is the latency a host adds to scheduling a control transfer
+		packetOverhead
+			The number of byte times each data packet costs beyond its payload - the token and handshake packets,
+			SYNC, PID, CRC and EOP fields, and the inter-packet gaps
+		clockFreq
+			The frequency of the :code:`usb` clock domain the USB device (and Flash controller, unless it is given its own
+			clock domain) run in at this speed
+		"""
+		self.name = name
+		self.bitRate = bitRate
+		self.frameTime = frameTime
+		self.packetOverhead = packetOverhead
+		self.clockFreq = clockFreq
+
+	def transactionTime(self, length : int) -> float:
+		""" Calculates how long a single transaction carrying the given number of bytes of data spends on the bus. """
+		# Allow for worst-case bit stuffing, which data that is mostly 0xFF (such as bitstream padding) approaches
+		return (length + self.packetOverhead) * 8 * (7 / 6) / self.bitRate
+
+fullSpeed = USBSpeed(name = 'full speed', bitRate = 12e6, frameTime = 1e-3, packetOverhead = 13, clockFreq = 12e6)
+highSpeed = USBSpeed(name = 'high speed', bitRate = 480e6, frameTime = 125e-6, packetOverhead = 24, clockFreq = 60e6)
+
+# The endpoint 0 max packet size, and the number of controller cycles each Flash transaction spends on CS handling
+maxPacketSize = 64
+spiTransactionCycles = 4
+
+class ProgrammingEstimate:
+	""" The modelled time taken to program an image into a boot slot over DFU, broken down by phase.
+
+	Attributes
+	----------
+	imageSize : int
+		The number of bytes in the image.
+	transfers : int
+		The number of DFU_DNLOAD requests needed to send the image, not including the final zero-length request.
+	transferSize : int
+		The largest number of bytes sent in a single DFU_DNLOAD request (wTransferSize).
+	speed : USBSpeed
+		The USB bus speed the bootloader runs at.
+	sckFreq : float
+		The frequency, in Hz, the Flash SPI bus is clocked at.
+	lanes : int
+		The number of data lanes the Flash SPI bus uses.
+	phases : Dict[str, float]
+		The total time, in seconds, spent in each phase. Phases run concurrently with each other, so these
+		add up to more than :py:attr:`total`.
+	erases : Dict[int, int]
+		The number of erases of each erase size, in bytes, used.
+	total : float
+		The total time, in seconds, from the first DFU_DNLOAD request to the end of the download.
+	notes : List[str]
+		Caveats about the model for this platform.
+	"""
+	def __init__(self, *, imageSize : int, transfers : int, transferSize : int, speed : USBSpeed, sckFreq : float,
+		lanes : int
+	):
+		self.imageSize = imageSize
+		self.transfers = transfers
+		self.transferSize = transferSize
+		self.speed = speed
+		self.sckFreq = sckFreq
+		self.lanes = lanes
+		self.phases : Dict[str, float] = {
+			'USB data': 0.0,
+			'Host scheduling': 0.0,
+			'Flash compare': 0.0,
+			'Flash erase': 0.0,
+			'Flash program': 0.0,
+			'Flash verify': 0.0,
+		}
+		self.erases : Dict[int, int] = {}
+		self.total = 0.0
+		self.notes : List[str] = []
+
+	@property
+	def throughput(self) -> float:
+		""" The average rate, in bytes per second, the image is programmed at. """
+		return self.imageSize / self.total if self.total else 0.0
+
+	def report(self) -> List[str]:
+		""" Builds a human readable breakdown of the estimate, one line per entry. """
+		erases = ', '.join(f'{count} x {size // 1024}KiB' for size, count in sorted(self.erases.items()) if count)
+		lines = [
+			f'Image of {self.imageSize} bytes sent as {self.transfers} requests of up to {self.transferSize} bytes '
+			f'at {self.speed.name}',
+			f'Flash SPI bus at {self.sckFreq / 1e6:g}MHz on {self.lanes} data lane{"s" if self.lanes > 1 else ""}, '
+			f'erasing with {erases or "no erases"}',
+		]
+		for phase, time in self.phases.items():
+			if time:
+				lines.append(f'{phase + ":":<16} {time * 1000:10.1f}ms')
+		lines.append(f'{"Total:":<16} {self.total * 1000:10.1f}ms ({self.throughput / 1024:.1f}KiB/s)')
+		lines.extend(f'Note: {note}' for note in self.notes)
+		return lines
+
+def stripDFUSuffix(image : bytes) -> bytes:
+	""" Removes the DFU file suffix from an image if it has one, as the host does before downloading it. """
+	if len(image) >= 16 and image[-8:-5] == b'UFD' and 16 <= image[-5] <= len(image):
+		return image[:-image[-5]]
+	return image
+
+def estimateProgramming(
+	platform : Platform, imageSize : int, slot : int = 1, transferSize : Optional[int] = None
+) -> ProgrammingEstimate:
+	""" Models how long the bootloader built for a platform takes to program an image into one of its boot slots.
+
+	The model follows what the gateware does for each DFU_DNLOAD request - the erases the Flash controller picks,
+	the Flash commands it issues and when it has the data for them, and whether the next request can be received
+	while the last is being programmed - using the typical erase and program times of the platform's Flash. The host
+	is assumed to start each control transfer in the (micro)frame after it asked to, and to poll the bootloader
+	again as soon as the poll timeout it is given has passed.
+
+	Parameters
+	----------
+	platform
+		The platform the bootloader is built for.
+	imageSize
+		The number of bytes in the image to be programmed.
+	slot
+		The boot slot the image is programmed into.
+	transferSize
+		The number of bytes the host sends in each DFU_DNLOAD request. If not given, this is taken to be the
+		wTransferSize the bootloader advertises.
+
+	Returns
+	-------
+	ProgrammingEstimate
+		The modelled time taken, broken down by phase.
+	"""
+	flash : Flash = platform.flash
+	if slot < 1 or slot >= flash.slots:
+		raise ValueError(f'Boot slot must be between 1 and {flash.slots - 1}, got {slot}')
+	beginAddress = flash.partitions[slot]['beginAddress']
+	endAddress = flash.partitions[slot]['endAddress']
+	if imageSize > endAddress - beginAddress:
+		raise ValueError(f'Image of {imageSize} bytes does not fit in the {endAddress - beginAddress} byte boot slot')
+	if flash.eraseTime is None or flash.programTime is None:
+		raise ValueError('The erase and program times of the platform Flash are not known, give the Flash a part')
+
+	speed = highSpeed if ('ulpi', 0) in platform.resources else fullSpeed
+	_, lanes = flashBus(platform)
+	hardSPI = getattr(platform, 'flashHardSPI', None)
+	if hardSPI is not None:
+		cyclesPerSCK = getattr(platform, 'flashHardSPIDivider', 1) + 1
+	elif getattr(platform, 'flashFullRate', False):
+		cyclesPerSCK = 1
+	else:
+		cyclesPerSCK = 2
+	flashClockFreq = getattr(platform, 'flashClockFreq', None)
+	if flashClockFreq is None:
+		flashClockFreq = speed.clockFreq
+	sckFreq = flashClockFreq / cyclesPerSCK
+	differential = getattr(platform, 'flashDifferential', False) and hardSPI is None
+	verify = getattr(platform, 'flashVerify', False) and hardSPI is None
+	doubleBuffer = getattr(platform, 'dfuDoubleBuffer', False)
+	preErase = getattr(platform, 'dfuPreErase', False)
+
+	sectorSize = flash.erasePageSize
+	pageSize = flash.pageSize
+	maxTransferSize = DFURequestHandler.transferSize(platform)
+	if transferSize is None:
+		transferSize = maxTransferSize
+	elif transferSize < 1 or transferSize > maxTransferSize:
+		raise ValueError(f'Transfer size must be between 1 and {maxTransferSize} bytes, got {transferSize}')
+	transfers = ceil(imageSize / transferSize)
+	estimate = ProgrammingEstimate(
+		imageSize = imageSize, transfers = transfers, transferSize = transferSize, speed = speed,
+		sckFreq = sckFreq, lanes = lanes
+	)
+
+	def spiTime(commandLength : int, dataLength : int = 0, dataLanes : int = 1) -> float:
+		cycles = commandLength * 8 + ceil(dataLength * 8 / dataLanes)
+		return (cycles * cyclesPerSCK + spiTransactionCycles) / flashClockFreq
+
+	# Status register polls run continuously with CS held, so each wait costs the command and a byte or so
+	statusTime = spiTime(1, 1)
+	writeEnableTime = spiTime(1)
+	# Commands that take an address send the opcode followed by the address bytes, and reads a dummy byte on top
+	addressCommand = 1 + flash.addressWidth // 8
+	readCommand = addressCommand + 1
+	# Without the 4-byte address opcodes, each operation is bracketed by entering and exiting 4-byte address mode
+	addressModeTime = 2 * spiTime(1) if flash.addressWidth == 32 and not flash.fourByteOpcodes else 0.0
+	# Only quad buses program with more than one lane, reads use all the lanes available
+	programLanes = 4 if lanes == 4 else 1
+
+	eraseTimes = flash.eraseTimes
+	if differential:
+		eraseTimes = {sectorSize: eraseTimes[sectorSize]}
+	for size, time in eraseTimes.items():
+		if time is None:
+			eraseTimes[size] = flash.eraseTime * size // sectorSize
+			estimate.notes.append(
+				f'The {size // 1024}KiB block erase time is not known, it is taken to be that of the sectors it covers'
+			)
+	estimate.erases = {size: 0 for size in eraseTimes}
+
+	if flash.part is not None and sckFreq > flash.part.maxClock:
+		estimate.notes.append(f'The SPI bus runs faster than the {flash.part.maxClock / 1e6:g}MHz the Flash supports')
+	if differential:
+		estimate.notes.append('Every sector is assumed to have changed, and so to need erasing and programming')
+	if getattr(platform, 'flashSkipBlank', False) and not verify:
+		estimate.notes.append('Pages whose data is all 0xFF are not programmed, which is not taken into account')
+	if preErase:
+		estimate.notes.append('The whole slot is erased when it is selected, and this is taken to delay the first request')
+	if getattr(platform, 'flashDiscovery', False):
+		estimate.notes.append('Block erases the Flash describes in its SFDP parameters are not taken into account')
+
+	frameTime = speed.frameTime
+	eraseAddress = beginAddress
+	writeAddress = beginAddress
+
+	def eraseTo(address : int) -> float:
+		nonlocal eraseAddress
+		# Pick the largest erase the erase address is aligned to that doesn't run past the end of the slot
+		eraseTime = 0.0
+		while eraseAddress < address:
+			size = max(
+				size for size in eraseTimes
+				if size == sectorSize or (eraseAddress % size == 0 and eraseAddress + size <= endAddress)
+			)
+			eraseTime += addressModeTime + writeEnableTime + spiTime(addressCommand) + eraseTimes[size] + statusTime
+			estimate.erases[size] += 1
+			eraseAddress += size
+		return eraseTime
+
+	pageTime = (
+		addressModeTime + writeEnableTime + spiTime(addressCommand, pageSize, programLanes) + flash.programTime +
+		statusTime
+	)
+
+	ready = 0.0
+	flashDone = 0.0
+	lastFlashDone = 0.0
+	if preErase:
+		# Selecting the slot erases all of it, and the first request is queued up behind that
+		flashDone = eraseTo(endAddress)
+		estimate.phases['Flash erase'] += flashDone
+	for offset in range(0, imageSize, transferSize):
+		length = min(transferSize, imageSize - offset)
+		writeEnd = writeAddress + length
+
+		# The data stage of the request, bracketed by its setup and status stages
+		usbTime = speed.transactionTime(8) + speed.transactionTime(0)
+		for packet in range(0, length, maxPacketSize):
+			usbTime += speed.transactionTime(min(maxPacketSize, length - packet))
+
+		# The request is handed to the Flash controller a sector at a time
+		compareTime = 0.0
+		eraseTime = 0.0
+		programTime = 0.0
+		verifyTime = 0.0
+		for blockAddress in range(writeAddress, writeEnd, sectorSize):
+			blockEnd = min(blockAddress + sectorSize, writeEnd)
+			if differential and blockAddress % sectorSize == 0 and blockEnd - blockAddress == sectorSize:
+				# The comparison stops once the first page shows the sector needs erasing and programming
+				compareTime += addressModeTime + spiTime(readCommand, pageSize)
+
+			eraseTime += eraseTo(blockEnd)
+
+			# Page Programs stop at page boundaries, so count the pages the data touches
+			pages = (blockEnd - 1) // pageSize - blockAddress // pageSize + 1
+			programTime += pages * pageTime
+
+			if verify:
+				verifyTime += addressModeTime + spiTime(readCommand, blockEnd - blockAddress, lanes)
+
+		# The host sends the request in the next frame, and the Flash controller is started by its setup stage
+		# unless the last request is still being programmed, in which case it is queued behind that
+		start = ready + frameTime
+		dataDone = start + usbTime
+		flashStart = max(start, flashDone)
+		flashWork = compareTime + eraseTime + programTime + verifyTime
+		# The last page can't be programmed till its data has arrived
+		lastFlashDone, flashDone = flashDone, flashStart + max(flashWork, dataDone - flashStart + pageTime + verifyTime)
+
+		# The host next polls the status; with double buffering it can move on as soon as the request is
+		# being programmed, otherwise it must wait for the programming to complete
+		ready = max(dataDone, lastFlashDone if doubleBuffer else flashDone) + frameTime
+
+		estimate.phases['USB data'] += usbTime
+		estimate.phases['Host scheduling'] += 2 * frameTime
+		estimate.phases['Flash compare'] += compareTime
+		estimate.phases['Flash erase'] += eraseTime
+		estimate.phases['Flash program'] += programTime
+		estimate.phases['Flash verify'] += verifyTime
+		writeAddress = writeEnd
+
+	# The final zero-length request completes once the Flash is done, then the host polls the status one last time
+	start = ready + frameTime
+	estimate.total = max(start + speed.transactionTime(8), flashDone) + frameTime
+	estimate.phases['Host scheduling'] += 2 * frameTime
+	return estimate
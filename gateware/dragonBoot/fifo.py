@@ -0,0 +1,165 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from torii.hdl import Elaboratable, Module, Signal, Memory, Mux, ResetSignal
+from torii.lib.cdc import FFSynchronizer, AsyncFFSynchronizer
+from torii.lib.coding import GrayEncoder, GrayDecoder
+from torii.lib.fifo import FIFOInterface
+
+__all__ = (
+	'RewindFIFO',
+)
+
+class RewindFIFO(Elaboratable, FIFOInterface):
+	""" Asynchronous FIFO whose reader can go back and read data again.
+
+	This is a drop-in replacement for :py:class:`torii.lib.fifo.AsyncFIFO` that adds the notion of committing
+	reads. Data that has been read but not yet committed is still held by the FIFO, with the space it takes up
+	not being made available to the writer, so the reader can rewind back to the last point it committed at and
+	read the same data again.
+
+	Attributes
+	----------
+	r_commit : Signal(), input
+		Whether reads are committed - while this is held high, which it is by default, the FIFO behaves as a normal
+		FIFO. While it is held low, reads are not committed until it is next asserted, at which point all reads made
+		up to and including that cycle are committed.
+	r_rewind : Signal(), input
+		Strobe that rewinds the read side of the FIFO to the last committed read, ready to read the same data again.
+
+	Notes
+	-----
+	The design of this queue is the same as :py:class:`torii.lib.fifo.AsyncFIFO` ("style #2" from Clifford E.
+	Cummings' paper "Simulation and Synthesis Techniques for Asynchronous FIFO Design"), with the difference being
+	that the read pointer passed back to the write domain is the committed read pointer. All the other attributes
+	are those of :py:class:`torii.lib.fifo.FIFOInterface`, with r_level counting the data that has not yet been
+	read (whether committed or not).
+
+	Like :py:class:`torii.lib.fifo.AsyncFIFO`, this FIFO only supports power of 2 depths and can only be reset
+	from the write domain.
+	"""
+
+	def __init__(self, *, width : int, depth : int, r_domain : str = 'read', w_domain : str = 'write'):
+		"""
+		Parameters
+		----------
+		width
+			The width of each entry in the FIFO.
+		depth
+			The number of entries the FIFO holds, which must be a power of 2.
+		r_domain
+			The clock domain for the read side of the FIFO.
+		w_domain
+			The clock domain for the write side of the FIFO.
+		"""
+		assert depth > 0 and depth & (depth - 1) == 0, f'RewindFIFO depth must be a power of 2, got {depth}'
+		super().__init__(width = width, depth = depth)
+
+		self._r_domain = r_domain
+		self._w_domain = w_domain
+		self._ctrBits = depth.bit_length()
+
+		self.r_commit = Signal(reset = 1)
+		self.r_rewind = Signal()
+
+	def elaborate(self, platform) -> Module:
+		""" Describes the gateware for the FIFO.
+
+		Parameters
+		----------
+		platform
+			The Amaranth platform for which the gateware will be synthesised.
+
+		Returns
+		-------
+		:py:class:`torii.hdl.dsl.Module`
+			A complete description of the gateware behaviour required.
+		"""
+		m = Module()
+
+		doWrite = self.w_rdy & self.w_en
+		doRead = self.r_rdy & self.r_en
+
+		produceWBin = Signal(self._ctrBits)
+		produceWNext = Signal(self._ctrBits)
+		produceWGray = Signal(self._ctrBits)
+		produceRGray = Signal(self._ctrBits)
+		produceRBin = Signal(self._ctrBits)
+
+		# The read counters must be reset_less as they are reset through the write domain's reset
+		consumeRBin = Signal(self._ctrBits, reset_less = True)
+		consumeRNext = Signal(self._ctrBits)
+		commitRBin = Signal(self._ctrBits, reset_less = True)
+		commitRNext = Signal(self._ctrBits)
+		commitRGray = Signal(self._ctrBits, reset_less = True)
+		commitWGray = Signal(self._ctrBits)
+		commitWBin = Signal(self._ctrBits)
+
+		m.submodules.produceEncoder = produceEncoder = GrayEncoder(self._ctrBits)
+		m.submodules.produceDecoder = produceDecoder = GrayDecoder(self._ctrBits)
+		m.submodules.produceCDC = FFSynchronizer(produceWGray, produceRGray, o_domain = self._r_domain)
+		m.submodules.commitEncoder = commitEncoder = GrayEncoder(self._ctrBits)
+		m.submodules.commitDecoder = commitDecoder = GrayDecoder(self._ctrBits)
+		m.submodules.commitCDC = FFSynchronizer(commitRGray, commitWGray, o_domain = self._w_domain)
+
+		m.d.comb += [
+			produceWNext.eq(produceWBin + doWrite),
+			produceEncoder.i.eq(produceWNext),
+			produceDecoder.i.eq(produceRGray),
+			produceRBin.eq(produceDecoder.o),
+			# Rewinding takes the read pointer back to the last commit, otherwise reads advance it
+			consumeRNext.eq(Mux(self.r_rewind, commitRBin, consumeRBin + doRead)),
+			commitRNext.eq(Mux(self.r_commit & ~self.r_rewind, consumeRBin + doRead, commitRBin)),
+			commitEncoder.i.eq(commitRNext),
+			commitDecoder.i.eq(commitWGray),
+		]
+		m.d[self._w_domain] += [
+			produceWBin.eq(produceWNext),
+			produceWGray.eq(produceEncoder.o),
+			commitWBin.eq(commitDecoder.o),
+		]
+		m.d[self._r_domain] += [
+			consumeRBin.eq(consumeRNext),
+			commitRBin.eq(commitRNext),
+			commitRGray.eq(commitEncoder.o),
+		]
+
+		wFull = Signal()
+		rEmpty = Signal()
+		m.d.comb += [
+			wFull.eq(
+				(produceWGray[-1] != commitWGray[-1]) &
+				(produceWGray[-2] != commitWGray[-2]) &
+				(produceWGray[:-2] == commitWGray[:-2])
+			),
+			rEmpty.eq(consumeRBin == produceRBin),
+			self.r_level.eq(produceRBin - consumeRBin),
+		]
+		m.d[self._w_domain] += self.w_level.eq(produceWBin - commitWBin)
+
+		m.submodules.storage = storage = Memory(width = self.width, depth = self.depth)
+		writePort = storage.write_port(domain = self._w_domain)
+		readPort = storage.read_port(domain = self._r_domain, transparent = False)
+		m.d.comb += [
+			writePort.addr.eq(produceWBin[:-1]),
+			writePort.data.eq(self.w_data),
+			writePort.en.eq(doWrite),
+			self.w_rdy.eq(~wFull),
+			readPort.addr.eq(consumeRNext[:-1]),
+			readPort.en.eq(1),
+			self.r_data.eq(readPort.data),
+			self.r_rdy.eq(~rEmpty),
+		]
+
+		# As with AsyncFIFO, a write domain reset empties the FIFO by forcing the read side's pointers
+		# to match the write pointer once the reset has been synchronised into the read domain
+		writeReset = ResetSignal(domain = self._w_domain, allow_reset_less = True)
+		readReset = Signal()
+		m.submodules.resetCDC = AsyncFFSynchronizer(writeReset, readReset, o_domain = self._r_domain)
+		with m.If(readReset):
+			m.d.comb += rEmpty.eq(1)
+			m.d[self._r_domain] += [
+				consumeRBin.eq(produceRBin),
+				commitRBin.eq(produceRBin),
+				commitRGray.eq(produceRGray),
+			]
+
+		return m
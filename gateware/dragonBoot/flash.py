@@ -1,13 +1,22 @@
 # SPDX-License-Identifier: BSD-3-Clause
-from torii.hdl import Elaboratable, Module, Signal
+from torii.hdl import Elaboratable, Module, Signal, Value, Const, Cat, Mux, Memory
+from torii.hdl.rec import Record
 from torii.lib.fifo import AsyncFIFO
 from enum import IntEnum, auto, unique
+from math import ceil
+from typing import Dict, List, Optional, Sequence, Tuple
 
-from .spi import SPIBus
+from .platform import QuadEnable
+from .fifo import RewindFIFO
+from .crc import CRC32
+from .spi import SPIBus, SPIBusWidth, SBSPIBus
 
 __all__ = (
 	'SPIFlash',
 	'SPIFlashOp',
+	'SPIFlashData',
+	'SPIFlashStep',
+	'SPIFlashTransactor',
 )
 
 @unique
@@ -19,14 +28,52 @@ class SPIFlashOp(IntEnum):
 	""" A sector erase is in progress. """
 	write = auto()
 	""" A Flash page write sequence is in progress. """
+	verify = auto()
+	""" The data just written is being read back to verify it. """
+
+@unique
+class SPIFlashData(IntEnum):
+	""" An enumeration of the data phases a step of a Flash command program can have. """
+	none = 0
+	""" The step has no data phase. """
+	write = 1
+	""" The contents of the FIFO are written to the Flash. """
+	read = 2
+	""" Data is read from the Flash, being presented a byte at a time by the bus' received and r_data. """
+	compare = 3
+	""" Data is read from the Flash and compared against the contents of the FIFO. """
+	capture = 4
+	""" Data is read from the Flash and pushed into the read FIFO. """
+	poll = 5
+	""" The status register is read until its busy (WIP) bit reads clear. """
+	blankCheck = 6
+	""" No transaction is run - instead the FIFO's data is checked for being all 0xFF (blank). If it is, the data is
+	consumed and the rest of the program skipped, as programming it would leave the Flash unchanged. Otherwise the
+	FIFO is rewound and the program carries on. """
 
 @unique
 class SPIFlashCmd(IntEnum):
 	""" An enumeration of the command opcodes for the Flash. """
+	writeStatus = 0x01
 	pageProgram = 0x02
 	readStatus = 0x05
 	writeEnable = 0x06
+	writeStatus2 = 0x31
+	quadPageProgram = 0x32
+	readStatus2 = 0x35
+	readSFDP = 0x5A
+	readJEDECID = 0x9F
+	dualOutputRead = 0x3B
+	quadOutputRead = 0x6B
+	fastRead = 0x0B
 	releasePowerDown = 0xAB
+	enter4ByteMode = 0xB7
+	exit4ByteMode = 0xE9
+	pageProgram4Byte = 0x12
+	quadPageProgram4Byte = 0x34
+	fastRead4Byte = 0x0C
+	dualOutputRead4Byte = 0x3C
+	quadOutputRead4Byte = 0x6C
 
 class SPIFlash(Elaboratable):
 	""" SPI Flash controller gateware.
@@ -35,6 +82,8 @@ class SPIFlash(Elaboratable):
 	----------
 	ready : Signal(), output
 		Initialisation completion strobe indicating the controller is ready to operate.
+	jedecID : Signal(24), output
+		The JEDEC ID read from the Flash during initialisation, or 0 if the Flash was not identified.
 	start : Signal(), input
 		Strobe to instruct the controller to start operations (this is further explained below).
 	done : Signal(), output
@@ -44,25 +93,83 @@ class SPIFlash(Elaboratable):
 	resetAddrs : Signal(), input
 		Strobe used to request the controller reset its internal Flash addressing to the
 		current values on the beginAddr adn endAddr signals.
+	seek : Signal(), input
+		Strobe used to request the controller move its write address to seekAddr, acted upon only when idle.
 
-	beginAddr : Signal(24), input
+	beginAddr : Signal(addressWidth), input
 		The Flash address for the start of an operation. Usually set to the beginning
 		of a slot when the alt-mode for that slot is selected by the host.
-	endAddr : Signal(24), input
+	endAddr : Signal(addressWidth), input
 		The Flash address for the end of an operation. Usually set to the end of a
 		slot when the alt-mode for that slot is selected by the host.
+	seekAddr : Signal(addressWidth), input
+		The Flash address a seek moves the write address to, which must be aligned to a sector.
+	seekEnd : Signal(addressWidth), input
+		The Flash address the data to be written after a seek ends at, which erases are kept from running past.
 	byteCount : Signal(24), input
 		A count of the number of bytes loaded (or being loaded) into the FIFO for the requested
 		write operation.
 
-	readAddr : Signal(24)
-		The internal current read address for the Flash.
-	eraseAddr : Signal(24)
+	eraseStart : Signal(), input
+		Strobe to instruct the controller to erase all of the Flash from eraseAddr up to endAddr, acted upon only
+		when idle and completing through done and finish as operations requested by start do.
+
+	readStart : Signal(), input
+		Strobe to instruct the controller to read readCount bytes from readAddr into the read FIFO, acted upon only
+		when idle.
+	readCount : Signal(24), input
+		The number of bytes to read for the requested read operation.
+
+	readAddr : Signal(addressWidth)
+		The internal current read address for the Flash, which advances as data is read.
+	eraseAddr : Signal(addressWidth)
 		The internal current erase address for the Flash.
-	writeAddr : Signal(24)
+	writeAddr : Signal(addressWidth)
 		The internal current write address for the Flash.
+
+	verifyFailed : Signal(), output
+		When verifying, whether the data read back after the last operation did not match, valid while done is set.
+	outOfRange : Signal(), output
+		Whether the last operation was refused for running past endAddr, valid while done is set.
+
+	busyEstimate : Signal(16), output
+		An estimate of the time, in milliseconds, until the operation in progress completes - or 0 if idle.
+
+	sectorsUnchanged : Signal(16), output
+		When programming differentially, the number of sectors left alone since the addressing was last reset.
+	sectorsBlank : Signal(16), output
+		When programming differentially, the number of sectors programmed without an erase since the last reset.
+	pagesSkipped : Signal(16), output
+		When skipping blank pages, the number of pages not programmed since the addressing was last reset.
+
+	erasing : Signal(), output
+		Whether the controller is erasing the Flash.
+	programming : Signal(), output
+		Whether the controller is programming pages of the Flash.
+	starved : Signal(), output
+		Whether programming is held up waiting for the FIFO to hold the data for the next page.
 	"""
-	def __init__(self, *, resource, fifo : AsyncFIFO):
+	fourByteCommands = {
+		SPIFlashCmd.pageProgram: SPIFlashCmd.pageProgram4Byte,
+		SPIFlashCmd.quadPageProgram: SPIFlashCmd.quadPageProgram4Byte,
+		SPIFlashCmd.fastRead: SPIFlashCmd.fastRead4Byte,
+		SPIFlashCmd.dualOutputRead: SPIFlashCmd.dualOutputRead4Byte,
+		SPIFlashCmd.quadOutputRead: SPIFlashCmd.quadOutputRead4Byte,
+	}
+	""" The 4-byte address forms of the program and read commands, by their 3-byte address forms. """
+	fourByteEraseCommands = {0x20: 0x21, 0x52: 0x5C, 0xD8: 0xDC}
+	""" The 4-byte address forms of the sector and block erase commands, by their 3-byte address forms. """
+	sfdpTableLength = 64
+	""" How many bytes of the SFDP Basic Flash Parameter Table to read, covering the 16 DWORDs defined since JESD216A. """
+	blockEraseSizes = (32 * 1024, 64 * 1024)
+	""" The block erase sizes the controller can pick up support for from the Flash's SFDP parameters. """
+
+	def __init__(
+		self, *, resource, fifo : AsyncFIFO, fullRate : Optional[bool] = None, lanes : int = 1,
+		differential : Optional[bool] = None, verify : Optional[bool] = None, readFIFO : Optional[AsyncFIFO] = None,
+		maxReadLength : int = 0, clockFreq : Optional[float] = None, addressWidth : int = 24,
+		skipBlank : Optional[bool] = None, discovery : Optional[bool] = None
+	):
 		"""
 		Parameters
 		----------
@@ -70,6 +177,42 @@ class SPIFlash(Elaboratable):
 			The fully qualified identifier for the platform resource defining the SPI bus to use.
 		fifo
 			A FIFO buffer used as the data input to Flash write operations.
+		fullRate
+			Whether to run the SPI bus SCK at the full rate of the controller's clock domain.
+			If not given, this is taken from the platform's :code:`flashFullRate` attribute if it has one.
+			This has no effect if the platform's :code:`flashHardSPI` attribute selects an SB_SPI hard
+			block to run the bus with instead, in which case a :py:class:`dragonBoot.spi.SBSPIBus` is used.
+		lanes
+			The number of data lanes the SPI bus resource provides. When this is 4, the controller
+			sets the Flash's Quad Enable bit as part of its initialisation and then programs pages using
+			the Quad Page Program command.
+		differential
+			Whether to compare each sector's worth of data with what the Flash already holds before erasing and
+			programming it. If not given, this is taken from the platform's :code:`flashDifferential` attribute
+			if it has one. This requires the FIFO to be a :py:class:`dragonBoot.fifo.RewindFIFO`.
+		verify
+			Whether to read back the data written by each operation to check it landed correctly. If not given,
+			this is taken from the platform's :code:`flashVerify` attribute if it has one. This is not supported
+			with the SB_SPI hard block.
+		readFIFO
+			Optionally, a FIFO buffer which read operations stream the data read from the Flash into. Read
+			operations are only supported when this is given, and are not supported with the SB_SPI hard block.
+		maxReadLength
+			The largest number of bytes a single read operation may be asked to read.
+		clockFreq
+			The frequency of the controller's clock domain, which is used to time the Flash's reset and operations.
+			If not given, this is taken to be the frequency of the platform's default clock.
+		addressWidth
+			The width of the controller's Flash addresses, which must be at least that of the platform's Flash
+			(:py:attr:`dragonBoot.platform.Flash.addressWidth`).
+		skipBlank
+			Whether to skip programming pages whose data is all 0xFF, as programming them would leave the freshly
+			erased Flash unchanged. If not given, this is taken from the platform's :code:`flashSkipBlank` attribute
+			if it has one. This requires the FIFO to be a :py:class:`dragonBoot.fifo.RewindFIFO`.
+		discovery
+			Whether to read the Flash's JEDEC ID and SFDP parameters during initialisation. If not given, this is
+			taken from the platform's :code:`flashDiscovery` attribute if it has one. This is not supported with the
+			SB_SPI hard block.
 
 		Notes
 		-----
@@ -78,24 +221,70 @@ class SPIFlash(Elaboratable):
 		On the completion of the required erase operations it then enters into write mode where Flash
 		page by Flash page the data from the FIFO is read out and written for up to byteCount bytes.
 
-		This system is designed with byteCount being equal to a multiple of platform.flash.erasePageSize
-		right up until the final cycle prior to either a warmboot of the Flash addressing being reset.
+		Each erase uses the largest of the Flash's erase sizes that is aligned and fits within the slot (and before
+		seekEnd after a seek), and the erase address is kept as a high-water mark so erased Flash is not erased again.
+
+		Flash larger than 16MiB is addressed with 4-byte addresses, by the 4-byte forms of the commands unless the
+		Flash description asks for 4-byte address mode, and is always left in 3-byte address mode between operations.
+
+		When discovery is enabled, the erase types, page size and Quad Enable requirements of the Flash's SFDP Basic
+		Flash Parameter Table are used in place of the platform's, within what the FIFO and slot layout allow.
+
+		When programming differentially, a sector that already holds its data is left alone, and one that is already
+		blank is programmed without being erased. When skipping blank pages, pages of all 0xFF are not programmed.
+
+		When verifying, the range written is read back once the operation's last page is programmed, and the CRC-32s
+		of the data written and read back are compared.
+
+		The busyEstimate is measured from the operations that cover a whole sector, and calculated from the Flash's
+		typical erase and program times until then.
+
+		Read operations stream the data read into the read FIFO as a single Fast Read command, and complete once
+		readCount bytes have been put into it - there is no completion handshake for them.
 		"""
 		self._flashResource = resource
 		self._fifo = fifo
+		self._fullRate = fullRate
+		self._lanes = lanes
+		self._differential = differential
+		self._verify = verify
+		self._readFIFO = readFIFO
+		self._maxReadLength = maxReadLength
+		self._clockFreq = clockFreq
+		self._skipBlank = skipBlank
+		self._discovery = discovery
 
 		self.ready = Signal()
+		self.jedecID = Signal(24)
 		self.start = Signal()
 		self.done = Signal()
 		self.finish = Signal()
 		self.resetAddrs = Signal()
-		self.beginAddr = Signal(24)
-		self.endAddr = Signal(24)
+		self.seek = Signal()
+		self.beginAddr = Signal(addressWidth)
+		self.endAddr = Signal(addressWidth)
+		self.seekAddr = Signal(addressWidth)
+		self.seekEnd = Signal(addressWidth)
 		self.byteCount = Signal(24)
+		self.eraseStart = Signal()
+		self.readStart = Signal()
+		self.readCount = Signal(24)
 
-		self.readAddr = Signal(24)
-		self.eraseAddr = Signal(24)
-		self.writeAddr = Signal(24)
+		self.readAddr = Signal(addressWidth)
+		self.eraseAddr = Signal(addressWidth)
+		self.writeAddr = Signal(addressWidth)
+
+		self.verifyFailed = Signal()
+		self.outOfRange = Signal()
+		self.busyEstimate = Signal(16)
+
+		self.sectorsUnchanged = Signal(16)
+		self.sectorsBlank = Signal(16)
+		self.pagesSkipped = Signal(16)
+
+		self.erasing = Signal()
+		self.programming = Signal()
+		self.starved = Signal()
 
 	def elaborate(self, platform) -> Module:
 		""" Describes the specific gateware needed to talk to and erase + rewrite the data in a SPI Flash device.
@@ -111,288 +300,1099 @@ class SPIFlash(Elaboratable):
 			A complete description of the gateware behaviour required.
 		"""
 		m = Module()
-		m.submodules.spi = flash = SPIBus(resource = self._flashResource)
+		fullRate = self._fullRate
+		if fullRate is None:
+			fullRate = getattr(platform, 'flashFullRate', False)
+		differential = self._differential
+		if differential is None:
+			differential = getattr(platform, 'flashDifferential', False)
+		verify = self._verify
+		if verify is None:
+			verify = getattr(platform, 'flashVerify', False)
+		hardSPI = getattr(platform, 'flashHardSPI', None)
+		if hardSPI is not None:
+			if self._lanes != 1:
+				raise ValueError('The SB_SPI hard block only supports single lane SPI Flash buses')
+			if differential:
+				raise ValueError('Differential programming is not supported with the SB_SPI hard block')
+			if self._readFIFO is not None:
+				raise ValueError('Streaming reads are not supported with the SB_SPI hard block')
+			if verify:
+				raise ValueError('Verification is not supported with the SB_SPI hard block')
+			flash = SBSPIBus(
+				resource = self._flashResource, block = hardSPI, divider = getattr(platform, 'flashHardSPIDivider', 1)
+			)
+		else:
+			flash = SPIBus(resource = self._flashResource, fullRate = fullRate, lanes = self._lanes)
+		m.submodules.spi = flash
+		# The SB_SPI block only presents the last byte read in a burst, so can't continuously poll the status
+		# register, nor read the Flash's identification and parameters
+		statusPoll = hardSPI is None
+		discovery = self._discovery
+		if discovery is None:
+			discovery = getattr(platform, 'flashDiscovery', False)
+		if discovery and hardSPI is not None:
+			raise ValueError('Discovering the Flash\'s parameters is not supported with the SB_SPI hard block')
 		fifo = self._fifo
+		if differential and not hasattr(fifo, 'r_rewind'):
+			raise ValueError('Differential programming requires a FIFO that supports rewinding, such as RewindFIFO')
+		skipBlank = self._skipBlank
+		if skipBlank is None:
+			skipBlank = getattr(platform, 'flashSkipBlank', False)
+		if skipBlank and not hasattr(fifo, 'r_rewind'):
+			raise ValueError('Skipping blank pages requires a FIFO that supports rewinding, such as RewindFIFO')
+		# The CRC of what was programmed is taken as the data goes out to the Flash, so must include blank pages
+		skipBlank = skipBlank and not verify
+
+		addressWidth = platform.flash.addressWidth
+		if addressWidth > len(self.writeAddr):
+			raise ValueError(f'The platform Flash needs {addressWidth} bit addresses, but the controller has {len(self.writeAddr)}')
+		addressLength = addressWidth // 8
+		fourByteOpcodes = addressWidth == 32 and platform.flash.fourByteOpcodes
+		fourByteMode = addressWidth == 32 and not platform.flash.fourByteOpcodes
+
+		quad = self._lanes == 4
+		# The Quad Enable method may be discovered at runtime, so is only fixed for buses that aren't quad
+		quadEnable = Signal(QuadEnable, reset = platform.flash.quadEnable if quad else QuadEnable.none)
+		quadEnableStates = quad and (discovery or platform.flash.quadEnable != QuadEnable.none)
+		pageProgram = SPIFlashCmd.quadPageProgram if quad else SPIFlashCmd.pageProgram
+		programWidth = SPIBusWidth.quad if quad else SPIBusWidth.single
+		compareCommand = SPIFlashCmd.fastRead
+		if quad:
+			readCommand, readWidth = SPIFlashCmd.quadOutputRead, SPIBusWidth.quad
+		elif self._lanes == 2:
+			readCommand, readWidth = SPIFlashCmd.dualOutputRead, SPIBusWidth.dual
+		else:
+			readCommand, readWidth = SPIFlashCmd.fastRead, SPIBusWidth.single
+		if fourByteOpcodes:
+			pageProgram = self.fourByteCommands[pageProgram]
+			compareCommand = self.fourByteCommands[compareCommand]
+			readCommand = self.fourByteCommands[readCommand]
+		readFIFO = self._readFIFO
+
+		clockFreq = self._clockFreq
+		if clockFreq is None:
+			clockFreq = platform.default_clk_constraint.frequency
+		resetDuration = int(20e-6 // (1 / clockFreq))
+		millisecond = int(1e-3 * clockFreq)
+		pageSize = platform.flash.pageSize
+		sectorSize = platform.flash.erasePageSize
+		# Starting estimates for how long sector operations take, with and without an erase, in milliseconds
+		programEstimate = ceil((platform.flash.programTime or 0) * (sectorSize // pageSize) * 1000)
+		eraseEstimate = ceil((platform.flash.eraseTime or 0) * 1000) + programEstimate
+
+		# The command programs the controller runs, each step of which is one transaction on the bus
+		writeEnable = SPIFlashStep(SPIFlashCmd.writeEnable)
+		waitReady = SPIFlashStep(SPIFlashCmd.readStatus, data = SPIFlashData.poll)
 
-		resetDuration = int(20e-6 // platform.default_clk_constraint.period)
+		def addressed(*steps : SPIFlashStep) -> Tuple[SPIFlashStep, ...]:
+			# Without the 4-byte address commands, the Flash is put in 4-byte address mode just for the operation
+			if fourByteMode:
+				return (SPIFlashStep(SPIFlashCmd.enter4ByteMode), *steps, SPIFlashStep(SPIFlashCmd.exit4ByteMode))
+			return steps
+
+		programs = {
+			'releasePowerDown': (SPIFlashStep(SPIFlashCmd.releasePowerDown), ),
+			# The erase opcode is picked at runtime to suit the erase address
+			'erase': addressed(writeEnable, SPIFlashStep(addressLength = addressLength), waitReady),
+			'pageProgram': addressed(
+				writeEnable,
+				SPIFlashStep(
+					pageProgram, addressLength = addressLength, data = SPIFlashData.write, dataWidth = programWidth
+				),
+				waitReady,
+			),
+		}
+		if skipBlank:
+			programs['pageProgram'] = (SPIFlashStep(data = SPIFlashData.blankCheck), *programs['pageProgram'])
+		# The reads all need a dummy byte after the address
+		if readFIFO is not None:
+			programs['read'] = addressed(SPIFlashStep(
+				readCommand, addressLength = addressLength + 1, data = SPIFlashData.capture, dataWidth = readWidth
+			))
+		if verify:
+			programs['verify'] = addressed(SPIFlashStep(
+				readCommand, addressLength = addressLength + 1, data = SPIFlashData.read, dataWidth = readWidth
+			))
+		if differential:
+			programs['compare'] = addressed(
+				SPIFlashStep(compareCommand, addressLength = addressLength + 1, data = SPIFlashData.compare)
+			)
+		if discovery:
+			programs['readJEDECID'] = (SPIFlashStep(SPIFlashCmd.readJEDECID, data = SPIFlashData.read, dataLength = 3), )
+			programs['readSFDPHeader'] = (
+				SPIFlashStep(SPIFlashCmd.readSFDP, addressLength = 4, data = SPIFlashData.read, dataLength = 16),
+			)
+			programs['readSFDPTable'] = (SPIFlashStep(SPIFlashCmd.readSFDP, addressLength = 4, data = SPIFlashData.read), )
+		if quadEnableStates:
+			programs['readStatus'] = (SPIFlashStep(SPIFlashCmd.readStatus, data = SPIFlashData.read, dataLength = 1), )
+			programs['readStatus2'] = (SPIFlashStep(SPIFlashCmd.readStatus2, data = SPIFlashData.read, dataLength = 1), )
+			# The status register values go out as though they were address bytes following the opcode
+			programs['writeStatus'] = (writeEnable, SPIFlashStep(SPIFlashCmd.writeStatus, addressLength = 1), waitReady)
+			programs['writeStatusBoth'] = (
+				writeEnable, SPIFlashStep(SPIFlashCmd.writeStatus, addressLength = 2), waitReady
+			)
+			programs['writeStatus2'] = (writeEnable, SPIFlashStep(SPIFlashCmd.writeStatus2, addressLength = 1), waitReady)
+
+		m.submodules.transactor = txn = SPIFlashTransactor(
+			bus = flash, fifo = fifo, programs = programs, maxDataLength = max(
+				pageSize, self._maxReadLength, sectorSize if verify else 0, self.sfdpTableLength if discovery else 0
+			), readFIFO = readFIFO, statusPoll = statusPoll
+		)
+		if differential or skipBlank:
+			# Reads are committed as they are made, unless a comparison or the transactor's blank check holds them
+			m.d.comb += [
+				fifo.r_commit.eq(~txn.holdReads),
+				fifo.r_rewind.eq(txn.rewindReads),
+			]
+
+		if verify:
+			m.submodules.writeCRC = writeCRC = CRC32()
+			m.submodules.readCRC = readCRC = CRC32()
+			m.d.comb += [
+				writeCRC.data.eq(fifo.r_data),
+				readCRC.data.eq(flash.r_data),
+			]
 
 		op = Signal(SPIFlashOp, reset = SPIFlashOp.none)
-		resetStep = Signal(range(2))
-		enableStep = Signal(range(3))
-		eraseCmdStep = Signal(range(6))
-		eraseWaitStep = Signal(range(4))
-		writeCmdStep = Signal(range(5))
-		writeFinishStep = Signal(range(2))
-		writeWaitStep = Signal(range(4))
-		writeTrigger = Signal()
+		statusReg1 = Signal(8)
+		statusReg2 = Signal(8)
 		resetTimer = Signal(range(resetDuration), reset = resetDuration - 1)
-		writeCount = Signal(range(platform.flash.pageSize + 1))
 		byteCount = Signal.like(self.byteCount)
+		readCount = Signal.like(self.readCount)
+		compareAddr = Signal.like(self.writeAddr)
+		verifyAddr = Signal.like(self.writeAddr)
+		sectorDiffers = Signal()
+		sectorBlank = Signal()
+		writeLength = Signal(range(pageSize + 1))
+		programLength = Signal(range(pageSize + 1))
+		pageRemaining = Signal(range(pageSize + 1))
+		pageSizeLog2 = Signal(range(pageSize.bit_length()), reset = pageSize.bit_length() - 1)
+		writeEnd = Signal.like(self.endAddr)
+		millisecondTimer = Signal(range(millisecond), reset = millisecond - 1)
+		opTime = Signal.like(self.busyEstimate)
+		opErases = Signal()
+		opMeasured = Signal()
+		eraseOpTime = Signal.like(self.busyEstimate, reset = min(eraseEstimate, 0xFFFF))
+		programOpTime = Signal.like(self.busyEstimate, reset = min(programEstimate, 0xFFFF))
+		expectedOpTime = Signal.like(self.busyEstimate)
+
+		# Block erases would take out neighbouring sectors that a differential comparison may want to leave alone
+		if differential:
+			eraseSizes = (sectorSize, )
+		else:
+			eraseSizes = set(platform.flash.eraseCommands)
+			# Other block erases the Flash may turn out to support when its SFDP parameters are read
+			if discovery:
+				eraseSizes |= {size for size in self.blockEraseSizes if size > sectorSize and size % sectorSize == 0}
+			eraseSizes = sorted(eraseSizes)
+		eraseCommands = platform.flash.eraseCommands
+		if fourByteOpcodes:
+			for size, command in eraseCommands.items():
+				if command not in self.fourByteEraseCommands:
+					raise ValueError(f'Erase command {command:#04x} has no known 4-byte address form')
+			eraseCommands = {size: self.fourByteEraseCommands[command] for size, command in eraseCommands.items()}
+		eraseOpcodes = {
+			size: Signal(8, name = f'eraseOpcode{size}', reset = eraseCommands.get(size, 0))
+			for size in eraseSizes
+		}
+		eraseSupported = {
+			size: Signal(name = f'eraseSupported{size}', reset = size in platform.flash.eraseCommands)
+			for size in eraseSizes
+		}
+		eraseCommand = Signal(8)
+		eraseLength = Signal(range(max(eraseSizes) + 1))
+		eraseEnd = Signal.like(self.eraseAddr)
+		# Erases stop at the end of the slot, or at the end of the data being written since the last seek
+		eraseLimit = Signal.like(self.endAddr)
+		eraseBounded = Signal()
+		eraseBound = Signal.like(self.seekEnd)
+
+		# Whole range erases are estimated in units of the largest erase whose time is known to be usable
+		bulkEraseSize = max(size for size in platform.flash.eraseCommands if size in eraseSizes)
+		bulkEraseTime = platform.flash.eraseTimes[bulkEraseSize]
+		if bulkEraseTime is None:
+			bulkEraseTime = (platform.flash.eraseTime or 0) * bulkEraseSize / sectorSize
+		bulkEraseEstimate = ceil(bulkEraseTime * 1000)
+		bulkEraseRemaining = Signal(len(self.endAddr) + 1)
+		bulkEraseOpTime = Signal(len(bulkEraseRemaining) + bulkEraseEstimate.bit_length())
 
 		m.d.comb += [
 			self.ready.eq(0),
 			self.done.eq(0),
-			flash.xfer.eq(0),
-			flash.w_data.eq(fifo.r_data),
+			programLength.eq(Const(1, len(programLength)) << pageSizeLog2),
+			# Page Programs wrap around within the page, so each must stop at the end of the page it starts in
+			pageRemaining.eq(programLength - (self.writeAddr[:pageSize.bit_length() - 1] & (programLength - 1))),
+			writeLength.eq(Mux(byteCount < pageRemaining, byteCount, pageRemaining)),
+			writeEnd.eq(self.writeAddr + byteCount),
+			eraseEnd.eq(self.eraseAddr + eraseLength),
+			eraseLimit.eq(Mux(eraseBounded, eraseBound, self.endAddr)),
+			expectedOpTime.eq(Mux(opErases, eraseOpTime, programOpTime)),
+			bulkEraseRemaining.eq(self.endAddr - self.eraseAddr + (bulkEraseSize - 1)),
+			bulkEraseOpTime.eq(bulkEraseRemaining[bulkEraseSize.bit_length() - 1:] * bulkEraseEstimate),
+			self.busyEstimate.eq(0),
 		]
 
+		# Time how long the operation in progress has been running for, in milliseconds
+		m.d.sync += millisecondTimer.dec()
+		with m.If(millisecondTimer == 0):
+			m.d.sync += millisecondTimer.eq(millisecondTimer.reset)
+			with m.If((op != SPIFlashOp.none) & (opTime != 0xFFFF)):
+				m.d.sync += opTime.inc()
+		with m.If((op != SPIFlashOp.none) & (expectedOpTime > opTime)):
+			m.d.comb += self.busyEstimate.eq(expectedOpTime - opTime)
+
+		# Pick the largest erase that the erase address is aligned to and that doesn't run past the erase limit
+		for size in eraseSizes:
+			with m.If((size == sectorSize) | (eraseSupported[size] &
+				(self.eraseAddr[:size.bit_length() - 1] == 0) & (self.eraseAddr + size <= eraseLimit)
+			)):
+				m.d.comb += [
+					eraseCommand.eq(eraseOpcodes[size]),
+					eraseLength.eq(size),
+				]
+
 		with m.FSM(name = 'flash'):
 			with m.State('PRE_RESET_WAIT'):
 				m.d.sync += resetTimer.dec()
 				with m.If(resetTimer == 0):
-					m.d.sync += [
-						resetTimer.eq(resetTimer.reset),
-						resetStep.eq(0),
-					]
+					m.d.sync += resetTimer.eq(resetTimer.reset)
 					m.next = 'RESET'
 			with m.State('RESET'):
-				with m.Switch(resetStep):
-					with m.Case(0):
-						m.d.comb += [
-							flash.xfer.eq(1),
-							flash.w_data.eq(SPIFlashCmd.releasePowerDown),
-						]
-						m.d.sync += [
-							flash.cs.eq(1),
-							resetStep.eq(1),
-						]
-					with m.Case(1):
-						with m.If(flash.done):
-							m.d.sync += flash.cs.eq(0)
-							m.next = 'RESET_WAIT'
+				m.d.comb += txn.request('releasePowerDown')
+				with m.If(txn.done):
+					m.next = 'RESET_WAIT'
 			with m.State('RESET_WAIT'):
 				m.d.sync += resetTimer.dec()
 				with m.If(resetTimer == 0):
 					m.d.sync += resetTimer.eq(resetTimer.reset)
+					if discovery:
+						m.next = 'READ_JEDEC_ID'
+					else:
+						m.next = 'CONFIGURE'
+
+			if discovery:
+				self._elaborateDiscovery(
+					m, flash, txn, quad, addressWidth, fourByteOpcodes, quadEnable, eraseOpcodes, eraseSupported,
+					pageSizeLog2
+				)
+			with m.State('CONFIGURE'):
+				if quadEnableStates:
+					with m.Switch(quadEnable):
+						with m.Case(QuadEnable.none):
+							m.d.comb += self.ready.eq(1)
+							m.next = 'IDLE'
+						with m.Case(QuadEnable.sr2Bit1Write31):
+							m.next = 'QE_READ_SR2'
+						with m.Default():
+							m.next = 'QE_READ_SR1'
+				else:
 					m.d.comb += self.ready.eq(1)
 					m.next = 'IDLE'
+
+			if quadEnableStates:
+				self._elaborateQuadEnable(m, flash, txn, quadEnable, statusReg1, statusReg2)
 			with m.State('IDLE'):
-				m.d.sync += [
-					enableStep.eq(0),
-					eraseCmdStep.eq(0),
-					eraseWaitStep.eq(0),
-					writeCmdStep.eq(0),
-					writeFinishStep.eq(0),
-					writeWaitStep.eq(0),
-				]
 				with m.If(self.resetAddrs):
 					m.d.sync += [
 						self.readAddr.eq(self.beginAddr),
 						self.eraseAddr.eq(self.beginAddr),
 						self.writeAddr.eq(self.beginAddr),
+						self.sectorsUnchanged.eq(0),
+						self.sectorsBlank.eq(0),
+						self.pagesSkipped.eq(0),
+						eraseBounded.eq(0),
+					]
+				with m.If(self.seek):
+					m.d.sync += [
+						self.writeAddr.eq(self.seekAddr),
+						eraseBounded.eq(1),
+						eraseBound.eq(self.seekEnd),
 					]
+					# Only Flash between the write and erase addresses is known to be erased and not yet programmed
+					with m.If((self.seekAddr < self.writeAddr) | (self.seekAddr > self.eraseAddr)):
+						m.d.sync += self.eraseAddr.eq(self.seekAddr)
 				with m.If(self.start):
 					m.d.sync += [
-						op.eq(SPIFlashOp.erase),
 						byteCount.eq(self.byteCount),
+						verifyAddr.eq(self.writeAddr),
+						self.verifyFailed.eq(0),
+						self.outOfRange.eq(0),
+						opTime.eq(0),
+						opErases.eq(self.eraseAddr < self.writeAddr + self.byteCount),
+						opMeasured.eq(self.byteCount == sectorSize),
 					]
-					m.next = 'WRITE_ENABLE'
-			with m.State('WRITE_ENABLE'):
-				with m.Switch(enableStep):
-					with m.Case(0):
+					if verify:
 						m.d.comb += [
-							flash.xfer.eq(1),
-							flash.w_data.eq(SPIFlashCmd.writeEnable),
+							writeCRC.reset.eq(1),
+							readCRC.reset.eq(1),
 						]
-						m.d.sync += [
-							flash.cs.eq(1),
-							enableStep.eq(1),
-						]
-					with m.Case(1):
-						with m.If(flash.done):
-							m.d.sync += [
-								flash.cs.eq(0),
-								enableStep.eq(2),
-							]
-					with m.Case(2):
-						m.d.sync += enableStep.eq(0)
-						with m.If(op == SPIFlashOp.erase):
-							m.next = 'ERASE_CMD'
-						with m.Else():
-							m.next = 'WRITE_CMD'
-			with m.State('ERASE_CMD'):
-				with m.Switch(eraseCmdStep):
-					with m.Case(0):
-						m.d.comb += [
-							flash.xfer.eq(1),
-							flash.w_data.eq(platform.flash.eraseCommand),
-						]
-						m.d.sync += [
-							flash.cs.eq(1),
-							eraseCmdStep.eq(1),
-						]
-					with m.Case(1):
-						with m.If(flash.done):
-							m.d.comb += [
-								flash.xfer.eq(1),
-								flash.w_data.eq(self.eraseAddr[16:24]),
-							]
-							m.d.sync += eraseCmdStep.eq(2)
-					with m.Case(2):
-						with m.If(flash.done):
-							m.d.comb += [
-								flash.xfer.eq(1),
-								flash.w_data.eq(self.eraseAddr[8:16]),
-							]
-							m.d.sync += eraseCmdStep.eq(3)
-					with m.Case(3):
-						with m.If(flash.done):
-							m.d.comb += [
-								flash.xfer.eq(1),
-								flash.w_data.eq(self.eraseAddr[0:8]),
-							]
-							m.d.sync += eraseCmdStep.eq(4)
-					with m.Case(4):
-						with m.If(flash.done):
-							m.d.sync += [
-								flash.cs.eq(0),
-								eraseCmdStep.eq(5),
-							]
-					with m.Case(5):
-						m.d.sync += [
-							self.eraseAddr.eq(self.eraseAddr + platform.flash.erasePageSize),
-							eraseCmdStep.eq(0),
-						]
-						m.next = 'ERASE_WAIT'
-			with m.State('ERASE_WAIT'):
-				with m.Switch(eraseWaitStep):
-					with m.Case(0):
-						m.d.comb += [
-							flash.xfer.eq(1),
-							flash.w_data.eq(SPIFlashCmd.readStatus),
-						]
-						m.d.sync += [
-							flash.cs.eq(1),
-							eraseWaitStep.eq(1),
-						]
-					with m.Case(1):
-						with m.If(flash.done):
-							m.d.comb += [
-								flash.xfer.eq(1),
-								flash.w_data.eq(0),
-							]
-							m.d.sync += eraseWaitStep.eq(2)
-					with m.Case(2):
-						with m.If(flash.done):
+					# Only erase if the data won't entirely land in Flash we've already erased
+					with m.If(self.eraseAddr < self.writeAddr + self.byteCount):
+						m.d.sync += op.eq(SPIFlashOp.erase)
+						m.next = 'ERASE'
+					with m.Else():
+						m.d.sync += op.eq(SPIFlashOp.write)
+						m.next = 'WRITE'
+					if differential:
+						with m.If((self.writeAddr[:sectorSize.bit_length() - 1] == 0) & (self.byteCount == sectorSize)):
 							m.d.sync += [
-								flash.cs.eq(0),
-								eraseWaitStep.eq(3),
+								compareAddr.eq(self.writeAddr),
+								sectorDiffers.eq(0),
+								sectorBlank.eq(1),
 							]
-					with m.Case(3):
-						m.d.sync += eraseWaitStep.eq(0)
-						with m.If(~flash.r_data[0]):
-							with m.If((self.writeAddr + byteCount) <= self.endAddr):
-								m.d.sync += op.eq(SPIFlashOp.write)
-							m.next = 'WRITE_ENABLE'
-			with m.State('WRITE_CMD'):
-				with m.Switch(writeCmdStep):
-					with m.Case(0):
-						m.d.comb += [
-							flash.xfer.eq(1),
-							flash.w_data.eq(SPIFlashCmd.pageProgram),
-						]
+							m.next = 'COMPARE'
+					# Nothing past the end of the slot may be touched, so an operation that would run over it is refused
+					with m.If(self.writeAddr + self.byteCount > self.endAddr):
 						m.d.sync += [
-							flash.cs.eq(1),
-							writeCmdStep.eq(1),
+							self.outOfRange.eq(1),
+							op.eq(SPIFlashOp.none),
 						]
-					with m.Case(1):
-						with m.If(flash.done):
-							m.d.comb += [
-								flash.xfer.eq(1),
-								flash.w_data.eq(self.writeAddr[16:24]),
-							]
-							m.d.sync += writeCmdStep.eq(2)
+						m.next = 'FINISH'
+				with m.If(self.eraseStart):
+					m.d.sync += [
+						self.verifyFailed.eq(0),
+						self.outOfRange.eq(0),
+					]
+					with m.If(self.eraseAddr < self.endAddr):
+						m.d.sync += op.eq(SPIFlashOp.erase)
+						m.next = 'BULK_ERASE'
+					with m.Else():
+						m.next = 'FINISH'
+				if readFIFO is not None:
+					with m.If(self.readStart):
+						m.d.sync += readCount.eq(self.readCount)
+						m.next = 'READ'
+			if readFIFO is not None:
+				with m.State('READ'):
+					m.d.comb += txn.request('read', address = self.readAddr[:addressWidth], dataLength = readCount)
+					with m.If(txn.done):
+						m.d.sync += self.readAddr.eq(self.readAddr + readCount)
+						m.next = 'IDLE'
+			if differential:
+				self._elaborateCompare(
+					m, txn, fifo, pageSize, sectorSize, addressWidth, op, byteCount, compareAddr, sectorDiffers,
+					sectorBlank
+				)
+			with m.State('ERASE'):
+				m.d.comb += [
+					txn.request('erase', command = eraseCommand, address = self.eraseAddr[:addressWidth]),
+					self.erasing.eq(1),
+				]
+				with m.If(txn.done):
+					m.d.sync += self.eraseAddr.eq(eraseEnd)
+					with m.If(eraseEnd >= writeEnd):
+						m.d.sync += op.eq(SPIFlashOp.write)
+						m.next = 'WRITE'
+			with m.State('BULK_ERASE'):
+				m.d.comb += [
+					txn.request('erase', command = eraseCommand, address = self.eraseAddr[:addressWidth]),
+					self.busyEstimate.eq(Mux(bulkEraseOpTime > 0xFFFF, 0xFFFF, bulkEraseOpTime)),
+					self.erasing.eq(1),
+				]
+				with m.If(txn.done):
+					m.d.sync += self.eraseAddr.eq(eraseEnd)
+					with m.If(eraseEnd >= self.endAddr):
+						m.d.sync += op.eq(SPIFlashOp.none)
+						m.next = 'FINISH'
+			with m.State('WRITE'):
+				if verify:
+					# Fold each byte into the CRC as it is taken from the FIFO to be programmed
+					m.d.comb += writeCRC.valid.eq(fifo.r_en & fifo.r_rdy)
+				m.d.comb += [
+					txn.request('pageProgram', address = self.writeAddr[:addressWidth], dataLength = writeLength),
+					self.programming.eq(1),
+					self.starved.eq(txn.waiting),
+				]
+				with m.If(txn.done):
+					m.d.sync += [
+						self.writeAddr.eq(self.writeAddr + writeLength),
+						byteCount.eq(byteCount - writeLength),
+					]
+					if skipBlank:
+						with m.If(txn.skipped):
+							m.d.sync += self.pagesSkipped.inc()
+					with m.If(byteCount == writeLength):
+						# Only whole sector operations are representative of how long the next will take
+						with m.If(opMeasured):
+							with m.If(opErases):
+								m.d.sync += eraseOpTime.eq(opTime)
+							with m.Else():
+								m.d.sync += programOpTime.eq(opTime)
+						if verify:
+							m.d.sync += op.eq(SPIFlashOp.verify)
+							m.next = 'VERIFY'
+						else:
+							m.d.sync += op.eq(SPIFlashOp.none)
+							m.next = 'FINISH'
+			if verify:
+				with m.State('VERIFY'):
+					m.d.comb += [
+						txn.request('verify', address = verifyAddr[:addressWidth], dataLength = self.writeAddr - verifyAddr),
+						readCRC.valid.eq(flash.received),
+					]
+					with m.If(txn.done):
+						m.next = 'VERIFY_CHECK'
+				with m.State('VERIFY_CHECK'):
+					m.d.sync += [
+						self.verifyFailed.eq(readCRC.value != writeCRC.value),
+						op.eq(SPIFlashOp.none),
+					]
+					m.next = 'FINISH'
+			with m.State('FINISH'):
+				m.d.comb += self.done.eq(1)
+				with m.If(self.finish):
+					m.next = 'IDLE'
+
+		return m
+
+	def _elaborateCompare(self, m : Module, txn : 'SPIFlashTransactor', fifo : RewindFIFO, pageSize : int,
+		sectorSize : int, addressWidth : int, op : Signal, byteCount : Signal, compareAddr : Signal, sectorDiffers : Signal,
+		sectorBlank : Signal
+	):
+		""" Describes the states needed to compare a sector against the data in the FIFO and decide what to do with it.
+
+		The FIFO's reads are held uncommitted for the duration of the comparison, and the comparison stops early once
+		the sector is known to need both erasing and programming.
+		"""
+		compareEnd = Signal.like(compareAddr)
+		m.d.comb += compareEnd.eq(compareAddr + pageSize)
+
+		with m.State('COMPARE'):
+			m.d.comb += fifo.r_commit.eq(0)
+			m.d.comb += txn.request('compare', address = compareAddr[:addressWidth], dataLength = pageSize)
+			with m.If(txn.done):
+				m.d.sync += [
+					compareAddr.eq(compareEnd),
+					sectorDiffers.eq(sectorDiffers | txn.differs),
+					sectorBlank.eq(sectorBlank & txn.blank),
+				]
+				# Stop at the end of the sector, or once it's known to need erasing and programming regardless
+				with m.If((compareEnd[:sectorSize.bit_length() - 1] == 0) |
+					((sectorDiffers | txn.differs) & ~(sectorBlank & txn.blank))
+				):
+					m.next = 'COMPARE_CHECK'
+		with m.State('COMPARE_CHECK'):
+			with m.If(~sectorDiffers):
+				# The sector already holds the data, so consume it and move on
+				m.d.sync += [
+					self.writeAddr.eq(self.writeAddr + sectorSize),
+					byteCount.eq(0),
+					op.eq(SPIFlashOp.none),
+					self.sectorsUnchanged.eq(self.sectorsUnchanged + 1),
+				]
+				with m.If(self.eraseAddr < self.writeAddr + sectorSize):
+					m.d.sync += self.eraseAddr.eq(self.writeAddr + sectorSize)
+				m.next = 'FINISH'
+			with m.Else():
+				m.d.comb += [
+					fifo.r_commit.eq(0),
+					fifo.r_rewind.eq(1),
+				]
+				with m.If(sectorBlank):
+					m.d.sync += [
+						op.eq(SPIFlashOp.write),
+						self.sectorsBlank.eq(self.sectorsBlank + 1),
+					]
+					with m.If(self.eraseAddr < self.writeAddr + sectorSize):
+						m.d.sync += self.eraseAddr.eq(self.writeAddr + sectorSize)
+					m.next = 'WRITE'
+				with m.Elif(op == SPIFlashOp.erase):
+					m.next = 'ERASE'
+				with m.Else():
+					m.next = 'WRITE'
+
+	def _elaborateDiscovery(self, m : Module, flash : SPIBus, txn : 'SPIFlashTransactor', quad : bool,
+		addressWidth : int, fourByteOpcodes : bool, quadEnable : Signal, eraseOpcodes : Dict[int, Signal],
+		eraseSupported : Dict[int, Signal], pageSizeLog2 : Signal
+	):
+		""" Describes the states needed to identify the Flash and read its SFDP basic parameters.
+
+		These are run after the Flash has been released from power-down, and end by going to CONFIGURE. The SFDP
+		header and first parameter header are read in one go, and if they describe a Basic Flash Parameter Table, its
+		first 16 DWORDs are then read. The parameters are picked out as they are received rather than being stored.
+		Should the table say the Flash can't take addresses of the width we use, this instead ends in UNUSABLE.
+		"""
+		sfdpIndex = Signal(range(self.sfdpTableLength + 1))
+		sfdpValid = Signal()
+		tableAddr = Signal(24)
+		tableLength = Signal(range(self.sfdpTableLength + 1))
+		eraseTypeSize = Signal(8)
+		addressMismatch = Signal()
+
+		with m.State('READ_JEDEC_ID'):
+			m.d.comb += txn.request('readJEDECID')
+			# The manufacturer ID comes first, so ends up in the top byte
+			with m.If(flash.received):
+				m.d.sync += self.jedecID.eq(Cat(flash.r_data, self.jedecID[0:16]))
+			with m.If(txn.done):
+				m.d.sync += [
+					sfdpIndex.eq(0),
+					sfdpValid.eq(1),
+				]
+				m.next = 'READ_SFDP_HEADER'
+		with m.State('READ_SFDP_HEADER'):
+			# The SFDP header is at address 0
+			m.d.comb += txn.request('readSFDPHeader', address = Const(0, 24))
+			with m.If(flash.received):
+				m.d.sync += sfdpIndex.inc()
+				with m.Switch(sfdpIndex):
+					# The header must start with the 'SFDP' signature, and the first parameter header must be for
+					# a Basic Flash Parameter Table (ID 0xFF00) of major revision 1 with at least the 9 DWORDs of JESD216
+					for index, value in {0: ord('S'), 1: ord('F'), 2: ord('D'), 3: ord('P'), 8: 0x00, 10: 0x01, 15: 0xFF}.items():
+						with m.Case(index):
+							with m.If(flash.r_data != value):
+								m.d.sync += sfdpValid.eq(0)
+					with m.Case(11):
+						with m.If(flash.r_data < 9):
+							m.d.sync += sfdpValid.eq(0)
+						m.d.sync += tableLength.eq(Mux(
+							flash.r_data >= self.sfdpTableLength // 4, self.sfdpTableLength, flash.r_data[0:4] << 2
+						))
+					for index in range(3):
+						with m.Case(12 + index):
+							m.d.sync += tableAddr.word_select(index, 8).eq(flash.r_data)
+			with m.If(txn.done):
+				m.d.sync += sfdpIndex.eq(0)
+				with m.If(sfdpValid):
+					m.next = 'READ_SFDP_TABLE'
+				with m.Else():
+					m.next = 'CONFIGURE'
+		with m.State('READ_SFDP_TABLE'):
+			m.d.comb += txn.request('readSFDPTable', address = tableAddr, dataLength = tableLength)
+			with m.If(flash.received):
+				m.d.sync += sfdpIndex.inc()
+				with m.Switch(sfdpIndex):
+					# DWORD 1 gives the address widths the Flash takes: 3-byte only, 3 or 4-byte, or 4-byte only
 					with m.Case(2):
-						with m.If(flash.done):
-							m.d.comb += [
-								flash.xfer.eq(1),
-								flash.w_data.eq(self.writeAddr[8:16]),
-							]
-							m.d.sync += writeCmdStep.eq(3)
-					with m.Case(3):
-						with m.If(flash.done):
+						m.d.sync += addressMismatch.eq(flash.r_data[1:3] == (0b10 if addressWidth == 24 else 0b00))
+					# DWORDs 8 and 9 describe the 4 erase types, as pairs of a size (as a power of 2) and an opcode
+					for index in range(28, 36, 2):
+						with m.Case(index):
+							m.d.sync += eraseTypeSize.eq(flash.r_data)
+						with m.Case(index + 1):
+							for size, opcode in eraseOpcodes.items():
+								with m.If(eraseTypeSize == size.bit_length() - 1):
+									if fourByteOpcodes:
+										# Only erase types whose opcode has a known 4-byte address form can be used
+										with m.Switch(flash.r_data):
+											for command, fourByteCommand in self.fourByteEraseCommands.items():
+												with m.Case(command):
+													m.d.sync += [
+														opcode.eq(fourByteCommand),
+														eraseSupported[size].eq(1),
+													]
+									else:
+										m.d.sync += [
+											opcode.eq(flash.r_data),
+											eraseSupported[size].eq(1),
+										]
+					# DWORD 11 gives the page size (as a power of 2), which we only make use of if it's smaller
+					with m.Case(40):
+						with m.If(flash.r_data[4:8] < pageSizeLog2.reset):
+							m.d.sync += pageSizeLog2.eq(flash.r_data[4:8])
+					# DWORD 15 gives the Quad Enable requirements, which we pick up those of that we know how to handle
+					if quad:
+						with m.Case(58):
+							with m.Switch(flash.r_data[4:7]):
+								with m.Case(0b000):
+									m.d.sync += quadEnable.eq(QuadEnable.none)
+								with m.Case(0b010):
+									m.d.sync += quadEnable.eq(QuadEnable.sr1Bit6)
+								with m.Case(0b100, 0b101):
+									m.d.sync += quadEnable.eq(QuadEnable.sr2Bit1)
+								with m.Case(0b110):
+									m.d.sync += quadEnable.eq(QuadEnable.sr2Bit1Write31)
+			with m.If(txn.done):
+				with m.If(addressMismatch):
+					m.next = 'UNUSABLE'
+				with m.Else():
+					m.next = 'CONFIGURE'
+		# A Flash that can't be addressed the way we were built to is left well alone, never signalling ready
+		with m.State('UNUSABLE'):
+			pass
+
+	def _elaborateQuadEnable(self, m : Module, flash : SPIBus, txn : 'SPIFlashTransactor', quadEnable : Signal,
+		statusReg1 : Signal, statusReg2 : Signal
+	):
+		""" Describes the states needed to check and, if necessary, set the Flash's Quad Enable bit.
+
+		These are run after the Flash has been identified, and end by going to IDLE and signalling ready. The status
+		registers holding the QE bit are read first so that we only write to them when the bit is not already set,
+		avoiding an unnecessary non-volatile write cycle every time the bootloader is run. As the Quad Enable method
+		can be discovered from the Flash, the states handle all the methods, with the one in quadEnable being used.
+		"""
+		quadEnabled = Mux(quadEnable == QuadEnable.sr1Bit6, statusReg1[6], statusReg2[1])
+
+		with m.State('QE_READ_SR1'):
+			m.d.comb += txn.request('readStatus')
+			with m.If(txn.done):
+				m.d.sync += statusReg1.eq(flash.r_data)
+				# Writing status register 1 alone on these parts clears status register 2, so it must be read too
+				with m.If(quadEnable == QuadEnable.sr2Bit1):
+					m.next = 'QE_READ_SR2'
+				with m.Else():
+					m.next = 'QE_CHECK'
+		with m.State('QE_READ_SR2'):
+			m.d.comb += txn.request('readStatus2')
+			with m.If(txn.done):
+				m.d.sync += statusReg2.eq(flash.r_data)
+				m.next = 'QE_CHECK'
+		with m.State('QE_CHECK'):
+			with m.If(quadEnabled):
+				m.d.comb += self.ready.eq(1)
+				m.next = 'IDLE'
+			with m.Else():
+				m.next = 'QE_WRITE'
+		with m.State('QE_WRITE'):
+			# The write also waits for the Flash to finish updating the status register
+			with m.Switch(quadEnable):
+				with m.Case(QuadEnable.sr1Bit6):
+					m.d.comb += txn.request('writeStatus', address = statusReg1 | 0x40)
+				with m.Case(QuadEnable.sr2Bit1):
+					m.d.comb += txn.request('writeStatusBoth', address = Cat(statusReg2 | 0x02, statusReg1))
+				with m.Case(QuadEnable.sr2Bit1Write31):
+					m.d.comb += txn.request('writeStatus2', address = statusReg2 | 0x02)
+			with m.If(txn.done):
+				m.d.comb += self.ready.eq(1)
+				m.next = 'IDLE'
+
+class SPIFlashStep:
+	""" A single step of a Flash command program, sent to the Flash as one transaction with CS held asserted. """
+	layout = (
+		('command', 8),
+		('commandInput', 1),
+		('addressLength', 3),
+		('data', 3),
+		('dataLength', 5),
+		('dataLengthInput', 1),
+		('dataWidth', 2),
+		('last', 1),
+	)
+	""" The layout of the step's fields in the command program ROM, least significant first. """
+
+	def __init__(
+		self, command : Optional[int] = None, *, addressLength : int = 0, data : SPIFlashData = SPIFlashData.none,
+		dataLength : Optional[int] = None, dataWidth : SPIBusWidth = SPIBusWidth.single
+	):
+		"""
+		Parameters
+		----------
+		command
+			The command opcode to send, or None to send the command requested along with the program.
+		addressLength
+			The number of bytes to send after the opcode. These are taken from the address requested along with the
+			program, most significant byte first, with any bytes beyond the address (such as dummy bytes) sent as 0.
+		data
+			The data phase of the step, if it has one.
+		dataLength
+			The number of data bytes to transfer, or None to transfer the number requested along with the program.
+			Poll steps always read a byte at a time.
+		dataWidth
+			The bus width to use for the data phase.
+		"""
+		if data == SPIFlashData.poll:
+			dataLength = 1
+		assert 0 <= addressLength <= 5, 'Steps can send at most 5 bytes after the opcode'
+		assert dataLength is None or dataLength < 2 ** 5, 'Fixed data lengths must fit in the step\'s dataLength field'
+		self.command = command
+		self.addressLength = addressLength
+		self.data = data
+		self.dataLength = dataLength
+		self.dataWidth = dataWidth
+
+	def encode(self, *, last : bool) -> int:
+		""" Encodes the step into a word for the command program ROM, marking it as the last of its program or not. """
+		fields = {
+			'command': 0 if self.command is None else self.command,
+			'commandInput': self.command is None,
+			'addressLength': self.addressLength,
+			'data': self.data,
+			'dataLength': self.dataLength or 0,
+			'dataLengthInput': self.data != SPIFlashData.none and self.dataLength is None,
+			'dataWidth': self.dataWidth,
+			'last': last,
+		}
+		word = 0
+		offset = 0
+		for name, width in self.layout:
+			word |= int(fields[name]) << offset
+			offset += width
+		return word
+
+class SPIFlashTransactor(Elaboratable):
+	""" SPI Flash command sequencer gateware, running command programs from a ROM.
+
+	Attributes
+	----------
+	start : Signal(), input
+		Request to run a program using the current values of the other inputs. This is acted upon
+		only when the transactor is idle, and so may be held asserted until done is seen.
+	done : Signal(), output
+		Strobe indicating the requested program has completed and CS has been deasserted.
+
+	program : Signal(range(len(microcode))), input
+		The ROM address of the first step of the program to run.
+	command : Signal(8), input
+		The command opcode sent by steps that don't have one of their own.
+	address : Signal(32), input
+		The bytes sent following the opcode by steps with an address phase, most significant byte first - normally
+		the address for the command.
+	dataLength : Signal(range(maxDataLength + 1)), input
+		How many data bytes steps that don't have a fixed data length transfer.
+
+	differs : Signal(), output
+		Whether any byte read by the last compare step differed from the FIFO's data. Valid once done
+		is signalled and held until the next program starts.
+	blank : Signal(), output
+		Whether every byte read by the last compare step was 0xFF (erased). Valid once done is signalled
+		and held until the next program starts.
+	skipped : Signal(), output
+		Whether the last program was cut short by a blank check step finding its data blank. Valid once done is
+		signalled and held until the next program starts.
+	waiting : Signal(), output
+		Whether the next step is being held off until the FIFO holds all the data it needs.
+
+	holdReads : Signal(), output
+		Whether reads from the FIFO should be held uncommitted, as a blank check step is in progress.
+	rewindReads : Signal(), output
+		Strobe indicating the FIFO should be rewound to its last committed read, as a blank check step found
+		data that isn't blank. These are only used by programs with blank check steps, which need a FIFO that
+		supports rewinding such as :py:class:`dragonBoot.fifo.RewindFIFO`.
+
+	Notes
+	-----
+	Each program is a list of :py:class:`SPIFlashStep` s, which are encoded into a ROM and run one after the other,
+	with :py:meth:`request` building the assignments to start one by name. This means the controller's states only
+	select which program to run and supply its address and length, and adding a new command is a matter of adding
+	a program to the table the transactor is built with.
+
+	A step is clocked out as a single burst using the stream interface of the SPI bus, so SCK does not idle at any
+	point between the opcode and the last data byte. For steps writing data, the FIFO is connected directly to the bus
+	for the data phase, and for compare steps the FIFO is popped as each byte is received. Both kinds of step wait,
+	with CS deasserted, until the FIFO holds all the data they need so that they are never stalled waiting on the
+	host. For steps reading data, the data read during the final byte is held in the bus' r_data once done is
+	signalled. For capture steps, each byte is pushed into the read FIFO as it is received, with SCK being paused
+	between bytes whenever the read FIFO is too full to take the bytes that could still be in flight.
+
+	For poll steps, bytes keep being read for as long as the bytes received have bit 0 set. As a byte is only received
+	once the bytes after it have started, a few more bytes are read once bit 0 is seen clear, the last of which is the
+	one left in r_data. This relies on the bus strobing received for every byte read, which the SB_SPI block does not
+	do - so when statusPoll is not set, poll steps instead read a single byte and are repeated until bit 0 is clear.
+
+	Blank check steps wait for all their data in the same way, then read through it a byte a cycle without
+	committing the reads, stopping as soon as a byte isn't 0xFF. As non-blank data normally shows itself within the
+	first few bytes, this costs little when the program goes ahead.
+
+	Once a step completes, the transactor idles for a further cycle so that CS is held deasserted
+	for at least two cycles between back-to-back steps. The ROM is a block RAM with a registered read, so a
+	program starts a cycle after it is requested, while its first step is read out.
+	"""
+	def __init__(
+		self, *, bus : SPIBus, fifo : AsyncFIFO, programs : Dict[str, Sequence[SPIFlashStep]], maxDataLength : int,
+		readFIFO : Optional[AsyncFIFO] = None, statusPoll : bool = True
+	):
+		"""
+		Parameters
+		----------
+		bus
+			The SPI bus to run programs on.
+		fifo
+			The FIFO that supplies the data for steps that write or compare data.
+		programs
+			The command programs to put in the ROM, by name.
+		maxDataLength
+			The largest number of data bytes a single step may be asked to transfer.
+		readFIFO
+			Optionally, the FIFO that capture steps put the data read into.
+		statusPoll
+			Whether poll steps can keep reading the status register with CS held asserted.
+		"""
+		self._bus = bus
+		self._fifo = fifo
+		self._readFIFO = readFIFO
+		self._statusPoll = statusPoll
+
+		# Lay the programs out one after the other in the ROM, noting where each starts
+		self._entries : Dict[str, int] = {}
+		self._microcode : List[int] = []
+		self._blankCheck = any(step.data == SPIFlashData.blankCheck for steps in programs.values() for step in steps)
+		for name, steps in programs.items():
+			assert len(steps) > 0, f'Command program {name} must have at least one step'
+			self._entries[name] = len(self._microcode)
+			for index, step in enumerate(steps):
+				self._microcode.append(step.encode(last = index == len(steps) - 1))
+
+		self.start = Signal()
+		self.done = Signal()
+
+		self.program = Signal(range(len(self._microcode)))
+		self.command = Signal(8)
+		self.address = Signal(32)
+		self.dataLength = Signal(range(maxDataLength + 1))
+
+		self.differs = Signal()
+		self.blank = Signal()
+		self.skipped = Signal()
+		self.waiting = Signal()
+
+		self.holdReads = Signal()
+		self.rewindReads = Signal()
+
+	def request(self, program : str, *, command = None, address = None, dataLength = None):
+		""" Builds the assignments to request a program be run with the given parameters.
+
+		Parameters
+		----------
+		program
+			The name of the command program to run.
+		command
+			The command opcode for steps that don't have one of their own.
+		address
+			The value sent by steps with an address phase. This is sent most significant byte first, and must be
+			a whole number of bytes - for steps that send more bytes than it has, the extra bytes are sent as 0.
+		dataLength
+			The number of data bytes steps without a fixed data length transfer.
+
+		Returns
+		-------
+		list
+			Combinatorial assignments which must be made while the program is wanted.
+		"""
+		assignments = [
+			self.start.eq(1),
+			self.program.eq(self._entries[program]),
+		]
+		if command is not None:
+			assignments.append(self.command.eq(command))
+		if address is not None:
+			address = Value.cast(address)
+			assert len(address) % 8 == 0 and len(address) <= len(self.address), 'Address must be 0 to 4 whole bytes'
+			# Left-align the address bytes so they are shifted out from the top of the register
+			assignments.append(self.address.eq(address << (len(self.address) - len(address))))
+		if dataLength is not None:
+			assignments.append(self.dataLength.eq(dataLength))
+		return assignments
+
+	def elaborate(self, platform) -> Module:
+		""" Describes the gateware needed to sequence command programs onto the SPI bus.
+
+		Parameters
+		----------
+		platform
+			The Amaranth platform for which the gateware will be synthesised.
+
+		Returns
+		-------
+		:py:class:`torii.hdl.dsl.Module`
+			A complete description of the gateware behaviour required.
+		"""
+		m = Module()
+		bus = self._bus
+		fifo = self._fifo
+
+		microcode = Memory(
+			width = sum(width for _, width in SPIFlashStep.layout), depth = len(self._microcode),
+			init = self._microcode, name = 'microcode'
+		)
+		# The step being run is read out of block RAM, so its ROM address must be given a cycle ahead
+		m.submodules.microcode = microcodePort = microcode.read_port(domain = 'sync', transparent = False)
+		step = Record(SPIFlashStep.layout)
+		stepIndex = Signal.like(self.program)
+
+		command = Signal.like(self.command)
+		address = Signal.like(self.address)
+		requestedLength = Signal.like(self.dataLength)
+		addressShift = Signal(40)
+		addressLength = Signal.like(step.addressLength)
+		dataLength = Signal.like(self.dataLength)
+		dataRead = Signal()
+		dataCompare = Signal()
+		dataCapture = Signal()
+		dataPoll = Signal()
+		pollDone = Signal()
+		captureReady = Signal()
+		differs = Signal()
+		blank = Signal()
+		skipped = Signal()
+		mismatch = Signal()
+		notBlank = Signal()
+
+		m.d.comb += [
+			self.done.eq(0),
+			microcodePort.addr.eq(stepIndex),
+			step.eq(microcodePort.data),
+			dataRead.eq(step.data >= SPIFlashData.read),
+			dataCompare.eq(step.data == SPIFlashData.compare),
+			dataCapture.eq(step.data == SPIFlashData.capture),
+			dataPoll.eq((step.data == SPIFlashData.poll) if self._statusPoll else 0),
+			bus.stream.valid.eq(0),
+			bus.stream.data.eq(0),
+			bus.stream.last.eq(0),
+			bus.width.eq(SPIBusWidth.single),
+			bus.read.eq(0),
+			fifo.r_en.eq(0),
+			mismatch.eq(bus.r_data != fifo.r_data),
+			notBlank.eq(bus.r_data != 0xFF),
+			# Fold in the byte being received this cycle so the flags are complete by the time done is signalled
+			self.differs.eq(differs | (bus.received & dataCompare & mismatch)),
+			self.blank.eq(blank & ~(bus.received & dataCompare & notBlank)),
+			self.skipped.eq(skipped),
+		]
+
+		# Once a byte being polled comes back with bit 0 clear, the poll can be brought to an end
+		with m.If(bus.received & dataPoll & ~bus.r_data[0]):
+			m.d.sync += pollDone.eq(1)
+
+		# Compare each byte against the FIFO as it arrives, which for the final byte is after the data phase ends
+		with m.If(bus.received & dataCompare):
+			m.d.comb += fifo.r_en.eq(1)
+			m.d.sync += [
+				differs.eq(self.differs),
+				blank.eq(self.blank),
+			]
+
+		readFIFO = self._readFIFO
+		if readFIFO is not None:
+			m.d.comb += [
+				readFIFO.w_en.eq(bus.received & dataCapture),
+				readFIFO.w_data.eq(bus.r_data),
+				# Leave room for the bytes that can still be on their way in once another byte is started
+				captureReady.eq(readFIFO.w_level <= readFIFO.depth - 4),
+			]
+
+		def stepLength(requestedLength : Value) -> Value:
+			return Mux(step.dataLengthInput, requestedLength, step.dataLength)
+
+		def stepReady(requestedLength : Value) -> Value:
+			# Steps that take data from the FIFO wait for all of it so they are never stalled with CS asserted
+			usesFIFO = (
+				(step.data == SPIFlashData.write) | (step.data == SPIFlashData.compare) |
+				(step.data == SPIFlashData.blankCheck)
+			)
+			return ~usesFIFO | (fifo.r_level >= stepLength(requestedLength))
+
+		def startStep(address : Value, requestedLength : Value):
+			m.d.sync += [
+				addressShift.eq(Cat(Const(0, 8), address)),
+				addressLength.eq(step.addressLength),
+				dataLength.eq(stepLength(requestedLength)),
+				pollDone.eq(0),
+			]
+			if self._blankCheck:
+				# Blank checks don't run a transaction, so leave CS deasserted for them
+				with m.If(step.data == SPIFlashData.blankCheck):
+					m.next = 'BLANK_CHECK'
+				with m.Else():
+					m.d.sync += bus.cs.eq(1)
+					m.next = 'COMMAND'
+			else:
+				m.d.sync += bus.cs.eq(1)
+				m.next = 'COMMAND'
+
+		with m.FSM(name = 'transaction'):
+			with m.State('IDLE'):
+				# Look up the first step of the requested program, which is then ready to start in STEP
+				m.d.comb += microcodePort.addr.eq(self.program)
+				with m.If(self.start):
+					m.d.sync += [
+						stepIndex.eq(self.program),
+						command.eq(self.command),
+						address.eq(self.address),
+						requestedLength.eq(self.dataLength),
+						differs.eq(0),
+						blank.eq(1),
+						skipped.eq(0),
+					]
+					m.next = 'STEP'
+			with m.State('STEP'):
+				with m.If(stepReady(requestedLength)):
+					startStep(address, requestedLength)
+				with m.Else():
+					m.d.comb += self.waiting.eq(1)
+			if self._blankCheck:
+				with m.State('BLANK_CHECK'):
+					m.d.comb += self.holdReads.eq(1)
+					with m.If(fifo.r_data == 0xFF):
+						m.d.comb += fifo.r_en.eq(1)
+						m.d.sync += dataLength.dec()
+						# All the data is blank, so commit the reads along with this last one and skip the rest
+						with m.If(dataLength == 1):
 							m.d.comb += [
-								flash.xfer.eq(1),
-								flash.w_data.eq(self.writeAddr[0:8]),
-							]
-							m.d.sync += writeCmdStep.eq(4)
-					with m.Case(4):
-						with m.If(flash.done):
-							m.d.sync += [
-								writeTrigger.eq(1),
-								writeCmdStep.eq(0)
+								self.holdReads.eq(0),
+								self.done.eq(1),
+								self.skipped.eq(1),
 							]
-							m.next = 'WRITE'
-			with m.State('WRITE'):
-				with m.If(flash.done | writeTrigger):
-					m.d.sync += writeTrigger.eq(0)
-					with m.If(fifo.r_rdy):
-						m.d.comb += [
-							flash.xfer.eq(1),
-							fifo.r_en.eq(1),
-						]
-						m.d.sync += [
-							writeCount.eq(writeCount + 1),
-							byteCount.eq(byteCount - 1),
-						]
-						with m.If((writeCount == platform.flash.pageSize - 1) | (byteCount == 1)):
-							m.next = 'WRITE_FINISH'
+							m.d.sync += skipped.eq(1)
+							m.next = 'IDLE'
 					with m.Else():
-						m.next = 'DATA_WAIT'
-			with m.State('DATA_WAIT'):
-				with m.If(fifo.r_rdy):
-					m.d.sync += writeTrigger.eq(1)
-					m.next = 'WRITE'
-			with m.State('WRITE_FINISH'):
-				with m.Switch(writeFinishStep):
-					with m.Case(0):
-						with m.If(flash.done):
-							m.d.sync += [
-								flash.cs.eq(0),
-								writeFinishStep.eq(1),
-							]
-					with m.Case(1):
-						m.d.sync += [
-							self.writeAddr.eq(self.writeAddr + writeCount),
-							writeCount.eq(0),
-							writeFinishStep.eq(0),
-						]
-						m.next = 'WRITE_WAIT'
-			with m.State('WRITE_WAIT'):
-				with m.Switch(writeWaitStep):
-					with m.Case(0):
 						m.d.comb += [
-							flash.xfer.eq(1),
-							flash.w_data.eq(SPIFlashCmd.readStatus),
+							self.rewindReads.eq(1),
+							microcodePort.addr.eq(stepIndex + 1),
 						]
-						m.d.sync += [
-							flash.cs.eq(1),
-							writeWaitStep.eq(1),
-						]
-					with m.Case(1):
-						with m.If(flash.done):
-							m.d.comb += [
-								flash.xfer.eq(1),
-								flash.w_data.eq(0),
-							]
-							m.d.sync += writeWaitStep.eq(2)
-					with m.Case(2):
-						with m.If(flash.done):
-							m.d.sync += [
-								flash.cs.eq(0),
-								writeWaitStep.eq(3),
-							]
-					with m.Case(3):
-						m.d.sync += writeWaitStep.eq(0)
-						with m.If(~flash.r_data[0]):
-							with m.If(byteCount):
-								m.next = 'WRITE_ENABLE'
-							with m.Else():
-								m.d.sync += op.eq(SPIFlashOp.none)
-								m.next = 'FINISH'
+						m.d.sync += stepIndex.inc()
+						m.next = 'STEP'
+			with m.State('COMMAND'):
+				m.d.comb += [
+					bus.stream.valid.eq(1),
+					bus.stream.data.eq(Mux(step.commandInput, command, step.command)),
+					bus.stream.last.eq((addressLength == 0) & (dataLength == 0)),
+				]
+				with m.If(bus.stream.ready):
+					with m.If(addressLength != 0):
+						m.next = 'ADDRESS'
+					with m.Elif(dataLength != 0):
+						m.next = 'DATA'
+					with m.Else():
+						m.next = 'FINISH'
+			with m.State('ADDRESS'):
+				m.d.comb += [
+					bus.stream.valid.eq(1),
+					bus.stream.data.eq(addressShift[32:40]),
+					bus.stream.last.eq((addressLength == 1) & (dataLength == 0)),
+				]
+				with m.If(bus.stream.ready):
+					m.d.sync += [
+						addressShift.eq(addressShift.shift_left(8)),
+						addressLength.dec(),
+					]
+					with m.If(addressLength == 1):
+						with m.If(dataLength != 0):
+							m.next = 'DATA'
+						with m.Else():
+							m.next = 'FINISH'
+			with m.State('DATA'):
+				m.d.comb += [
+					bus.stream.last.eq(Mux(dataPoll, pollDone, dataLength == 1)),
+					bus.width.eq(step.dataWidth),
+					bus.read.eq(dataRead),
+				]
+				with m.If(dataRead):
+					m.d.comb += bus.stream.valid.eq(~dataCapture | captureReady)
+				with m.Else():
+					m.d.comb += [
+						bus.stream.valid.eq(fifo.r_rdy),
+						bus.stream.data.eq(fifo.r_data),
+						fifo.r_en.eq(bus.stream.ready),
+					]
+				with m.If(bus.stream.valid & bus.stream.ready):
+					m.d.sync += dataLength.dec()
+					with m.If(bus.stream.last):
+						m.next = 'FINISH'
 			with m.State('FINISH'):
-				m.d.comb += self.done.eq(1)
-				with m.If(self.finish):
+				with m.If(bus.done):
+					m.d.sync += bus.cs.eq(0)
+					m.next = 'RELEASE'
+			with m.State('RELEASE'):
+				# Polls that caught the Flash still busy go again, otherwise move on to the next step if there is one
+				with m.If((step.data == SPIFlashData.poll) & bus.r_data[0]):
+					m.next = 'STEP'
+				with m.Elif(~step.last):
+					m.d.comb += microcodePort.addr.eq(stepIndex + 1)
+					m.d.sync += stepIndex.inc()
+					m.next = 'STEP'
+				with m.Else():
+					m.d.comb += self.done.eq(1)
 					m.next = 'IDLE'
 
 		return m
@@ -0,0 +1,92 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from typing import Dict, Optional, Tuple, Union
+
+__all__ = (
+	'FlashPart',
+	'flashParts',
+	'lookupFlashPart',
+)
+
+class FlashPart:
+	""" The timing characteristics of a specific SPI Flash part, taken from its datasheet. """
+	def __init__(self, *, name : str, jedecID : int, pageProgramTime : float, sectorEraseTime : float,
+		blockEraseTimes : Optional[Dict[int, float]] = None, maxClock : float
+	):
+		"""
+		Parameters
+		----------
+		name
+			The part number of the Flash
+		jedecID
+			The 24-bit JEDEC ID the Flash answers the Read JEDEC ID (0x9F) command with, manufacturer ID in the top byte
+		pageProgramTime
+			The typical time, in seconds, the Flash takes to program a page (tPP)
+		sectorEraseTime
+			The typical time, in seconds, the Flash takes to erase a 4KiB sector (tSE)
+		blockEraseTimes
+			A mapping of the larger erase block sizes, in bytes, to the typical time, in seconds,
+			the Flash takes to erase one (tBE)
+		maxClock
+			The maximum SCK frequency, in Hz, the Flash supports for the read and program commands
+		"""
+		self.name = name
+		self.jedecID = jedecID
+		self.pageProgramTime = pageProgramTime
+		self.sectorEraseTime = sectorEraseTime
+		self.blockEraseTimes = {} if blockEraseTimes is None else dict(blockEraseTimes)
+		self.maxClock = maxClock
+
+	def __repr__(self) -> str:
+		return f'FlashPart({self.name}, jedecID = {self.jedecID:#08x})'
+
+_parts : Tuple[FlashPart, ...] = (
+	FlashPart(
+		name = 'AT25SF081', jedecID = 0x1F8501, pageProgramTime = 0.4e-3, sectorEraseTime = 45e-3,
+		blockEraseTimes = {32 * 1024: 120e-3, 64 * 1024: 150e-3}, maxClock = 104e6
+	),
+	FlashPart(
+		name = 'GD25Q40C', jedecID = 0xC84013, pageProgramTime = 0.6e-3, sectorEraseTime = 50e-3,
+		blockEraseTimes = {32 * 1024: 150e-3, 64 * 1024: 250e-3}, maxClock = 104e6
+	),
+	FlashPart(
+		name = 'W25Q16JV', jedecID = 0xEF4015, pageProgramTime = 0.4e-3, sectorEraseTime = 45e-3,
+		blockEraseTimes = {32 * 1024: 120e-3, 64 * 1024: 150e-3}, maxClock = 133e6
+	),
+	FlashPart(
+		name = 'W25Q32JV', jedecID = 0xEF4016, pageProgramTime = 0.4e-3, sectorEraseTime = 45e-3,
+		blockEraseTimes = {32 * 1024: 120e-3, 64 * 1024: 150e-3}, maxClock = 133e6
+	),
+	FlashPart(
+		name = 'W25Q64JV', jedecID = 0xEF4017, pageProgramTime = 0.4e-3, sectorEraseTime = 45e-3,
+		blockEraseTimes = {32 * 1024: 120e-3, 64 * 1024: 150e-3}, maxClock = 133e6
+	),
+	FlashPart(
+		name = 'W25Q128JV', jedecID = 0xEF4018, pageProgramTime = 0.4e-3, sectorEraseTime = 45e-3,
+		blockEraseTimes = {32 * 1024: 120e-3, 64 * 1024: 150e-3}, maxClock = 133e6
+	),
+)
+
+flashParts : Dict[int, FlashPart] = {part.jedecID: part for part in _parts}
+""" The database of known Flash parts, keyed by JEDEC ID. """
+
+def lookupFlashPart(part : Union[str, int]) -> FlashPart:
+	""" Looks up a Flash part in the database.
+
+	Parameters
+	----------
+	part
+		Either the part number (matched without regard to case) or the JEDEC ID of the Flash to look up
+
+	Returns
+	-------
+	FlashPart
+		The timing characteristics of the requested Flash part
+	"""
+	if isinstance(part, int):
+		if part not in flashParts:
+			raise KeyError(f'No Flash part with JEDEC ID {part:#08x} is known')
+		return flashParts[part]
+	for flashPart in flashParts.values():
+		if flashPart.name.upper() == part.upper():
+			return flashPart
+	raise KeyError(f'No Flash part named {part} is known')
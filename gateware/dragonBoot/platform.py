@@ -4,10 +4,15 @@ from torii.build import Platform
 from torii.build.run import BuildPlan, BuildProducts, LocalBuildProducts
 from torii.platform.vendor.lattice.ice40 import ICE40Platform
 from abc import abstractmethod
-from typing import Dict, Union
+from enum import IntEnum, unique
+from typing import Dict, Optional, Union
+
+from .parts import FlashPart, lookupFlashPart
 
 __all__ = (
 	'Flash',
+	'QuadEnable',
+	'SBSPIBlock',
 	'DragonICE40Platform',
 	'platform'
 )
@@ -19,9 +24,39 @@ sizeSuffixes = {
 	3: 'GiB',
 }
 
+@unique
+class QuadEnable(IntEnum):
+	""" An enumeration of the ways a Flash part's Quad Enable (QE) bit can be set.
+
+	These follow the common Quad Enable Requirements defined in JESD216 (SFDP).
+	"""
+	none = 0
+	""" The part has no QE bit, so its quad commands are always available. """
+	sr1Bit6 = 1
+	""" QE is bit 6 of status register 1, read with 0x05 and written with a 1 byte 0x01. """
+	sr2Bit1 = 2
+	""" QE is bit 1 of status register 2, read with 0x35 and written with a 2 byte 0x01. """
+	sr2Bit1Write31 = 3
+	""" QE is bit 1 of status register 2, read with 0x35 and written with 0x31. """
+
+@unique
+class SBSPIBlock(IntEnum):
+	""" An enumeration of the hard SB_SPI blocks on the iCE40 parts that have them (UltraPlus and LM).
+
+	The values are those of the block's system bus address (the BUS_ADDR74 parameter).
+	"""
+	left = 0b0000
+	""" The SB_SPI block in the left corner of the device. """
+	right = 0b0010
+	""" The SB_SPI block in the right corner of the device. """
+
 class Flash:
 	""" The platform Flash configuration type. """
-	def __init__(self, *, size : int, pageSize : int, erasePageSize : int, eraseCommand : int):
+	def __init__(self, *, size : int, pageSize : int, erasePageSize : int, eraseCommand : int,
+		quadEnable : QuadEnable = QuadEnable.none, blockEraseCommands : Optional[Dict[int, int]] = None,
+		eraseTime : Optional[float] = None, programTime : Optional[float] = None,
+		part : Optional[Union[str, int]] = None, fourByteOpcodes : bool = True
+	):
 		"""
 		Parameters
 		----------
@@ -33,11 +68,72 @@ class Flash:
 			The size, in bytes, of an erase sector on the target Flash
 		eraseCommand
 			The numerical value of the command byte to send to the target Flash to erase a sector
+		quadEnable
+			How the Quad Enable bit must be set on the target Flash before its quad commands can be used
+		blockEraseCommands
+			A mapping of the larger erase block sizes, in bytes, the target Flash supports to the numerical
+			values of the command bytes that erase them (eg, :code:`{32768: 0x52, 65536: 0xD8}`)
+		eraseTime
+			The typical time, in seconds, the target Flash takes to erase a sector, if known
+		programTime
+			The typical time, in seconds, the target Flash takes to program a page, if known
+		part
+			The part number or JEDEC ID of the target Flash in the :py:mod:`Flash part database <dragonBoot.parts>`,
+			which supplies the default erase and program times along with the part's other timing characteristics
+		fourByteOpcodes
+			For Flash larger than 16MiB, whether to use the dedicated 4-byte address command opcodes (such as
+			0x12, 0x21 and 0xDC) rather than entering 4-byte address mode (0xB7) around each operation
 		"""
 		self.size = size
 		self.pageSize = pageSize
 		self.erasePageSize = erasePageSize
 		self.eraseCommand = eraseCommand
+		self.quadEnable = quadEnable
+		self.blockEraseCommands = {} if blockEraseCommands is None else dict(blockEraseCommands)
+		self.part : Optional[FlashPart] = None if part is None else lookupFlashPart(part)
+		if self.part is not None:
+			if eraseTime is None:
+				eraseTime = self.part.sectorEraseTime
+			if programTime is None:
+				programTime = self.part.pageProgramTime
+		self.eraseTime = eraseTime
+		self.programTime = programTime
+		self.fourByteOpcodes = fourByteOpcodes
+
+		for blockSize in self.blockEraseCommands:
+			assert blockSize > erasePageSize and blockSize & (blockSize - 1) == 0 and blockSize % erasePageSize == 0, \
+				f'Erase block size {blockSize} must be a power of 2 multiple of the erase page size'
+
+	@property
+	def eraseCommands(self) -> Dict[int, int]:
+		""" This property returns a mapping of all the erase sizes the Flash supports to their command bytes.
+
+		The sizes are given in ascending order, starting with the erase page (sector) size.
+		"""
+		commands = {self.erasePageSize: self.eraseCommand}
+		for blockSize in sorted(self.blockEraseCommands):
+			commands[blockSize] = self.blockEraseCommands[blockSize]
+		return commands
+
+	@property
+	def addressWidth(self) -> int:
+		""" This property returns the width, in bits, of the addresses needed to reach all of the Flash.
+
+		This is 24 for Flash up to 16MiB, which is addressed with the normal 3-byte addresses, and 32 above that.
+		"""
+		return 24 if self.size <= 2 ** 24 else 32
+
+	@property
+	def eraseTimes(self) -> Dict[int, Optional[float]]:
+		""" This property returns a mapping of all the erase sizes the Flash supports to their typical times in seconds.
+
+		The sizes are those of :py:attr:`eraseCommands`, with the time being None for any size whose time isn't known.
+		"""
+		blockEraseTimes = {} if self.part is None else self.part.blockEraseTimes
+		times = {self.erasePageSize: self.eraseTime}
+		for blockSize in sorted(self.blockEraseCommands):
+			times[blockSize] = blockEraseTimes.get(blockSize)
+		return times
 
 	def platform(self, platform : Platform):
 		""" Called during the initialisation of the platform, this calculates the slot information.
@@ -136,6 +232,60 @@ class DragonICE40Platform(ICE40Platform):
 	It also includes logic required to enforce the presence and facilitate retrieval of Flash descriptor objects.
 	"""
 
+	flashFullRate = False
+	""" Whether the Flash SPI bus should run SCK at the full Flash controller clock rate using the DDR I/O registers. """
+	flashHardSPI : Optional[SBSPIBlock] = None
+	""" The hard SB_SPI block to run the Flash SPI bus with in place of the fabric SPI bus, if any.
+
+	The block must be the one whose pins the Flash is wired to - on most parts the configuration Flash pins.
+	"""
+	flashHardSPIDivider = 1
+	""" The divider the hard SB_SPI block generates SCK with, from the Flash controller clock, when used. """
+	flashClockFreq : Optional[float] = None
+	""" The frequency of the clock to run the Flash controller from, in its own :code:`flash` clock domain, if any.
+
+	When set, the platform's clocking must provide the :code:`flash` domain at this frequency. Otherwise the Flash
+	controller runs from the USB clock.
+	"""
+	flashDifferential = False
+	""" Whether to compare downloaded sectors with the Flash's contents, skipping the erase and program of
+	sectors that are unchanged and the erase of sectors that are already blank. """
+	flashVerify = False
+	""" Whether to read back the data just programmed into the Flash, checking it by CRC-32 against what was sent. """
+	flashDiscovery = False
+	""" Whether to read the Flash's JEDEC ID and SFDP parameters at startup, picking up erase types, a smaller page
+	size and the Quad Enable method from them. This is not needed when the Flash description is exact. """
+	flashSkipBlank = True
+	""" Whether to skip programming pages whose downloaded data is all 0xFF, such as bitstream and slot padding, as
+	this would leave the erased Flash unchanged. """
+	dfuTransferSize : Optional[int] = None
+	""" The largest download request, in bytes, the bootloader accepts (the DFU wTransferSize), if not the Flash's
+	sector erase size. This must be a power of 2 multiple of the sector size, of no more than 32KiB, and the bitstream
+	FIFO is sized to hold a whole request (or two when double buffering) in block RAM. """
+	dfuDoubleBuffer = False
+	""" Whether to buffer two sector erase pages of downloaded data, so the next download request can be received
+	while the last is programmed into the Flash. This doubles the block RAM used by the bitstream FIFO. """
+	dfuPreErase = False
+	""" Whether selecting a slot (the DFU interface's alt-mode) erases the whole slot in the background, so that
+	downloads into it only need to program the Flash. Slot 0, the bootloader's own, is never erased this way, and
+	upload requests are not supported as selecting a slot to read it back would erase it. """
+	dfuStreaming = False
+	""" Whether to add a vendor-specific interface with a bulk OUT endpoint that images can be streamed into the
+	Flash through, which avoids the per-request overhead of DFU download requests. DFU downloads still work as
+	normal alongside it. """
+	dfuCompression = False
+	""" Whether to pass downloads through a decompressor, so images compressed with :code:`dragonBoot compress` can
+	be downloaded in fewer requests. Uncompressed images are still accepted, and passed straight through. """
+	dfuAddressed = False
+	""" Whether to place the data of each DFU download request in the slot by its block number, so that host tooling
+	can skip blocks that haven't changed or resume an interrupted download. This cannot be used with dfuCompression. """
+	dfuCounters = False
+	""" Whether to keep performance counters recording where the time goes during a DFU session, which can be read
+	back with a vendor request. These are left out by default as they take a fair amount of logic. """
+	dfuTrace = False
+	""" Whether to record a timestamped trace of what the bootloader does during a DFU session, which can be read
+	back with a vendor request. This is left out by default as it takes a block RAM. """
+
 	@property
 	@abstractmethod
 	def flash(self) -> Flash:
@@ -1,7 +1,7 @@
 # SPDX-License-Identifier: BSD-3-Clause
 from torii.build import Attrs
 from torii.platform.resources.interface import SPIResource, ULPIResource
-from ..platform import DragonICE40Platform, Flash, platform
+from ..platform import DragonICE40Platform, Flash, QuadEnable, platform
 
 __all__ = (
 	'AudioInterfacePlatform',
@@ -57,5 +57,11 @@ class AudioInterfacePlatform(DragonICE40Platform):
 		size = 512 * 1024,
 		pageSize = 256,
 		erasePageSize = 4096,
-		eraseCommand = 0x20
+		eraseCommand = 0x20,
+		quadEnable = QuadEnable.sr2Bit1,
+		blockEraseCommands = {
+			32 * 1024: 0x52,
+			64 * 1024: 0xD8,
+		},
+		part = 'GD25Q40C',
 	)
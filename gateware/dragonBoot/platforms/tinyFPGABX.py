@@ -2,7 +2,7 @@
 from torii.hdl import Elaboratable, Module, Instance, Signal, Const, ClockDomain, ClockSignal
 from torii.build import Resource, Pins, Clock, Attrs
 from torii.platform.resources.interface import SPIResource, DirectUSBResource
-from ..platform import DragonICE40Platform, Flash, platform
+from ..platform import DragonICE40Platform, Flash, QuadEnable, platform
 
 __all__ = (
 	'TinyFPGABXPlatform',
@@ -14,12 +14,19 @@ class USBPLL(Elaboratable):
 		m.domains.sync = ClockDomain()
 		m.domains.usb = ClockDomain()
 		m.domains.usb_io = ClockDomain()
+		# The Flash controller can be run from any of the clocks we have to hand
+		flashClockFreq = getattr(platform, 'flashClockFreq', None)
+		if flashClockFreq is not None:
+			if flashClockFreq not in (12e6, 24e6, 48e6):
+				raise ValueError(f'The Flash clock must be one of 12MHz, 24MHz or 48MHz, not {flashClockFreq / 1e6}MHz')
+			m.domains.flash = ClockDomain()
 
 		platform.lookup(platform.default_clk).attrs['GLOBAL'] = False
 
 		clk12MHz = Signal()
 		clk16MHz = platform.request(platform.default_clk, dir = 'i').i
 		clk48MHz = Signal()
+		clk24MHz = Signal()
 
 		m.submodules.pll = Instance(
 			'SB_PLL40_CORE',
@@ -45,6 +52,9 @@ class USBPLL(Elaboratable):
 
 		platform.add_clock_constraint(clk12MHz, 12e6)
 		platform.add_clock_constraint(clk48MHz, 48e6)
+		if flashClockFreq == 24e6:
+			platform.add_clock_constraint(clk24MHz, 24e6)
+			m.d.comb += clk24MHz.eq(clkCounter[0])
 
 		m.d.comb += [
 			clk12MHz.eq(clkCounter[1]),
@@ -52,6 +62,8 @@ class USBPLL(Elaboratable):
 			ClockSignal('usb').eq(clk12MHz),
 			ClockSignal('usb_io').eq(clk48MHz),
 		]
+		if flashClockFreq is not None:
+			m.d.comb += ClockSignal('flash').eq({12e6: clk12MHz, 24e6: clk24MHz, 48e6: clk48MHz}[flashClockFreq])
 		return m
 
 @platform
@@ -105,9 +117,20 @@ class TinyFPGABXPlatform(DragonICE40Platform):
 		size = 1 * 1024 * 1024,
 		pageSize = 256,
 		erasePageSize = 4096,
-		eraseCommand = 0x20
+		eraseCommand = 0x20,
+		quadEnable = QuadEnable.sr2Bit1,
+		blockEraseCommands = {
+			32 * 1024: 0x52,
+			64 * 1024: 0xD8,
+		},
+		part = 'AT25SF081',
 	)
 
+	# The AT25SF081 should be happy to be run at the full 12MHz of the USB clock domain, but flashFullRate is left off
+	# until its DDR I/O path has been checked on the BX itself rather than only in simulation
+	# Requests larger than a sector (dfuTransferSize) have only been modelled with the programming time estimator and not
+	# measured on the BX, so it keeps sector sized requests rather than giving half of the LP8K's block RAM to them
+
 	pll_type = USBPLL
 	# Unlike other platforms, this one waits 1s for the USB connection to come up, and if that fails,
 	# warmboots into w/e the user has in slot 1.
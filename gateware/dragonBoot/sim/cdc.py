@@ -0,0 +1,44 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+
+from ..cdc import BusSynchronizer
+
+class BusSynchronizerTestCase(ToriiTestCase):
+	dut : BusSynchronizer = BusSynchronizer
+	dut_args = {
+		'width': 16,
+		'i_domain': 'fast',
+		'o_domain': 'slow',
+	}
+	domains = (('fast', 100e6), ('slow', 24e6))
+
+	@ToriiTestCase.simulation
+	def testBusSynchronizer(self):
+		@ToriiTestCase.sync_domain(domain = 'fast')
+		def domainFast(self: BusSynchronizerTestCase):
+			# Count up through a carry that changes every bit of the value
+			for value in range(0x7FF0, 0x8400):
+				yield self.dut.i.eq(value)
+				yield
+			yield self.dut.i.eq(0x1234)
+			yield from self.step(40)
+		domainFast(self)
+
+		@ToriiTestCase.sync_domain(domain = 'slow')
+		def domainSlow(self: BusSynchronizerTestCase):
+			last = 0
+			# Each value seen must be one the input actually held, with none going backwards
+			for _ in range(240):
+				yield Settle()
+				value = yield self.dut.o
+				if value != 0:
+					self.assertGreaterEqual(value, last)
+					self.assertTrue(0x7FF0 <= value < 0x8400)
+					last = value
+				yield
+			self.assertGreater(last, 0x8000)
+			yield from self.step(30)
+			yield Settle()
+			self.assertEqual((yield self.dut.o), 0x1234)
+		domainSlow(self)
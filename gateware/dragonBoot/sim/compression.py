@@ -0,0 +1,128 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from random import Random
+from unittest import TestCase
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+
+from ..compression import compressedMagic, compressImage, decompressImage, StreamDecompressor
+
+def sampleImage() -> bytes:
+	random = Random(0x5A)
+	return (
+		bytes(300) +
+		b'\x12\x34\x56\x78' * 40 +
+		bytes(random.randrange(256) for _ in range(200)) +
+		b'\xAA' * 5000 +
+		bytes(random.choice((0, 0, 0, 1, 0x80, 0xFF)) for _ in range(2000)) +
+		b'abc' * 30
+	)
+
+class CompressionTestCase(TestCase):
+	def testRoundTrip(self):
+		image = sampleImage()
+		compressed = compressImage(image)
+		self.assertTrue(compressed.startswith(compressedMagic))
+		self.assertLess(len(compressed), len(image) // 4)
+		self.assertEqual(decompressImage(compressed), image)
+		# Images that aren't compressed are passed through as-is
+		self.assertEqual(decompressImage(image), image)
+		self.assertEqual(decompressImage(compressImage(b'')), b'')
+
+		random = Random(0x1D)
+		for _ in range(50):
+			image = bytes(random.choice((0, 0, 0xFF, random.randrange(256))) for _ in range(random.randrange(1, 2000)))
+			self.assertEqual(decompressImage(compressImage(image)), image)
+
+class StreamDecompressorTestCase(ToriiTestCase):
+	dut : StreamDecompressor = StreamDecompressor
+	domains = (('sync', 60e6),)
+
+	@ToriiTestCase.simulation
+	def testStreamDecompressor(self):
+		image = sampleImage()
+		compressed = compressImage(image)
+		# The first 3 bytes of this match the magic, so must be replayed once the 4th doesn't
+		rawImage = compressedMagic[0:3] + b'X' + bytes(range(256))
+		images = ((compressed, image), (rawImage, rawImage), (image[0:1000], image[0:1000]))
+		sink = self.dut.sink
+		source = self.dut.source
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSink(self: StreamDecompressorTestCase):
+			random = Random(1)
+			for data, _ in images:
+				yield self.dut.start.eq(1)
+				yield
+				yield self.dut.start.eq(0)
+				for byte in data:
+					# Hold the data back every so often, as happens when the FIFO ahead runs dry
+					while random.random() < 0.2:
+						yield sink.valid.eq(0)
+						yield
+					yield sink.valid.eq(1)
+					yield sink.data.eq(byte)
+					yield Settle()
+					while not (yield sink.ready):
+						yield
+						yield Settle()
+					yield
+				yield sink.valid.eq(0)
+				# Wait for everything to come out before starting the next image
+				yield Settle()
+				while (yield self.dut.busy) or (yield source.valid):
+					yield
+					yield Settle()
+				yield from self.step(4)
+		domainSink(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSource(self: StreamDecompressorTestCase):
+			random = Random(2)
+			for _, expected in images:
+				result = bytearray()
+				while len(result) < len(expected):
+					ready = random.random() >= 0.2
+					yield source.ready.eq(1 if ready else 0)
+					yield Settle()
+					if ready and (yield source.valid):
+						result.append((yield source.data))
+					yield
+				yield source.ready.eq(0)
+				self.assertEqual(bytes(result), expected)
+		domainSource(self)
+
+	@ToriiTestCase.simulation
+	def testThroughput(self):
+		image = bytes(2000) + b'\x5A\xA5' * 1000
+		compressed = compressImage(image)
+		sink = self.dut.sink
+		source = self.dut.source
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSink(self: StreamDecompressorTestCase):
+			for byte in compressed:
+				yield sink.valid.eq(1)
+				yield sink.data.eq(byte)
+				yield Settle()
+				while not (yield sink.ready):
+					yield
+					yield Settle()
+				yield
+			yield sink.valid.eq(0)
+		domainSink(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSource(self: StreamDecompressorTestCase):
+			yield source.ready.eq(1)
+			result = bytearray()
+			cycles = 0
+			while len(result) < len(image):
+				yield Settle()
+				if (yield source.valid):
+					result.append((yield source.data))
+				cycles += 1
+				yield
+			self.assertEqual(bytes(result), image)
+			# Runs and matches must come out at a byte a cycle, bar a few cycles for each token
+			self.assertLess(cycles, len(image) + 4 * len(compressed))
+		domainSource(self)
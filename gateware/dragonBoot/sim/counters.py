@@ -0,0 +1,51 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from struct import pack
+from torii.test import ToriiTestCase
+
+from ..counters import PerformanceCounter, PerformanceCounters, counterFormat, unpackCounters
+
+class PerformanceCountersTestCase(ToriiTestCase):
+	dut : PerformanceCounters = PerformanceCounters
+	domains = (('sync', 60e6),)
+
+	def testUnpackCounters(self):
+		values = tuple(range(1, len(PerformanceCounter) + 1))
+		counters = unpackCounters(pack(counterFormat, *values))
+		self.assertEqual(counters[PerformanceCounter.flashEraseCycles], 1)
+		self.assertEqual(counters[PerformanceCounter.stalls], len(PerformanceCounter))
+		with self.assertRaises(ValueError):
+			unpackCounters(bytes(4))
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testPerformanceCounters(self):
+		erase = 1 << PerformanceCounter.flashEraseCycles
+		stall = 1 << PerformanceCounter.stalls
+		counts = self.dut.counts
+
+		yield self.dut.events.eq(erase | stall)
+		for _ in range(5):
+			yield
+		yield self.dut.events.eq(erase)
+		for _ in range(3):
+			yield
+		# Nothing is counted while the counters are frozen
+		yield self.dut.freeze.eq(1)
+		for _ in range(4):
+			yield
+		yield self.dut.freeze.eq(0)
+		yield self.dut.events.eq(0)
+		yield
+		self.assertEqual((yield counts[PerformanceCounter.flashEraseCycles]), 8)
+		self.assertEqual((yield counts[PerformanceCounter.stalls]), 5)
+		self.assertEqual((yield counts[PerformanceCounter.bytesReceived]), 0)
+
+		# Clearing takes priority over counting
+		yield self.dut.events.eq(erase)
+		yield self.dut.clear.eq(1)
+		yield
+		yield self.dut.clear.eq(0)
+		yield self.dut.events.eq(0)
+		yield
+		for count in counts:
+			self.assertEqual((yield count), 0)
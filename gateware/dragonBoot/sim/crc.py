@@ -0,0 +1,38 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+from zlib import crc32
+
+from ..crc import CRC32
+
+class CRC32TestCase(ToriiTestCase):
+	dut : CRC32 = CRC32
+	dut_args = {}
+	domains = (('sync', 60e6), )
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testCRC32(self):
+		data = b'123456789' + bytes(range(256))
+		yield
+		yield Settle()
+		self.assertEqual((yield self.dut.value), crc32(b''))
+		yield self.dut.valid.eq(1)
+		for byte in data:
+			yield self.dut.data.eq(byte)
+			yield
+		yield self.dut.valid.eq(0)
+		yield
+		yield Settle()
+		self.assertEqual((yield self.dut.value), crc32(data))
+		# Bytes not marked valid must not be folded in
+		yield self.dut.data.eq(0xA5)
+		yield from self.step(3)
+		yield Settle()
+		self.assertEqual((yield self.dut.value), crc32(data))
+		yield self.dut.reset.eq(1)
+		yield
+		yield self.dut.reset.eq(0)
+		yield
+		yield Settle()
+		self.assertEqual((yield self.dut.value), crc32(b''))
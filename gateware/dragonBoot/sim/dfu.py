@@ -2,13 +2,15 @@
 from torii.hdl import Record
 from torii.hdl.rec import Direction
 from torii.build import Clock
+from torii.sim import Settle
 from torii.test import ToriiTestCase
 from usb_construct.types import USBRequestType, USBRequestRecipient, USBStandardRequests
 from usb_construct.types.descriptors.dfu import DFURequests
 from typing import Tuple, Union
+from struct import pack as structPack
 
 from ..platform import Flash
-from ..dfu import DFURequestHandler, DFUState
+from ..dfu import DFURequestHandler, DFUState, DFUStatus, VendorRequests
 
 bus = Record((
 	('clk', [
@@ -62,16 +64,7 @@ dfuData = (
 	0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
 )
 
-class DFURequestHandlerTestCase(ToriiTestCase):
-	dut : DFURequestHandler = DFURequestHandler
-	dut_args = {
-		'configuration': 1,
-		'interface': 0,
-		'resource': ('flash', 0),
-	}
-	domains = (('usb', 60e6),)
-	platform = Platform()
-
+class DFUTestCase(ToriiTestCase):
 	def setupReceived(self):
 		yield self.setup.received.eq(1)
 		yield from self.settle()
@@ -112,6 +105,10 @@ class DFURequestHandlerTestCase(ToriiTestCase):
 		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
 			request = DFURequests.DOWNLOAD, value = 0, index = 0, length = 256)
 
+	def sendDFUDownloadComplete(self):
+		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+			request = DFURequests.DOWNLOAD, value = 0, index = 0, length = 0)
+
 	def sendDFUGetStatus(self):
 		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = True,
 			request = DFURequests.GET_STATUS, value = 0, index = 0, length = 6)
@@ -171,6 +168,103 @@ class DFURequestHandlerTestCase(ToriiTestCase):
 		assert (yield self.interface.handshakes_out.ack) == 0
 		return result
 
+	def receiveStatus(self):
+		data = bytearray()
+		yield self.tx.ready.eq(1)
+		yield self.interface.data_requested.eq(1)
+		yield
+		yield self.interface.data_requested.eq(0)
+		while (yield self.tx.first) == 0:
+			yield
+		while True:
+			self.assertEqual((yield self.tx.valid), 1)
+			data.append((yield self.tx.data))
+			if (yield self.tx.last):
+				break
+			yield
+		yield self.tx.ready.eq(0)
+		yield
+		yield from self.sendStatus()
+		return bytes(data)
+
+	def completeDownload(self):
+		yield from self.sendDFUDownloadComplete()
+		yield from self.receiveZLP()
+		return (yield from self.pollManifestation())
+
+	def pollManifestation(self):
+		# Poll the status through the manifestation phase till the slot is finalised, as the host would
+		polls = 0
+		while True:
+			yield from self.sendDFUGetStatus()
+			status = yield from self.receiveStatus()
+			self.assertEqual(status[0], DFUStatus.ok)
+			if status[4] == DFUState.dfuIdle:
+				break
+			self.assertEqual(status[4], DFUState.manifest)
+			polls += 1
+			yield from self.step(8)
+		return polls
+
+	def sendDFUUpload(self, *, length : int):
+		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = True,
+			request = DFURequests.UPLOAD, value = 0, index = 0, length = length)
+
+	def receivePacket(self, *, data : bytes, ack = True):
+		yield self.tx.ready.eq(1)
+		# Keep asking for the packet for as long as the handler NAKs, as the host would
+		while True:
+			yield self.interface.data_requested.eq(1)
+			yield Settle()
+			nak = yield self.interface.handshakes_out.nak
+			zlp = (yield self.tx.valid) == 1 and (yield self.tx.last) == 1
+			yield
+			yield self.interface.data_requested.eq(0)
+			if not nak:
+				break
+			yield from self.step(8)
+		if zlp:
+			self.assertEqual(len(data), 0)
+		# The whole packet must go out without a break
+		for idx, value in enumerate(data):
+			yield Settle()
+			self.assertEqual((yield self.tx.valid), 1)
+			self.assertEqual((yield self.tx.first), 1 if idx == 0 else 0)
+			self.assertEqual((yield self.tx.last), 1 if idx == len(data) - 1 else 0)
+			self.assertEqual((yield self.tx.data), value)
+			yield
+		yield Settle()
+		self.assertEqual((yield self.tx.valid), 0)
+		yield self.tx.ready.eq(0)
+		if ack:
+			yield self.interface.handshakes_in.ack.eq(1)
+			yield
+			yield self.interface.handshakes_in.ack.eq(0)
+		yield
+
+	def sendDownloadBlock(self, *, block : int, data : bytes):
+		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+			request = DFURequests.DOWNLOAD, value = block, index = 0, length = len(data))
+		yield from self.sendData(data = data)
+		yield from self.sendDFUGetState()
+		while (yield from self.receiveData(data = (DFUState.downloadBusy,), check = False)):
+			yield from self.sendDFUGetState()
+		yield from self.sendDFUGetStatus()
+		yield from self.receiveData(data = (0, 0, 0, 0, DFUState.downloadSync, 0))
+
+	def sendStreamSlot(self, *, slot : int, offset : int, length : int):
+		yield from self.sendSetup(type = USBRequestType.VENDOR, retrieve = False,
+			request = VendorRequests.streamSlot, value = slot, index = 0, length = 8)
+		yield from self.sendData(data = structPack('<II', offset, length))
+
+	def sendStatus(self):
+		yield self.interface.status_requested.eq(1)
+		yield Settle()
+		self.assertEqual((yield self.interface.handshakes_out.ack), 1)
+		yield
+		yield self.interface.status_requested.eq(0)
+		yield from self.step(2)
+
 	def receiveZLP(self):
 		assert (yield self.tx.valid) == 0
 		assert (yield self.tx.last) == 0
@@ -186,6 +280,16 @@ class DFURequestHandlerTestCase(ToriiTestCase):
 		yield self.interface.handshakes_in.ack.eq(0)
 		yield
 
+class DFURequestHandlerTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = Platform()
+
 	@ToriiTestCase.simulation
 	@ToriiTestCase.sync_domain(domain = 'usb')
 	def testDFURequestHandler(self):
@@ -228,3 +332,1203 @@ class DFURequestHandlerTestCase(ToriiTestCase):
 		yield from self.settle()
 		assert (yield self.dut.triggerReboot) == 1
 		yield
+
+class ManifestationPlatform(Platform):
+	flash = Flash(
+		size = 512 * 1024,
+		pageSize = 64,
+		erasePageSize = 256,
+		eraseCommand = 0x20
+	)
+
+	flash.slots = 4
+	flash.slotSize = 1024
+
+	dfuDoubleBuffer = True
+
+class DFUManifestationTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = ManifestationPlatform()
+
+	def ensureStalled(self):
+		yield self.interface.status_requested.eq(1)
+		yield Settle()
+		self.assertEqual((yield self.interface.handshakes_out.stall), 1)
+		yield
+		yield self.interface.status_requested.eq(0)
+		yield
+
+	@ToriiTestCase.simulation
+	def testMultiSlotSession(self):
+		from .flash import spiFlashModel
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		blocks = (
+			bytes((byte * 5 + 1) & 0xFF for byte in range(256)),
+			bytes((byte * 3 + 7) & 0xFF for byte in range(256)),
+		)
+		memory = {}
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUManifestationTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+
+			# Program slots 1 and 2, which begin at 0x400 and 0x800, one after the other
+			for slot, block in enumerate(blocks, start = 1):
+				yield from self.sendSetup(type = USBRequestType.STANDARD, retrieve = False,
+					request = USBStandardRequests.SET_INTERFACE, value = (slot, 0), index = (0, 0), length = 0)
+				yield from self.receiveZLP()
+				yield from self.step(3)
+				yield from self.sendDFUDownload()
+				yield from self.sendData(data = block)
+				# With the other buffer free, the download can be ended while the block is still being programmed
+				yield from self.sendDFUGetStatus()
+				yield from self.receiveData(data = (0, 0, 0, 0, DFUState.downloadSync, 0))
+				yield from self.sendDFUDownloadComplete()
+				yield from self.receiveZLP()
+				yield from self.sendDFUGetState()
+				yield from self.receiveData(data = (DFUState.manifestSync,))
+
+				# Until the slot is finalised, the next can't be selected and the device can't be detached
+				yield from self.sendSetup(type = USBRequestType.STANDARD, retrieve = False,
+					request = USBStandardRequests.SET_INTERFACE, value = (slot + 1, 0), index = (0, 0), length = 0)
+				yield from self.ensureStalled()
+				yield from self.sendDFUDetach()
+				yield from self.ensureStalled()
+				self.assertEqual((yield self.dut.triggerReboot), 0)
+
+				# The status reports manifestation in progress while the last of the slot is programmed
+				yield from self.sendDFUGetStatus()
+				status = yield from self.receiveStatus()
+				self.assertEqual(status[4], DFUState.manifest)
+				yield from self.pollManifestation()
+				self.assertEqual(bytes(memory.get(0x400 * slot + offset, 0xFF) for offset in range(256)), block)
+
+				# Once finalised, the slot reads back from its start
+				yield from self.sendDFUUpload(length = 64)
+				yield from self.receivePacket(data = block[0:64])
+				yield from self.sendStatus()
+				yield from self.step(8)
+
+			# Only then is the device rebooted, once, at the end of the session
+			yield from self.sendDFUDetach()
+			yield from self.receiveZLP()
+			self.assertEqual((yield self.dut.triggerReboot), 1)
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUManifestationTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
+
+class UploadPlatform(Platform):
+	flash = Flash(
+		size = 512 * 1024,
+		pageSize = 64,
+		erasePageSize = 256,
+		eraseCommand = 0x20
+	)
+
+	flash.slots = 2
+	flash.slotSize = 512
+
+class DFUUploadTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = UploadPlatform()
+
+	@ToriiTestCase.simulation
+	def testDFUUpload(self):
+		from .flash import spiFlashModel
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		slotData = bytes((byte * 7 + 3) & 0xFF for byte in range(256))
+		memory = {0x100 + offset: byte for offset, byte in enumerate(slotData)}
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUUploadTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+			# Select slot 0, which runs from 0x100 to 0x200
+			yield from self.sendSetup(type = USBRequestType.STANDARD, retrieve = False,
+				request = USBStandardRequests.SET_INTERFACE, value = (0, 0), index = (0, 0), length = 0)
+			yield from self.receiveZLP()
+			yield from self.step(3)
+
+			yield from self.sendDFUUpload(length = 192)
+			yield from self.receivePacket(data = slotData[0:64])
+			# Lose the ACK for the second packet - the handler must send the same data again
+			yield from self.receivePacket(data = slotData[64:128], ack = False)
+			yield from self.receivePacket(data = slotData[64:128])
+			yield from self.receivePacket(data = slotData[128:192])
+			yield from self.sendStatus()
+			yield from self.sendDFUGetState()
+			yield from self.receiveData(data = (DFUState.uploadIdle,))
+
+			# Only 64 bytes of the slot remain, so the data phase must be ended short with a ZLP
+			yield from self.sendDFUUpload(length = 256)
+			yield from self.receivePacket(data = slotData[192:256])
+			yield from self.receivePacket(data = b'')
+			yield from self.sendStatus()
+			yield from self.sendDFUGetState()
+			yield from self.receiveData(data = (DFUState.dfuIdle,))
+
+			# And with the slot exhausted, there's no more data to be had
+			yield from self.sendDFUUpload(length = 64)
+			yield from self.receivePacket(data = b'')
+			yield from self.sendStatus()
+			yield from self.sendDFUGetState()
+			yield from self.receiveData(data = (DFUState.dfuIdle,))
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUUploadTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
+
+class DoubleBufferPlatform(Platform):
+	dfuDoubleBuffer = True
+
+class DFUDoubleBufferTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = DoubleBufferPlatform()
+
+	@ToriiTestCase.simulation
+	def testDoubleBuffer(self):
+		from .flash import spiFlashModel
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		blocks = (
+			bytes((byte * 5 + 1) & 0xFF for byte in range(256)),
+			bytes((byte * 3 + 7) & 0xFF for byte in range(256)),
+		)
+		memory = {}
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUDoubleBufferTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+			# Select slot 1, which begins at 0x40000
+			yield from self.sendSetupSetInterface()
+			yield from self.receiveZLP()
+			yield from self.step(3)
+
+			# With the other buffer free, the first block must not hold the host up
+			yield from self.sendDFUDownload()
+			yield from self.sendData(data = blocks[0])
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0, 0, 0, DFUState.downloadSync, 0))
+			yield from self.sendDFUGetState()
+			yield from self.receiveData(data = (DFUState.downloadIdle,))
+
+			# The second block fills the other buffer while the first is still being programmed
+			yield from self.sendDFUDownload()
+			yield from self.sendData(data = blocks[1])
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0, 0, 0, DFUState.downloadBusy, 0))
+			yield from self.sendDFUGetState()
+			while (yield from self.receiveData(data = (DFUState.downloadBusy,), check = False)):
+				yield from self.sendDFUGetState()
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0, 0, 0, DFUState.downloadSync, 0))
+
+			# Manifestation must wait for the second block to make it into the Flash
+			self.assertGreater((yield from self.completeDownload()), 0)
+			yield from self.sendDFUGetState()
+			yield from self.receiveData(data = (DFUState.dfuIdle,))
+			self.assertEqual(bytes(memory.get(0x40000 + offset, 0xFF) for offset in range(512)), blocks[0] + blocks[1])
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUDoubleBufferTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
+
+class VerifyPlatform(Platform):
+	flashVerify = True
+
+class DFUVerifyTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = VerifyPlatform()
+
+	@ToriiTestCase.simulation
+	def testVerifyFailure(self):
+		from .flash import spiFlashModel
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		block = bytes((byte * 5 + 1) & 0xFF for byte in range(256))
+		# A byte the (ignored) erase fails to clear, so it reads back wrong once programmed
+		memory = {0x40000 + 10: 0x00}
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUVerifyTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+			yield from self.sendSetupSetInterface()
+			yield from self.receiveZLP()
+			yield from self.step(3)
+
+			yield from self.sendDFUDownload()
+			yield from self.sendData(data = block)
+			yield from self.sendDFUGetState()
+			while (yield from self.receiveData(data = (DFUState.downloadBusy,), check = False)):
+				yield from self.sendDFUGetState()
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (DFUStatus.errVERIFY, 0, 0, 0, DFUState.error, 0))
+			self.assertNotEqual(memory[0x40000 + 10], block[10])
+
+			# Clearing the status returns the handler to idle, ready for the host to try again
+			yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+				request = DFURequests.CLR_STATUS, value = 0, index = 0, length = 0)
+			yield from self.receiveZLP()
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0, 0, 0, DFUState.dfuIdle, 0))
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUVerifyTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
+
+class PreErasePlatform(Platform):
+	flash = Flash(
+		size = 512 * 1024,
+		pageSize = 64,
+		erasePageSize = 256,
+		eraseCommand = 0x20,
+		blockEraseCommands = {
+			64 * 1024: 0xD8,
+		},
+		part = 'W25Q16JV'
+	)
+
+	flash.slots = 4
+	flash.slotSize = 2 ** 18
+
+	dfuPreErase = True
+
+class DFUPreEraseTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = PreErasePlatform()
+
+	def sendEraseSlot(self):
+		yield from self.sendSetup(type = USBRequestType.VENDOR, retrieve = False,
+			request = VendorRequests.eraseSlot, value = 0, index = 0, length = 0)
+
+	@ToriiTestCase.simulation
+	def testPreErase(self):
+		from .flash import spiFlashModel, spiMonitor
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		block = bytes((byte * 5 + 1) & 0xFF for byte in range(256))
+		memory = {}
+		transactions = []
+
+		def erases():
+			return [txn[0] for txn in transactions if txn[0][0] in (0x20, 0xD8)]
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUPreEraseTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+			# Selecting slot 1 starts it being erased, with 4 64KiB block erases of 150ms each left to go
+			yield from self.sendSetupSetInterface()
+			yield from self.receiveZLP()
+			yield from self.step(3)
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0x58, 0x02, 0, DFUState.downloadBusy, 0))
+
+			# A download sent while the slot is being erased must wait for the erase to complete
+			yield from self.sendDFUDownload()
+			yield from self.sendData(data = block)
+			yield from self.sendDFUGetState()
+			while (yield from self.receiveData(data = (DFUState.downloadBusy,), check = False)):
+				yield from self.sendDFUGetState()
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0, 0, 0, DFUState.downloadSync, 0))
+			yield from self.completeDownload()
+			yield from self.sendDFUGetState()
+			yield from self.receiveData(data = (DFUState.dfuIdle,))
+			self.assertEqual(erases(), [bytes((0xD8, address, 0x00, 0x00)) for address in range(0x04, 0x08)])
+			self.assertEqual(bytes(memory.get(0x40000 + offset, 0xFF) for offset in range(256)), block)
+
+			# The slot can also be erased on request, which starts again from the beginning of the slot
+			transactions.clear()
+			yield from self.sendEraseSlot()
+			yield from self.receiveZLP()
+			yield from self.step(3)
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0x58, 0x02, 0, DFUState.downloadBusy, 0))
+			# Once the erase completes, the state goes back to idle
+			yield from self.sendDFUGetState()
+			while (yield from self.receiveData(data = (DFUState.downloadBusy,), check = False)):
+				yield from self.sendDFUGetState()
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0, 0, 0, DFUState.dfuIdle, 0))
+			self.assertEqual(erases(), [bytes((0xD8, address, 0x00, 0x00)) for address in range(0x04, 0x08)])
+
+			# Selecting slot 0, which holds the bootloader, must leave it alone
+			transactions.clear()
+			yield from self.sendSetup(type = USBRequestType.STANDARD, retrieve = False,
+				request = USBStandardRequests.SET_INTERFACE, value = (0, 0), index = (0, 0), length = 0)
+			yield from self.receiveZLP()
+			yield from self.step(3)
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0, 0, 0, DFUState.dfuIdle, 0))
+			self.assertEqual(erases(), [])
+
+			# And as selecting a slot would erase it, uploads are refused
+			yield from self.sendDFUUpload(length = 64)
+			yield self.interface.data_requested.eq(1)
+			yield Settle()
+			self.assertEqual((yield self.interface.handshakes_out.stall), 1)
+			yield
+			yield self.interface.data_requested.eq(0)
+			yield
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainMonitor(self: DFUPreEraseTestCase):
+			yield from spiMonitor(transactions, bus)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUPreEraseTestCase):
+			yield from spiFlashModel(memory, bus, eraseCycles = 2000)
+		domainFlash(self)
+
+class FlashDomainPlatform(UploadPlatform):
+	flashClockFreq = 100e6
+
+class DFUFlashDomainTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6), ('flash', 100e6))
+	platform = FlashDomainPlatform()
+
+	@ToriiTestCase.simulation
+	def testFlashDomain(self):
+		from .flash import spiFlashModel
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		slotData = bytes((byte * 7 + 3) & 0xFF for byte in range(256))
+		block = bytes((byte * 5 + 1) & 0xFF for byte in range(256))
+		memory = {0x100 + offset: byte for offset, byte in enumerate(slotData)}
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUFlashDomainTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			# The Flash is given its reset timings in real time here, rather than in cycles of a 12MHz clock
+			yield from self.wait_for(50e-6)
+			yield from self.step(2)
+			yield from self.sendSetup(type = USBRequestType.STANDARD, retrieve = False,
+				request = USBStandardRequests.SET_INTERFACE, value = (0, 0), index = (0, 0), length = 0)
+			yield from self.receiveZLP()
+			yield from self.step(3)
+
+			# Reads are run in the Flash domain and streamed back over to the USB domain
+			yield from self.sendDFUUpload(length = 128)
+			yield from self.receivePacket(data = slotData[0:64])
+			yield from self.receivePacket(data = slotData[64:128])
+			yield from self.sendStatus()
+			yield from self.sendDFUGetState()
+			yield from self.receiveData(data = (DFUState.uploadIdle,))
+
+			# As are downloads, with the Flash domain telling the USB domain when it has finished. The Flash model
+			# doesn't apply erases, so do that for it
+			memory.clear()
+			yield from self.sendDFUDownload()
+			yield from self.sendData(data = block)
+			yield from self.sendDFUGetState()
+			while (yield from self.receiveData(data = (DFUState.downloadBusy,), check = False)):
+				yield from self.sendDFUGetState()
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0, 0, 0, DFUState.downloadSync, 0))
+			yield from self.completeDownload()
+			self.assertEqual(bytes(memory[0x100 + offset] for offset in range(256)), block)
+
+			# Selecting the slot again must take reads back to its start
+			yield from self.sendSetup(type = USBRequestType.STANDARD, retrieve = False,
+				request = USBStandardRequests.SET_INTERFACE, value = (0, 0), index = (0, 0), length = 0)
+			yield from self.receiveZLP()
+			yield from self.step(3)
+			yield from self.sendDFUUpload(length = 64)
+			yield from self.receivePacket(data = block[0:64])
+			yield from self.sendStatus()
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'flash')
+		def domainFlash(self: DFUFlashDomainTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
+
+class TransferSizePlatform(Platform):
+	dfuTransferSize = 512
+
+class DFUTransferSizeTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = TransferSizePlatform()
+
+	def testTransferSizeLimits(self):
+		self.assertEqual(DFURequestHandler.transferSize(Platform()), 256)
+		self.assertEqual(DFURequestHandler.transferSize(self.platform), 512)
+		for transferSize in (128, 768, 64 * 1024):
+			class BadPlatform(Platform):
+				dfuTransferSize = transferSize
+			with self.assertRaises(ValueError):
+				DFURequestHandler.transferSize(BadPlatform())
+
+	@ToriiTestCase.simulation
+	def testTransferSize(self):
+		from .flash import spiFlashModel, spiMonitor
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		block = bytes((byte * 5 + 1) & 0xFF for byte in range(512))
+		memory = {}
+		transactions = []
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUTransferSizeTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+			yield from self.sendSetupSetInterface()
+			yield from self.receiveZLP()
+			yield from self.step(3)
+
+			# A request spanning two sectors is handed to the SPI Flash engine a sector at a time
+			yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+				request = DFURequests.DOWNLOAD, value = 0, index = 0, length = 512)
+			yield from self.sendData(data = block)
+			yield from self.sendDFUGetState()
+			while (yield from self.receiveData(data = (DFUState.downloadBusy,), check = False)):
+				yield from self.sendDFUGetState()
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0, 0, 0, DFUState.downloadSync, 0))
+			yield from self.completeDownload()
+			erases = [txn[0] for txn in transactions if txn[0][0] == 0x20]
+			self.assertEqual(erases, [bytes((0x20, 0x04, 0x00, 0x00)), bytes((0x20, 0x04, 0x01, 0x00))])
+			self.assertEqual(bytes(memory.get(0x40000 + offset, 0xFF) for offset in range(512)), block)
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainMonitor(self: DFUTransferSizeTestCase):
+			yield from spiMonitor(transactions, bus)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUTransferSizeTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
+
+class StreamPlatform(Platform):
+	dfuStreaming = True
+
+class DFUStreamTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = StreamPlatform()
+
+	@ToriiTestCase.simulation
+	def testStream(self):
+		from .flash import spiFlashModel, spiMonitor
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		streamData = self.dut.streamData
+		block = bytes((byte * 5 + 1) & 0xFF for byte in range(512))
+		memory = {}
+		transactions = []
+		streamStarted = []
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUStreamTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+
+			# Stream two sectors into slot 1 (which begins at 0x40000), a sector into it
+			yield from self.sendStreamSlot(slot = 1, offset = 0x100, length = 512)
+			yield from self.step(4)
+			yield from self.sendDFUGetState()
+			yield from self.receiveData(data = (DFUState.downloadBusy,))
+			streamStarted.append(True)
+			yield from self.sendDFUGetState()
+			while (yield from self.receiveData(data = (DFUState.downloadBusy,), check = False)):
+				yield from self.sendDFUGetState()
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0, 0, 0, DFUState.dfuIdle, 0))
+			erases = [txn[0] for txn in transactions if txn[0][0] == 0x20]
+			self.assertEqual(erases, [bytes((0x20, 0x04, 0x01, 0x00)), bytes((0x20, 0x04, 0x02, 0x00))])
+			self.assertEqual(bytes(memory.get(0x40100 + offset, 0xFF) for offset in range(512)), block)
+			self.assertNotIn(0x40000, memory)
+
+			# Streams that don't fit in the slot, or don't start on a sector boundary, must be refused
+			for offset, length in ((0x3FF00, 512), (0x80, 256), (0, 0)):
+				yield from self.sendStreamSlot(slot = 1, offset = offset, length = length)
+				yield from self.step(4)
+				yield from self.sendDFUGetStatus()
+				yield from self.receiveData(data = (DFUStatus.errADDRESS, 0, 0, 0, DFUState.error, 0))
+				yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+					request = DFURequests.CLR_STATUS, value = 0, index = 0, length = 0)
+				yield from self.receiveZLP()
+				yield from self.sendDFUGetState()
+				yield from self.receiveData(data = (DFUState.dfuIdle,))
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainStream(self: DFUStreamTestCase):
+			# Anything sent before the stream is set up is thrown away
+			yield Settle()
+			self.assertEqual((yield streamData.ready), 1)
+			while not streamStarted:
+				yield
+			for byte in block:
+				yield streamData.valid.eq(1)
+				yield streamData.data.eq(byte)
+				yield Settle()
+				while not (yield streamData.ready):
+					yield
+					yield Settle()
+				yield
+			yield streamData.valid.eq(0)
+		domainStream(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainMonitor(self: DFUStreamTestCase):
+			yield from spiMonitor(transactions, bus)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUStreamTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
+
+class CompressionPlatform(Platform):
+	dfuCompression = True
+
+class DFUCompressionTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = CompressionPlatform()
+
+	def sendDownload(self, data : bytes):
+		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+			request = DFURequests.DOWNLOAD, value = 0, index = 0, length = len(data))
+		yield from self.sendData(data = data)
+		yield from self.sendDFUGetState()
+		while (yield from self.receiveData(data = (DFUState.downloadBusy,), check = False)):
+			yield from self.sendDFUGetState()
+		yield from self.sendDFUGetStatus()
+		yield from self.receiveData(data = (0, 0, 0, 0, DFUState.downloadSync, 0))
+
+	def sendDownloadComplete(self):
+		yield from self.completeDownload()
+		yield from self.sendDFUGetState()
+		yield from self.receiveData(data = (DFUState.dfuIdle,))
+
+	@ToriiTestCase.simulation
+	def testCompression(self):
+		from .flash import spiFlashModel
+		from ..compression import compressImage
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		image = bytes(300) + b'\x12\x34\x56\x78' * 60 + bytes((byte * 5 + 1) & 0xFF for byte in range(100)) + bytes(60)
+		compressed = compressImage(image)
+		rawImage = bytes((byte * 3 + 7) & 0xFF for byte in range(300))
+		memory = {}
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUCompressionTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+			yield from self.sendSetupSetInterface()
+			yield from self.receiveZLP()
+			yield from self.step(3)
+
+			# A compressed image spread over two requests, split mid-token, decompresses to more than 2 sectors
+			self.assertLess(len(compressed), 256)
+			yield from self.sendDownload(compressed[:len(compressed) // 2])
+			yield from self.sendDownload(compressed[len(compressed) // 2:])
+			# The end of the image doesn't fill a sector, so is only programmed once the download is complete
+			yield from self.sendDownloadComplete()
+			self.assertEqual(bytes(memory.get(0x40000 + offset, 0xFF) for offset in range(len(image))), image)
+
+			# Images that aren't compressed still download as normal
+			memory.clear()
+			yield from self.sendSetupSetInterface()
+			yield from self.receiveZLP()
+			yield from self.step(3)
+			yield from self.sendDownload(rawImage[:256])
+			yield from self.sendDownload(rawImage[256:])
+			yield from self.sendDownloadComplete()
+			self.assertEqual(bytes(memory.get(0x40000 + offset, 0xFF) for offset in range(len(rawImage))), rawImage)
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUCompressionTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
+
+class SmallSlotCompressionPlatform(UploadPlatform):
+	dfuCompression = True
+
+class DFUCompressionOverflowTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = SmallSlotCompressionPlatform()
+
+	@ToriiTestCase.simulation
+	def testOverflow(self):
+		from .flash import spiFlashModel
+		from ..compression import compressImage
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		# Slot 1 runs from 0x200 to 0x400, so this expands to twice what it can hold
+		image = bytes((byte // 64) & 0xFF for byte in range(1024))
+		compressed = compressImage(image)
+		memory = {}
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUCompressionOverflowTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+			yield from self.sendSetupSetInterface()
+			yield from self.receiveZLP()
+			yield from self.step(3)
+
+			self.assertLess(len(compressed), 256)
+			yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+				request = DFURequests.DOWNLOAD, value = 0, index = 0, length = len(compressed))
+			yield from self.sendData(data = compressed)
+			yield from self.sendDFUGetState()
+			while (yield from self.receiveData(data = (DFUState.downloadBusy,), check = False)):
+				yield from self.sendDFUGetState()
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (DFUStatus.errADDRESS, 0, 0, 0, DFUState.error, 0))
+			# What fits is still programmed once the Flash catches up, but nothing past the end of the slot
+			yield from self.wait_for(200e-6)
+			self.assertEqual(bytes(memory.get(0x200 + offset, 0xFF) for offset in range(512)), image[:512])
+			self.assertFalse(any(address >= 0x400 for address in memory))
+			yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+				request = DFURequests.CLR_STATUS, value = 0, index = 0, length = 0)
+			yield from self.receiveZLP()
+			yield from self.sendDFUGetState()
+			yield from self.receiveData(data = (DFUState.dfuIdle,))
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUCompressionOverflowTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
+
+class AddressedPlatform(Platform):
+	dfuAddressed = True
+
+class DFUAddressedTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = AddressedPlatform()
+
+	def testAddressedCompression(self):
+		class BadPlatform(AddressedPlatform):
+			dfuCompression = True
+		with self.assertRaises(ValueError):
+			DFURequestHandler(configuration = 1, interface = 0, resource = ('flash', 0)).elaborate(BadPlatform())
+
+	@ToriiTestCase.simulation
+	def testAddressed(self):
+		from .flash import spiFlashModel, spiMonitor
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		blocks = [bytes((byte * 5 + index) & 0xFF for byte in range(256)) for index in range(3)]
+		# The second block already holds the right data, so the host skips it
+		memory = {0x40100 + offset: byte for offset, byte in enumerate(blocks[1])}
+		transactions = []
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUAddressedTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+			yield from self.sendSetupSetInterface()
+			yield from self.receiveZLP()
+			yield from self.step(3)
+
+			yield from self.sendDownloadBlock(block = 0, data = blocks[0])
+			yield from self.sendDownloadBlock(block = 2, data = blocks[2])
+			# Going back to resend a block has it erased and programmed again
+			yield from self.sendDownloadBlock(block = 0, data = blocks[0])
+			yield from self.completeDownload()
+			erases = [txn[0] for txn in transactions if txn[0][0] == 0x20]
+			self.assertEqual(erases, [
+				bytes((0x20, 0x04, 0x00, 0x00)), bytes((0x20, 0x04, 0x02, 0x00)), bytes((0x20, 0x04, 0x00, 0x00))
+			])
+			self.assertEqual(bytes(memory.get(0x40000 + offset, 0xFF) for offset in range(768)), b''.join(blocks))
+
+			# A block that would run past the end of the slot is refused
+			transactions.clear()
+			yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+				request = DFURequests.DOWNLOAD, value = 0x400, index = 0, length = 256)
+			yield self.interface.status_requested.eq(1)
+			yield Settle()
+			self.assertEqual((yield self.interface.handshakes_out.stall), 1)
+			yield
+			yield self.interface.status_requested.eq(0)
+			yield
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (DFUStatus.errADDRESS, 0, 0, 0, DFUState.error, 0))
+			yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+				request = DFURequests.CLR_STATUS, value = 0, index = 0, length = 0)
+			yield from self.receiveZLP()
+			yield from self.sendDFUGetState()
+			yield from self.receiveData(data = (DFUState.dfuIdle,))
+			self.assertEqual(transactions, [])
+
+			# While the last block of the slot is fine
+			yield from self.sendDownloadBlock(block = 0x3FF, data = blocks[0])
+			self.assertEqual(bytes(memory.get(0x7FF00 + offset, 0xFF) for offset in range(256)), blocks[0])
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainMonitor(self: DFUAddressedTestCase):
+			yield from spiMonitor(transactions, bus)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUAddressedTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
+
+class StreamAddressedPlatform(Platform):
+	dfuStreaming = True
+	dfuAddressed = True
+
+class DFUStreamAddressedTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = StreamAddressedPlatform()
+
+	@ToriiTestCase.simulation
+	def testStreamThenAddressed(self):
+		from .flash import spiFlashModel
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		streamData = self.dut.streamData
+		streamed = bytes((byte * 5 + 1) & 0xFF for byte in range(256))
+		downloaded = bytes((byte * 3 + 2) & 0xFF for byte in range(256))
+		memory = {}
+		streamStarted = []
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUStreamAddressedTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+
+			# Stream a sector into slot 1 a sector in from its start
+			yield from self.sendStreamSlot(slot = 1, offset = 0x100, length = 256)
+			yield from self.step(4)
+			streamStarted.append(True)
+			yield from self.sendDFUGetState()
+			while (yield from self.receiveData(data = (DFUState.downloadBusy,), check = False)):
+				yield from self.sendDFUGetState()
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (0, 0, 0, 0, DFUState.dfuIdle, 0))
+
+			# Block 0 must still land at the start of the slot rather than at the stream's offset
+			yield from self.sendDownloadBlock(block = 0, data = downloaded)
+			yield from self.completeDownload()
+			self.assertEqual(bytes(memory.get(0x40000 + offset, 0xFF) for offset in range(256)), downloaded)
+			self.assertEqual(bytes(memory.get(0x40100 + offset, 0xFF) for offset in range(256)), streamed)
+
+			# And an upload must read the slot back from its start
+			slotData = downloaded + streamed
+			for start in (0, 256):
+				yield from self.sendDFUUpload(length = 256)
+				for packet in range(start, start + 256, 64):
+					yield from self.receivePacket(data = slotData[packet:packet + 64])
+				yield from self.sendStatus()
+			yield from self.sendDFUGetState()
+			yield from self.receiveData(data = (DFUState.uploadIdle,))
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainStream(self: DFUStreamAddressedTestCase):
+			while not streamStarted:
+				yield
+			for byte in streamed:
+				yield streamData.valid.eq(1)
+				yield streamData.data.eq(byte)
+				yield Settle()
+				while not (yield streamData.ready):
+					yield
+					yield Settle()
+				yield
+			yield streamData.valid.eq(0)
+		domainStream(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUStreamAddressedTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
+
+class CountersPlatform(Platform):
+	dfuCounters = True
+
+class DFUCountersTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = CountersPlatform()
+
+	def readCounters(self):
+		from ..counters import unpackCounters, counterFormat
+		from struct import calcsize
+
+		yield from self.sendSetup(type = USBRequestType.VENDOR, retrieve = True,
+			request = VendorRequests.readCounters, value = 0, index = 0, length = calcsize(counterFormat))
+		data = bytearray()
+		yield self.tx.ready.eq(1)
+		yield self.interface.data_requested.eq(1)
+		yield
+		yield self.interface.data_requested.eq(0)
+		while (yield self.tx.first) == 0:
+			yield
+		while True:
+			self.assertEqual((yield self.tx.valid), 1)
+			data.append((yield self.tx.data))
+			if (yield self.tx.last):
+				break
+			yield
+		yield self.tx.ready.eq(0)
+		yield
+		yield from self.sendStatus()
+		return unpackCounters(bytes(data))
+
+	@ToriiTestCase.simulation
+	def testCounters(self):
+		from .flash import spiFlashModel
+		from ..counters import PerformanceCounter
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		block = bytes((byte * 5 + 1) & 0xFF for byte in range(256))
+		memory = {}
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUCountersTestCase):
+			yield self.interface.active_config.eq(1)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+			yield from self.sendSetupSetInterface()
+			yield from self.receiveZLP()
+			yield from self.step(3)
+
+			yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+				request = DFURequests.DOWNLOAD, value = 0, index = 0, length = len(block))
+			yield from self.sendData(data = block)
+			statusRequests = 0
+			while True:
+				yield from self.sendDFUGetStatus()
+				statusRequests += 1
+				if not (yield from self.receiveData(data = (0, 0, 0, 0, DFUState.downloadSync, 0), check = False)):
+					continue
+				break
+			# Each of the status requests polling through manifestation counts too
+			statusRequests += 1 + (yield from self.completeDownload())
+			# A request the handler doesn't know is stalled
+			yield from self.sendSetup(type = USBRequestType.VENDOR, retrieve = False,
+				request = 0x7F, value = 0, index = 0, length = 0)
+			yield self.interface.status_requested.eq(1)
+			yield
+			yield self.interface.status_requested.eq(0)
+			yield
+
+			counters = yield from self.readCounters()
+			self.assertEqual(counters[PerformanceCounter.bytesReceived], len(block))
+			self.assertEqual(counters[PerformanceCounter.downloadRequests], 2)
+			self.assertEqual(counters[PerformanceCounter.getStatusRequests], statusRequests)
+			self.assertEqual(counters[PerformanceCounter.stalls], 1)
+			self.assertGreater(counters[PerformanceCounter.flashEraseCycles], 0)
+			self.assertGreater(counters[PerformanceCounter.flashProgramCycles], 0)
+			self.assertGreater(counters[PerformanceCounter.flashIdleCycles], 0)
+			self.assertEqual(bytes(memory.get(0x40000 + offset, 0xFF) for offset in range(256)), block)
+
+			# Resetting the counters sets them all back to 0
+			yield from self.sendSetup(type = USBRequestType.VENDOR, retrieve = False,
+				request = VendorRequests.resetCounters, value = 0, index = 0, length = 0)
+			yield from self.receiveZLP()
+			counters = yield from self.readCounters()
+			self.assertEqual(set(counters.values()), {0})
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUCountersTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
+
+class TracePlatform(Platform):
+	dfuTrace = True
+
+class DFUTraceTestCase(DFUTestCase):
+	dut : DFURequestHandler = DFURequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0,
+		'resource': ('flash', 0),
+	}
+	domains = (('usb', 60e6),)
+	platform = TracePlatform()
+
+	def readTrace(self, entry : int, length : int):
+		yield from self.sendSetup(type = USBRequestType.VENDOR, retrieve = True,
+			request = VendorRequests.readTrace, value = entry, index = 0, length = length)
+		data = bytearray()
+		yield self.tx.ready.eq(1)
+		yield self.interface.data_requested.eq(1)
+		yield
+		yield self.interface.data_requested.eq(0)
+		while (yield self.tx.first) == 0:
+			yield
+		while True:
+			self.assertEqual((yield self.tx.valid), 1)
+			data.append((yield self.tx.data))
+			if (yield self.tx.last):
+				break
+			yield
+		yield self.tx.ready.eq(0)
+		yield
+		yield from self.sendStatus()
+		return bytes(data)
+
+	@ToriiTestCase.simulation
+	def testTrace(self):
+		from .flash import spiFlashModel
+		from ..trace import TraceEvent, unpackTrace, traceToChrome
+
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+		block = bytes((byte * 3 + 7) & 0xFF for byte in range(256))
+		memory = {}
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: DFUTraceTestCase):
+			yield self.interface.active_config.eq(1)
+			yield self.dut.busReset.eq(1)
+			yield
+			yield self.dut.busReset.eq(0)
+			yield from self.settle()
+			yield
+			yield from self.wait_until_low(bus.cs.o)
+			yield from self.wait_for(20e-6)
+			yield from self.step(2)
+			yield from self.sendSetupSetInterface()
+			yield from self.receiveZLP()
+			yield from self.step(3)
+
+			yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+				request = DFURequests.DOWNLOAD, value = 0, index = 0, length = len(block))
+			yield from self.sendData(data = block)
+			while True:
+				# Poll as a host would, rather than as fast as possible, so as not to fill the buffer
+				yield from self.wait_for(50e-6)
+				yield from self.sendDFUGetStatus()
+				if not (yield from self.receiveData(data = (0, 0, 0, 0, DFUState.downloadSync, 0), check = False)):
+					continue
+				break
+			yield from self.completeDownload()
+			self.assertEqual(bytes(memory.get(0x40000 + offset, 0xFF) for offset in range(256)), block)
+
+			# Reads must fit in a single packet
+			yield from self.sendSetup(type = USBRequestType.VENDOR, retrieve = True,
+				request = VendorRequests.readTrace, value = 0, index = 0, length = 65)
+			yield self.interface.data_requested.eq(1)
+			yield Settle()
+			self.assertEqual((yield self.interface.handshakes_out.stall), 1)
+			yield
+			yield self.interface.data_requested.eq(0)
+			yield
+
+			# Read back the whole buffer, a packet's worth of entries at a time
+			dump = b''
+			for entry in range(0, 256, 8):
+				dump += yield from self.readTrace(entry, 64)
+			entries = unpackTrace(dump)
+			events = [entry['event'] for entry in entries]
+			self.assertIn(TraceEvent.busReset, events)
+			self.assertIn(TraceEvent.flashStart, events)
+			self.assertIn(TraceEvent.flashDone, events)
+			setups = [entry['data'] & 0xFF for entry in entries if entry['event'] == TraceEvent.setup]
+			self.assertEqual(setups[0:2], [USBStandardRequests.SET_INTERFACE, DFURequests.DOWNLOAD])
+			states = [entry['data'] & 0xF for entry in entries if entry['event'] == TraceEvent.dfuState]
+			self.assertEqual(states, [DFUState.dfuIdle, DFUState.downloadBusy, DFUState.downloadSync,
+				DFUState.downloadIdle, DFUState.manifestSync, DFUState.dfuIdle])
+			timestamps = [entry['timestamp'] for entry in entries]
+			self.assertEqual(timestamps, sorted(timestamps))
+
+			# The flash operation shows up as a span in the timeline
+			timeline = traceToChrome(dump)['traceEvents']
+			self.assertIn('program', [event['name'] for event in timeline if event['ph'] == 'X'])
+
+			# Reads of less than a whole entry only return what was asked for
+			self.assertEqual((yield from self.readTrace(0, 3)), dump[0:3])
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainFlash(self: DFUTraceTestCase):
+			yield from spiFlashModel(memory, bus)
+		domainFlash(self)
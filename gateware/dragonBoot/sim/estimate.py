@@ -0,0 +1,90 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from unittest import TestCase
+
+from ..dfu import DFURequestHandler
+from ..estimate import estimateProgramming, stripDFUSuffix, fullSpeed
+from ..parts import lookupFlashPart
+from ..platforms.tinyFPGABX import TinyFPGABXPlatform
+
+class DoubleBufferPlatform(TinyFPGABXPlatform):
+	dfuDoubleBuffer = True
+
+class DifferentialPlatform(TinyFPGABXPlatform):
+	flashDifferential = True
+
+class PreErasePlatform(TinyFPGABXPlatform):
+	dfuPreErase = True
+
+class FlashClockPlatform(TinyFPGABXPlatform):
+	flashClockFreq = 48e6
+
+class LargeTransferPlatform(TinyFPGABXPlatform):
+	dfuTransferSize = 8192
+
+class EstimateTestCase(TestCase):
+	def testFlashParts(self):
+		part = lookupFlashPart('at25sf081')
+		self.assertIs(lookupFlashPart(0x1F8501), part)
+		flash = TinyFPGABXPlatform.flash
+		self.assertIs(flash.part, part)
+		self.assertEqual(flash.eraseTime, part.sectorEraseTime)
+		self.assertEqual(flash.eraseTimes[64 * 1024], part.blockEraseTimes[64 * 1024])
+		with self.assertRaises(KeyError):
+			lookupFlashPart('AT25SF999')
+
+	def testEstimate(self):
+		platform = TinyFPGABXPlatform()
+		estimate = estimateProgramming(platform, 100000)
+		self.assertIs(estimate.speed, fullSpeed)
+		self.assertEqual(estimate.transfers, 25)
+		# The slot is 64KiB aligned, so the image's 25 sectors are erased with two 64KiB block erases
+		self.assertEqual(estimate.erases, {4096: 0, 32 * 1024: 0, 64 * 1024: 2})
+		self.assertAlmostEqual(estimate.phases['Flash erase'], 0.3, places = 2)
+		flashTime = estimate.phases['Flash erase'] + estimate.phases['Flash program']
+		self.assertGreater(estimate.total, flashTime)
+		self.assertLess(estimate.total, flashTime + estimate.phases['USB data'] + estimate.phases['Host scheduling'])
+
+		# Double buffering overlaps receiving each request with programming the last
+		doubleBuffered = estimateProgramming(DoubleBufferPlatform(), 100000)
+		self.assertLess(doubleBuffered.total, estimate.total)
+
+		# Differential programming can only use sector erases
+		differential = estimateProgramming(DifferentialPlatform(), 100000)
+		self.assertEqual(differential.erases, {4096: 25})
+		self.assertGreater(differential.phases['Flash compare'], 0)
+
+		# Pre-erasing erases the whole slot, not just what the image needs
+		preErased = estimateProgramming(PreErasePlatform(), 100000)
+		self.assertEqual(preErased.erases[64 * 1024], platform.flash.slotSize // (64 * 1024))
+		self.assertGreater(preErased.phases['Flash erase'], estimate.phases['Flash erase'])
+
+		# Smaller transfers only erase as the data crosses into sectors not yet erased
+		smallTransfers = estimateProgramming(platform, 100000, transferSize = 1000)
+		self.assertEqual(smallTransfers.transfers, 100)
+		self.assertEqual(smallTransfers.erases, estimate.erases)
+		self.assertAlmostEqual(smallTransfers.phases['Flash erase'], estimate.phases['Flash erase'])
+		self.assertGreater(smallTransfers.phases['Flash program'], estimate.phases['Flash program'])
+		with self.assertRaises(ValueError):
+			estimateProgramming(platform, 100000, transferSize = DFURequestHandler.transferSize(platform) + 1)
+
+		# Requests of more than one sector save on control transfers
+		largeTransfers = estimateProgramming(LargeTransferPlatform(), 100000)
+		self.assertEqual(largeTransfers.transfers, 13)
+		self.assertEqual(largeTransfers.erases, estimate.erases)
+		self.assertLess(largeTransfers.total, estimate.total)
+
+		# Running the Flash from its own faster clock speeds up the SPI bus
+		fastFlash = estimateProgramming(FlashClockPlatform(), 100000)
+		self.assertEqual(fastFlash.sckFreq, 4 * estimate.sckFreq)
+		self.assertLess(fastFlash.phases['Flash program'], estimate.phases['Flash program'])
+
+		with self.assertRaises(ValueError):
+			estimateProgramming(platform, platform.flash.slotSize + 1)
+		with self.assertRaises(ValueError):
+			estimateProgramming(platform, 1, slot = 0)
+
+	def testDFUSuffix(self):
+		image = bytes(range(256))
+		suffix = b'\xFF\xFF\xFF\xFF\xFF\xFF\x00\x01UFD\x10\x00\x00\x00\x00'
+		self.assertEqual(stripDFUSuffix(image + suffix), image)
+		self.assertEqual(stripDFUSuffix(image), image)
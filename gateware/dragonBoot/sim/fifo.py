@@ -0,0 +1,74 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+
+from ..fifo import RewindFIFO
+
+class RewindFIFOTestCase(ToriiTestCase):
+	dut : RewindFIFO = RewindFIFO
+	dut_args = {
+		'width': 8,
+		'depth': 8,
+		'r_domain': 'sync',
+		'w_domain': 'sync',
+	}
+	domains = (('sync', 60e6), )
+
+	def write(self, data):
+		yield self.dut.w_en.eq(1)
+		for byte in data:
+			yield Settle()
+			self.assertEqual((yield self.dut.w_rdy), 1)
+			yield self.dut.w_data.eq(byte)
+			yield
+		yield self.dut.w_en.eq(0)
+		yield
+
+	def read(self, data, commit):
+		yield self.dut.r_commit.eq(commit)
+		for byte in data:
+			yield Settle()
+			self.assertEqual((yield self.dut.r_rdy), 1)
+			self.assertEqual((yield self.dut.r_data), byte)
+			yield self.dut.r_en.eq(1)
+			yield
+			yield self.dut.r_en.eq(0)
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testRewindFIFO(self):
+		data = (0x01, 0x23, 0x45, 0x67, 0x89, 0xAB, 0xCD, 0xEF)
+		yield
+		yield from self.write(data)
+		# Let the write pointer make it across to the read side
+		yield from self.step(2)
+		yield Settle()
+		self.assertEqual((yield self.dut.r_level), 8)
+		self.assertEqual((yield self.dut.w_rdy), 0)
+		# Read some of the data without committing it, then go back and read it all again
+		yield from self.read(data[:5], commit = False)
+		yield Settle()
+		self.assertEqual((yield self.dut.r_level), 3)
+		yield from self.step(3)
+		yield Settle()
+		# None of the space taken by uncommitted data may be given back to the writer
+		self.assertEqual((yield self.dut.w_rdy), 0)
+		self.assertEqual((yield self.dut.w_level), 8)
+		yield self.dut.r_rewind.eq(1)
+		yield
+		yield self.dut.r_rewind.eq(0)
+		yield self.dut.r_commit.eq(1)
+		yield Settle()
+		self.assertEqual((yield self.dut.r_level), 8)
+		yield from self.read(data[:3], commit = True)
+		yield from self.step(3)
+		yield Settle()
+		# Committed reads free up their space
+		self.assertEqual((yield self.dut.w_level), 5)
+		self.assertEqual((yield self.dut.w_rdy), 1)
+		yield from self.read(data[3:], commit = True)
+		yield Settle()
+		self.assertEqual((yield self.dut.r_rdy), 0)
+		yield from self.step(3)
+		yield Settle()
+		self.assertEqual((yield self.dut.w_level), 0)
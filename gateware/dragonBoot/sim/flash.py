@@ -3,12 +3,14 @@ from torii.hdl import Elaboratable, Module, Record
 from torii.build import Clock
 from torii.lib.fifo import AsyncFIFO
 from torii.hdl.rec import Direction
-from torii.sim import Settle
+from torii.sim import Settle, Passive
 from torii.test import ToriiTestCase
 
-from ..platform import Flash
+from ..platform import Flash, QuadEnable
 from ..flash import SPIFlash
+from ..fifo import RewindFIFO
 from .dfu import dfuData
+from .spi import quadBus
 
 bus = Record((
 	('clk', [
@@ -40,10 +42,30 @@ class Platform:
 		assert number == 0
 		return bus
 
+# The controller's power-on and wake-up delays, along with identifying the Flash, take at most this many cycles
+readyTimeout = 2 * int(20e-6 * 12e6) + 64 + 512
+
+class PageProgramPlatform(Platform):
+	flash = Flash(
+		size = 512 * 1024,
+		pageSize = 256,
+		erasePageSize = 4096,
+		eraseCommand = 0x20
+	)
+
 class DUT(Elaboratable):
-	def __init__(self, *, resource):
-		self._fifo = AsyncFIFO(width = 8, depth = Platform.flash.erasePageSize, r_domain = 'sync', w_domain = 'usb')
-		self._flash = SPIFlash(resource = resource, fifo = self._fifo)
+	def __init__(
+		self, *, resource, fifoDepth = Platform.flash.erasePageSize, differential = False, verify = False, clockFreq = None,
+		addressWidth = 24, skipBlank = False, lanes = 1
+	):
+		if differential or skipBlank:
+			self._fifo = RewindFIFO(width = 8, depth = fifoDepth, r_domain = 'sync', w_domain = 'usb')
+		else:
+			self._fifo = AsyncFIFO(width = 8, depth = fifoDepth, r_domain = 'sync', w_domain = 'usb')
+		self._flash = SPIFlash(
+			resource = resource, fifo = self._fifo, differential = differential, verify = verify, clockFreq = clockFreq,
+			addressWidth = addressWidth, skipBlank = skipBlank, lanes = lanes
+		)
 
 		self.fillFIFO = False
 
@@ -52,12 +74,22 @@ class DUT(Elaboratable):
 		self.finish = self._flash.finish
 		self.done = self._flash.done
 		self.resetAddrs = self._flash.resetAddrs
+		self.seek = self._flash.seek
 		self.beginAddr = self._flash.beginAddr
 		self.endAddr = self._flash.endAddr
+		self.seekAddr = self._flash.seekAddr
+		self.seekEnd = self._flash.seekEnd
 		self.readAddr = self._flash.readAddr
 		self.eraseAddr = self._flash.eraseAddr
 		self.writeAddr = self._flash.writeAddr
 		self.byteCount = self._flash.byteCount
+		self.sectorsUnchanged = self._flash.sectorsUnchanged
+		self.sectorsBlank = self._flash.sectorsBlank
+		self.pagesSkipped = self._flash.pagesSkipped
+		self.verifyFailed = self._flash.verifyFailed
+		self.outOfRange = self._flash.outOfRange
+		self.busyEstimate = self._flash.busyEstimate
+		self.jedecID = self._flash.jedecID
 
 	def elaborate(self, _):
 		m = Module()
@@ -73,23 +105,24 @@ class SPIFlashTestCase(ToriiTestCase):
 	domains = (('sync', 60e6), ('usb', 60e6))
 	platform = Platform()
 
-	def spiTransact(self, copi = None, cipo = None, partial = False, continuation = False):
+	def spiTransact(self, copi = None, cipo = None, idle = 2):
 		if copi is not None and cipo is not None:
 			self.assertEqual(len(copi), len(cipo))
 
 		bytes = max(0 if copi is None else len(copi), 0 if cipo is None else len(cipo))
-		self.assertEqual((yield bus.clk.o), 1)
-		if continuation:
+		# CS must stay deasserted between transactions
+		for _ in range(idle):
+			self.assertEqual((yield bus.clk.o), 1)
+			self.assertEqual((yield bus.cs.o), 0)
 			yield Settle()
+			yield
+		# CS is then asserted ahead of the first SCK edge
+		for _ in range(2):
+			self.assertEqual((yield bus.clk.o), 1)
 			self.assertEqual((yield bus.cs.o), 1)
-		else:
-			self.assertEqual((yield bus.cs.o), 0)
 			yield Settle()
-		yield
-		self.assertEqual((yield bus.clk.o), 1)
-		self.assertEqual((yield bus.cs.o), 1)
-		yield Settle()
-		yield
+			yield
+		# And all the bytes of the transaction go out back-to-back
 		for byte in range(bytes):
 			for bit in range(8):
 				self.assertEqual((yield bus.clk.o), 0)
@@ -104,34 +137,28 @@ class SPIFlashTestCase(ToriiTestCase):
 				self.assertEqual((yield bus.cs.o), 1)
 				yield Settle()
 				yield
-			if byte < bytes - 1:
-				self.assertEqual((yield bus.clk.o), 1)
-				self.assertEqual((yield bus.cs.o), 1)
 			self.assertEqual((yield self.dut.done), 0)
-			yield Settle()
-			if cipo is not None and cipo[byte] is not None:
-				yield bus.cipo.i.eq(0)
-			if byte < bytes - 1:
-				yield
-		if not partial:
-			assert (yield bus.clk.o) == 1
-			assert (yield bus.cs.o) == 0
-			yield Settle()
-			yield
+		yield bus.cipo.i.eq(0)
 
 	@ToriiTestCase.simulation
 	def testSPIFlash(self):
 		fifo = self.dut._fifo
+		statusReady = (0x00, 0x00, 0x00)
+
+		def statusPoll(reads):
+			return (None, ) * (reads + len(statusReady) - 1)
 
 		@ToriiTestCase.sync_domain(domain = 'sync')
 		def domainSync(self: SPIFlashTestCase):
+			# Wait out the controller's power-on delay
+			yield from self.step(int(20e-6 * 12e6) - 1)
+			yield from self.spiTransact(copi = (0xAB,), idle = 2)
+			# The controller is ready once the Flash has woken up, as it wasn't built to identify the Flash
+			yield from self.wait_until_high(self.dut.ready, timeout = int(20e-6 * 12e6) + 8)
+			self.assertEqual((yield bus.cs.o), 0)
+			yield
 			yield self.dut.beginAddr.eq(0)
 			yield self.dut.endAddr.eq(4096)
-			yield from self.spiTransact(copi = (0xAB,))
-			yield Settle()
-			yield
-			yield from self.wait_until_high(self.dut.ready, timeout = 20e-6 * 12e6)
-			yield
 			yield self.dut.resetAddrs.eq(1)
 			yield Settle()
 			yield
@@ -148,55 +175,40 @@ class SPIFlashTestCase(ToriiTestCase):
 			self.assertEqual((yield self.dut.readAddr), 0)
 			self.assertEqual((yield self.dut.eraseAddr), 0)
 			self.assertEqual((yield self.dut.writeAddr), 0)
-			self.assertEqual((yield bus.cs.o), 0)
-			yield
-			yield from self.spiTransact(copi = (0x06,))
+			yield from self.spiTransact(copi = (0x06,), idle = 3)
 			yield from self.spiTransact(copi = (0x20, 0x00, 0x00, 0x00))
-			yield from self.spiTransact(copi = (0x05, None), cipo = (None, 0x03))
-			yield from self.spiTransact(copi = (0x05, None), cipo = (None, 0x03))
-			yield from self.spiTransact(copi = (0x05, None), cipo = (None, 0x03))
-			yield from self.spiTransact(copi = (0x05, None), cipo = (None, 0x00))
-			yield from self.spiTransact(copi = (0x06,))
-			self.assertEqual((yield fifo.r_rdy), 0)
-			yield from self.spiTransact(copi = (0x02, 0x00, 0x00, 0x00), partial = True)
-			yield
-			yield Settle()
-			self.assertEqual((yield fifo.r_rdy), 0)
-			self.assertEqual((yield bus.cs.o), 1)
-			self.assertEqual((yield bus.clk.o), 1)
-			yield
-			yield Settle()
-			self.assertEqual((yield fifo.r_rdy), 0)
-			self.assertEqual((yield bus.cs.o), 1)
-			self.assertEqual((yield bus.clk.o), 1)
-			self.dut.fillFIFO = True
-			for _ in range(6):
+			# The status register is read continuously until WIP clears, with a couple more reads in flight by then
+			yield from self.spiTransact(copi = (0x05, *statusPoll(4)), cipo = (None, 0x03, 0x03, 0x03, *statusReady))
+			yield from self.spiTransact(copi = (0x06,), idle = 3)
+			# The page program must not start until the FIFO holds the whole page
+			for _ in range(8):
+				self.assertEqual((yield fifo.r_rdy), 0)
+				self.assertEqual((yield bus.cs.o), 0)
+				self.assertEqual((yield bus.clk.o), 1)
 				yield Settle()
 				yield
-				self.assertEqual((yield bus.cs.o), 1)
-				self.assertEqual((yield bus.clk.o), 1)
-			yield from self.spiTransact(copi = dfuData[0:64], continuation = True)
+			self.dut.fillFIFO = True
+			yield from self.wait_until_high(bus.cs.o, timeout = 256)
+			self.assertGreaterEqual((yield fifo.r_level), 64)
+			yield from self.spiTransact(copi = (0x02, 0x00, 0x00, 0x00, *dfuData[0:64]), idle = 0)
+			yield from self.spiTransact(copi = (0x05, *statusPoll(2)), cipo = (None, 0x03, *statusReady))
+			# The write address moves on once the page program command program completes
+			yield from self.spiTransact(copi = (0x06,), idle = 3)
 			self.assertEqual((yield self.dut.writeAddr), 64)
-			yield from self.spiTransact(copi = (0x05, None), cipo = (None, 0x03))
-			yield from self.spiTransact(copi = (0x05, None), cipo = (None, 0x00))
-
-			yield from self.spiTransact(copi = (0x06,))
-			yield from self.spiTransact(copi = (0x02, 0x00, 0x00, 0x40), partial = True)
-			yield from self.spiTransact(copi = dfuData[64:128], continuation = True)
+			yield from self.spiTransact(copi = (0x02, 0x00, 0x00, 0x40, *dfuData[64:128]))
+			yield from self.spiTransact(copi = (0x05, *statusPoll(1)), cipo = (None, *statusReady))
+			yield from self.spiTransact(copi = (0x06,), idle = 3)
 			self.assertEqual((yield self.dut.writeAddr), 128)
-			yield from self.spiTransact(copi = (0x05, None), cipo = (None, 0x00))
-
-			yield from self.spiTransact(copi = (0x06,))
-			yield from self.spiTransact(copi = (0x02, 0x00, 0x00, 0x80), partial = True)
-			yield from self.spiTransact(copi = dfuData[128:192], continuation = True)
+			yield from self.spiTransact(copi = (0x02, 0x00, 0x00, 0x80, *dfuData[128:192]))
+			yield from self.spiTransact(copi = (0x05, *statusPoll(1)), cipo = (None, *statusReady))
+			yield from self.spiTransact(copi = (0x06,), idle = 3)
 			self.assertEqual((yield self.dut.writeAddr), 192)
-			yield from self.spiTransact(copi = (0x05, None), cipo = (None, 0x00))
-
-			yield from self.spiTransact(copi = (0x06,))
-			yield from self.spiTransact(copi = (0x02, 0x00, 0x00, 0xC0), partial = True)
-			yield from self.spiTransact(copi = dfuData[192:256], continuation = True)
+			yield from self.spiTransact(copi = (0x02, 0x00, 0x00, 0xC0, *dfuData[192:256]))
+			yield from self.spiTransact(copi = (0x05, *statusPoll(1)), cipo = (None, *statusReady))
+			self.assertEqual((yield bus.cs.o), 0)
+			yield Settle()
+			yield
 			self.assertEqual((yield self.dut.writeAddr), 256)
-			yield from self.spiTransact(copi = (0x05, None), cipo = (None, 0x00))
 
 			self.assertEqual((yield self.dut.done), 1)
 			yield self.dut.finish.eq(1)
@@ -220,3 +232,1194 @@ class SPIFlashTestCase(ToriiTestCase):
 			yield fifo.w_en.eq(0)
 			yield
 		domainUSB(self)
+
+def spiMonitor(transactions : list, spiBus = bus):
+	""" Passively decodes the transactions on the Flash bus, recording the bytes, SCK cycles and CS cycles of each. """
+	yield Passive()
+	clk = 1
+	while True:
+		# Wait for the start of the next transaction
+		while not (yield spiBus.cs.o):
+			yield
+		data = []
+		byte = 0
+		bits = 0
+		csCycles = 0
+		while (yield spiBus.cs.o):
+			csCycles += 1
+			nextClk = yield spiBus.clk.o
+			# Sample COPI on each rising edge of SCK, as the Flash would
+			if not clk and nextClk:
+				byte = (byte << 1) | (yield spiBus.copi.o)
+				bits += 1
+				if bits % 8 == 0:
+					data.append(byte)
+					byte = 0
+			clk = nextClk
+			yield
+		transactions.append((bytes(data), bits, csCycles))
+
+class SPIFlashPageProgramTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+		'fifoDepth': PageProgramPlatform.flash.erasePageSize,
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = PageProgramPlatform()
+
+	@ToriiTestCase.simulation
+	def testPageProgramTiming(self):
+		fifo = self.dut._fifo
+		pageData = bytes((byte * 7) & 0xFF for byte in range(256))
+		transactions = []
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashPageProgramTestCase):
+			yield from spiMonitor(transactions)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashPageProgramTestCase):
+			yield from self.wait_until_high(self.dut.ready, timeout = readyTimeout)
+			yield
+			yield self.dut.beginAddr.eq(0x1000)
+			yield self.dut.endAddr.eq(0x2000)
+			yield self.dut.resetAddrs.eq(1)
+			yield
+			yield self.dut.resetAddrs.eq(0)
+			yield self.dut.start.eq(1)
+			yield self.dut.byteCount.eq(len(pageData))
+			yield
+			yield self.dut.start.eq(0)
+			yield from self.wait_until_high(self.dut.done, timeout = 20000)
+			yield self.dut.finish.eq(1)
+			yield
+			yield self.dut.finish.eq(0)
+			yield
+
+			pagePrograms = [txn for txn in transactions if txn[0][0] == 0x02]
+			self.assertEqual(len(pagePrograms), 1)
+			data, sckCycles, csCycles = pagePrograms[0]
+			self.assertEqual(data, bytes((0x02, 0x00, 0x10, 0x00)) + pageData)
+			# The opcode, address and page data must go out back-to-back with no idle SCK cycles,
+			# with CS asserted for only one cycle either side of the SCK cycles needed
+			self.assertEqual(sckCycles, 8 * (4 + 256))
+			self.assertEqual(csCycles, 2 * sckCycles + 2)
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashPageProgramTestCase):
+			yield fifo.w_en.eq(1)
+			for byte in pageData:
+				yield fifo.w_data.eq(byte)
+				yield
+			yield fifo.w_en.eq(0)
+			yield
+		domainUSB(self)
+		domainMonitor(self)
+
+class BlockErasePlatform(Platform):
+	flash = Flash(
+		size = 512 * 1024,
+		pageSize = 256,
+		erasePageSize = 4096,
+		eraseCommand = 0x20,
+		blockEraseCommands = {
+			32 * 1024: 0x52,
+			64 * 1024: 0xD8,
+		}
+	)
+
+class SPIFlashBlockEraseTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+		'fifoDepth': BlockErasePlatform.flash.erasePageSize,
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = BlockErasePlatform()
+
+	@ToriiTestCase.simulation
+	def testBlockErase(self):
+		fifo = self.dut._fifo
+		transactions = []
+		fills = []
+
+		def download(beginAddr = None, endAddr = None):
+			if beginAddr is not None:
+				yield self.dut.beginAddr.eq(beginAddr)
+				yield self.dut.endAddr.eq(endAddr)
+				yield self.dut.resetAddrs.eq(1)
+				yield
+				yield self.dut.resetAddrs.eq(0)
+			fills.append(256)
+			transactions.clear()
+			yield self.dut.start.eq(1)
+			yield self.dut.byteCount.eq(256)
+			yield
+			yield self.dut.start.eq(0)
+			yield from self.wait_until_high(self.dut.done, timeout = 20000)
+			yield self.dut.finish.eq(1)
+			yield
+			yield self.dut.finish.eq(0)
+			yield
+			return [txn[0] for txn in transactions if txn[0][0] in (0x20, 0x52, 0xD8)]
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashBlockEraseTestCase):
+			yield from self.wait_until_high(self.dut.ready, timeout = readyTimeout)
+			yield
+			# Not aligned to a block, so only the sector can be erased
+			self.assertEqual((yield from download(0x01000, 0x20000)), [bytes((0x20, 0x00, 0x10, 0x00))])
+			# Aligned to a 32KiB block but not a 64KiB one
+			self.assertEqual((yield from download(0x08000, 0x20000)), [bytes((0x52, 0x00, 0x80, 0x00))])
+			# Aligned to a 64KiB block which fits in the slot
+			self.assertEqual((yield from download(0x10000, 0x20000)), [bytes((0xD8, 0x01, 0x00, 0x00))])
+			self.assertEqual((yield self.dut.eraseAddr), 0x20000)
+			# The next download lands in Flash already erased, so must not be erased again
+			self.assertEqual((yield from download()), [])
+			self.assertEqual((yield self.dut.writeAddr), 0x10200)
+			# Aligned to a 64KiB block, but that would run past the end of the slot
+			self.assertEqual((yield from download(0x10000, 0x18000)), [bytes((0x52, 0x01, 0x00, 0x00))])
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashBlockEraseTestCase):
+			yield from spiMonitor(transactions)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashBlockEraseTestCase):
+			yield Passive()
+			while True:
+				if fills:
+					yield fifo.w_en.eq(1)
+					for byte in range(fills.pop()):
+						yield fifo.w_data.eq(byte)
+						yield
+					yield fifo.w_en.eq(0)
+				yield
+		domainUSB(self)
+
+class SPIFlashSeekTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+		'fifoDepth': BlockErasePlatform.flash.erasePageSize,
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = BlockErasePlatform()
+
+	@ToriiTestCase.simulation
+	def testSeek(self):
+		fifo = self.dut._fifo
+		transactions = []
+		fills = []
+
+		def download(seekAddr, seekEnd):
+			yield self.dut.seekAddr.eq(seekAddr)
+			yield self.dut.seekEnd.eq(seekEnd)
+			yield self.dut.seek.eq(1)
+			yield
+			yield self.dut.seek.eq(0)
+			fills.append(256)
+			transactions.clear()
+			yield self.dut.start.eq(1)
+			yield self.dut.byteCount.eq(256)
+			yield
+			yield self.dut.start.eq(0)
+			yield from self.wait_until_high(self.dut.done, timeout = 20000)
+			yield self.dut.finish.eq(1)
+			yield
+			yield self.dut.finish.eq(0)
+			yield
+			self.assertEqual((yield self.dut.writeAddr), seekAddr + 256)
+			return [txn[0] for txn in transactions if txn[0][0] in (0x20, 0x52, 0xD8)]
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashSeekTestCase):
+			yield from self.wait_until_high(self.dut.ready, timeout = readyTimeout)
+			yield
+			yield self.dut.beginAddr.eq(0x10000)
+			yield self.dut.endAddr.eq(0x30000)
+			yield self.dut.resetAddrs.eq(1)
+			yield
+			yield self.dut.resetAddrs.eq(0)
+			# Aligned to a 64KiB block, but the data written there ends a sector later so only the sector is erased
+			self.assertEqual((yield from download(0x20000, 0x21000)), [bytes((0x20, 0x02, 0x00, 0x00))])
+			self.assertEqual((yield self.dut.eraseAddr), 0x21000)
+			# Going back before the write address erases again, this time with a block erase as the data allows it
+			self.assertEqual((yield from download(0x10000, 0x20000)), [bytes((0xD8, 0x01, 0x00, 0x00))])
+			# Skipping ahead into Flash that was erased but not since programmed doesn't erase it again
+			self.assertEqual((yield from download(0x11000, 0x12000)), [])
+			self.assertEqual((yield self.dut.eraseAddr), 0x20000)
+			# Going back over what was just programmed has it erased again
+			self.assertEqual((yield from download(0x11000, 0x12000)), [bytes((0x20, 0x01, 0x10, 0x00))])
+			self.assertEqual((yield self.dut.eraseAddr), 0x12000)
+			# Resetting the addressing lifts the limit on how far erases may run
+			yield self.dut.resetAddrs.eq(1)
+			yield
+			yield self.dut.resetAddrs.eq(0)
+			fills.append(256)
+			transactions.clear()
+			yield self.dut.start.eq(1)
+			yield self.dut.byteCount.eq(256)
+			yield
+			yield self.dut.start.eq(0)
+			yield from self.wait_until_high(self.dut.done, timeout = 20000)
+			yield self.dut.finish.eq(1)
+			yield
+			yield self.dut.finish.eq(0)
+			yield
+			self.assertEqual(
+				[txn[0] for txn in transactions if txn[0][0] in (0x20, 0x52, 0xD8)], [bytes((0xD8, 0x01, 0x00, 0x00))]
+			)
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashSeekTestCase):
+			yield from spiMonitor(transactions)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashSeekTestCase):
+			yield Passive()
+			while True:
+				if fills:
+					yield fifo.w_en.eq(1)
+					for byte in range(fills.pop()):
+						yield fifo.w_data.eq(byte)
+						yield
+					yield fifo.w_en.eq(0)
+				yield
+		domainUSB(self)
+
+class SPIFlashOutOfRangeTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = Platform()
+
+	@ToriiTestCase.simulation
+	def testOutOfRange(self):
+		fifo = self.dut._fifo
+		transactions = []
+		fills = []
+
+		def download(fill):
+			if fill:
+				fills.append(256)
+			transactions.clear()
+			yield self.dut.start.eq(1)
+			yield self.dut.byteCount.eq(256)
+			yield
+			yield self.dut.start.eq(0)
+			yield from self.wait_until_high(self.dut.done, timeout = 20000)
+			outOfRange = yield self.dut.outOfRange
+			yield self.dut.finish.eq(1)
+			yield
+			yield self.dut.finish.eq(0)
+			yield
+			return outOfRange
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashOutOfRangeTestCase):
+			yield from self.wait_until_high(self.dut.ready, timeout = readyTimeout)
+			yield
+			yield self.dut.beginAddr.eq(0x1000)
+			yield self.dut.endAddr.eq(0x1100)
+			yield self.dut.resetAddrs.eq(1)
+			yield
+			yield self.dut.resetAddrs.eq(0)
+			self.assertEqual((yield from download(True)), 0)
+			self.assertEqual((yield self.dut.writeAddr), 0x1100)
+			# With the slot full, the next operation must be refused without erasing or programming anything
+			self.assertEqual((yield from download(False)), 1)
+			self.assertEqual(transactions, [])
+			self.assertEqual((yield self.dut.eraseAddr), 0x1100)
+			self.assertEqual((yield self.dut.writeAddr), 0x1100)
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashOutOfRangeTestCase):
+			yield from spiMonitor(transactions)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashOutOfRangeTestCase):
+			yield Passive()
+			while True:
+				if fills:
+					yield fifo.w_en.eq(1)
+					for byte in range(fills.pop()):
+						yield fifo.w_data.eq(byte)
+						yield
+					yield fifo.w_en.eq(0)
+				yield
+		domainUSB(self)
+
+class FourBytePlatform(Platform):
+	flash = Flash(
+		size = 32 * 1024 * 1024,
+		pageSize = 256,
+		erasePageSize = 4096,
+		eraseCommand = 0x20,
+		blockEraseCommands = {
+			32 * 1024: 0x52,
+			64 * 1024: 0xD8,
+		}
+	)
+
+class FourByteModePlatform(Platform):
+	flash = Flash(
+		size = 32 * 1024 * 1024,
+		pageSize = 256,
+		erasePageSize = 4096,
+		eraseCommand = 0x20,
+		blockEraseCommands = {
+			32 * 1024: 0x52,
+			64 * 1024: 0xD8,
+		},
+		fourByteOpcodes = False
+	)
+
+def fourByteDownload(self : ToriiTestCase, transactions : list, beginAddr : int, endAddr : int):
+	""" Downloads a page to the Flash, returning the transactions other than status register reads it took. """
+	yield from self.wait_until_high(self.dut.ready, timeout = readyTimeout)
+	yield
+	yield self.dut.beginAddr.eq(beginAddr)
+	yield self.dut.endAddr.eq(endAddr)
+	yield self.dut.resetAddrs.eq(1)
+	yield
+	yield self.dut.resetAddrs.eq(0)
+	transactions.clear()
+	yield self.dut.start.eq(1)
+	yield self.dut.byteCount.eq(256)
+	yield
+	yield self.dut.start.eq(0)
+	yield from self.wait_until_high(self.dut.done, timeout = 20000)
+	yield self.dut.finish.eq(1)
+	yield
+	yield self.dut.finish.eq(0)
+	yield
+	return [txn[0][:5] for txn in transactions if txn[0][0] != 0x05]
+
+def fillFIFO(fifo):
+	yield fifo.w_en.eq(1)
+	for byte in range(256):
+		yield fifo.w_data.eq(byte)
+		yield
+	yield fifo.w_en.eq(0)
+	yield
+
+class SPIFlashFourByteTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+		'fifoDepth': FourBytePlatform.flash.erasePageSize,
+		'addressWidth': 32,
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = FourBytePlatform()
+
+	@ToriiTestCase.simulation
+	def testFourByteOpcodes(self):
+		transactions = []
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashFourByteTestCase):
+			# Above 16MiB, the erase and Page Program use their 4-byte address forms
+			self.assertEqual((yield from fourByteDownload(self, transactions, 0x1010000, 0x1020000)), [
+				bytes((0x06, )),
+				bytes((0xDC, 0x01, 0x01, 0x00, 0x00)),
+				bytes((0x06, )),
+				bytes((0x12, 0x01, 0x01, 0x00, 0x00)),
+			])
+			self.assertEqual((yield self.dut.writeAddr), 0x1010100)
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashFourByteTestCase):
+			yield from spiMonitor(transactions)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashFourByteTestCase):
+			yield from fillFIFO(self.dut._fifo)
+		domainUSB(self)
+
+class SPIFlashFourByteModeTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+		'fifoDepth': FourByteModePlatform.flash.erasePageSize,
+		'addressWidth': 32,
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = FourByteModePlatform()
+
+	@ToriiTestCase.simulation
+	def testFourByteMode(self):
+		transactions = []
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashFourByteModeTestCase):
+			# Without the 4-byte address opcodes, the Flash is put in 4-byte address mode around each operation
+			self.assertEqual((yield from fourByteDownload(self, transactions, 0x1010000, 0x1020000)), [
+				bytes((0xB7, )),
+				bytes((0x06, )),
+				bytes((0xD8, 0x01, 0x01, 0x00, 0x00)),
+				bytes((0xE9, )),
+				bytes((0xB7, )),
+				bytes((0x06, )),
+				bytes((0x02, 0x01, 0x01, 0x00, 0x00)),
+				bytes((0xE9, )),
+			])
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashFourByteModeTestCase):
+			yield from spiMonitor(transactions)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashFourByteModeTestCase):
+			yield from fillFIFO(self.dut._fifo)
+		domainUSB(self)
+
+def spiFlashModel(memory : dict, spiBus = bus, eraseCycles = 0, programCycles = 0, jedecID = None, sfdp = None):
+	""" Passively models a Flash on the given bus, answering Fast Read commands from memory and applying Page Program
+	commands to it. Memory reads as 0xFF (erased) where not given, and erase commands are ignored other than for
+	reporting the Flash busy in its status register (WIP) for eraseCycles, as with programCycles for Page Program.
+	If given, the JEDEC ID bytes and SFDP data are answered for their read commands too. """
+	yield Passive()
+	clk = 1
+	busy = 0
+	while True:
+		while not (yield spiBus.cs.o):
+			busy = max(busy - 1, 0)
+			yield
+		command = 0
+		address = 0
+		data = 0
+		bits = 0
+		while (yield spiBus.cs.o):
+			# Look at SCK as it is for this cycle, so the data bit is driven before the next rising edge
+			yield Settle()
+			nextClk = yield spiBus.clk.o
+			if not clk and nextClk:
+				bit = yield spiBus.copi.o
+				if bits < 8:
+					command = (command << 1) | bit
+				elif bits < 32:
+					address = (address << 1) | bit
+				else:
+					data = ((data << 1) | bit) & 0xFF
+				bits += 1
+				# Programming can only clear bits
+				if command == 0x02 and bits > 32 and bits % 8 == 0:
+					offset = address + (bits - 40) // 8
+					memory[offset] = memory.get(offset, 0xFF) & data
+			# The Flash shifts data out on the falling edge of SCK, after the opcode, address and dummy byte
+			elif clk and not nextClk and command == 0x0B and bits >= 40:
+				byte = memory.get(address + (bits - 40) // 8, 0xFF)
+				yield spiBus.cipo.i.eq((byte >> (7 - (bits % 8))) & 1)
+			# The status register's WIP bit is its least significant, so the last shifted out of each read of it
+			elif clk and not nextClk and command == 0x05 and bits >= 8:
+				yield spiBus.cipo.i.eq(1 if bits % 8 == 7 and busy else 0)
+			elif clk and not nextClk and command == 0x9F and bits >= 8 and jedecID is not None:
+				offset = (bits - 8) // 8
+				byte = jedecID[offset] if offset < len(jedecID) else 0xFF
+				yield spiBus.cipo.i.eq((byte >> (7 - (bits % 8))) & 1)
+			elif clk and not nextClk and command == 0x5A and bits >= 40 and sfdp is not None:
+				offset = address + (bits - 40) // 8
+				byte = sfdp[offset] if offset < len(sfdp) else 0xFF
+				yield spiBus.cipo.i.eq((byte >> (7 - (bits % 8))) & 1)
+			clk = nextClk
+			busy = max(busy - 1, 0)
+			yield
+		yield spiBus.cipo.i.eq(0)
+		if command in (0x20, 0x52, 0xD8):
+			busy = eraseCycles
+		elif command == 0x02:
+			busy = programCycles
+
+def quadFlashModel(transactions : list, statusRegs : dict):
+	""" Passively models a Flash on the Quad SPI bus, recording the lane enables and lanes driven going into each
+	rising edge of SCK for each transaction. Reads of the status registers are answered from statusRegs (by their
+	read opcode), and a 2 byte Write Status Register updates both. """
+	yield Passive()
+	clk = 1
+	while True:
+		while not (yield quadBus.cs.o):
+			yield
+		beats = []
+		command = 0
+		lanes = None
+		while (yield quadBus.cs.o):
+			yield Settle()
+			nextClk = yield quadBus.clk.o
+			# The lanes must be set up while SCK is low, ready for the Flash to sample them as it rises
+			if not nextClk:
+				lanes = ((yield quadBus.dq.oe), (yield quadBus.dq.o))
+				# Status is shifted out on IO1 from the falling edge of SCK after the opcode
+				if clk and command in statusRegs and len(beats) >= 8:
+					yield quadBus.dq.i.eq(((statusRegs[command] >> (7 - len(beats) % 8)) & 1) << 1)
+			elif not clk:
+				beats.append(lanes)
+				if len(beats) <= 8:
+					command = (command << 1) | (beats[-1][1] & 1)
+			clk = nextClk
+			yield
+		yield quadBus.dq.i.eq(0)
+		transactions.append(beats)
+		if command == 0x01 and len(beats) == 24:
+			statusRegs[0x05] = sum((beats[8 + bit][1] & 1) << (7 - bit) for bit in range(8))
+			statusRegs[0x35] = sum((beats[16 + bit][1] & 1) << (7 - bit) for bit in range(8))
+
+class QuadFlashPlatform(Platform):
+	flash = Flash(
+		size = 512 * 1024,
+		pageSize = 64,
+		erasePageSize = 256,
+		eraseCommand = 0x20,
+		quadEnable = QuadEnable.sr2Bit1,
+	)
+
+	def request(self, name, number):
+		assert name == 'flash'
+		assert number == 0
+		return quadBus
+
+class SPIFlashQuadTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+		'lanes': 4,
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = QuadFlashPlatform()
+
+	@staticmethod
+	def singleLaneBytes(beats):
+		return bytes(
+			sum((beats[byte * 8 + bit][1] & 1) << (7 - bit) for bit in range(8)) for byte in range(len(beats) // 8)
+		)
+
+	@ToriiTestCase.simulation
+	def testQuadFlash(self):
+		fifo = self.dut._fifo
+		transactions = []
+		# Status register 2 has QE clear, while status register 1 has a block protect bit that must be kept
+		statusRegs = {0x05: 0x04, 0x35: 0x00}
+		pageData = bytes((byte * 9 + 2) & 0xFF for byte in range(64))
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashQuadTestCase):
+			yield from self.wait_until_high(self.dut.ready, timeout = readyTimeout + 1024)
+			yield
+			# Both status registers are read, then written back together with QE set and the write waited out
+			commands = [self.singleLaneBytes(beats)[:3] for beats in transactions]
+			self.assertEqual(commands[0], bytes((0xAB, )))
+			self.assertEqual(commands[1][0], 0x05)
+			self.assertEqual(commands[2][0], 0x35)
+			self.assertEqual(commands[3], bytes((0x06, )))
+			self.assertEqual(commands[4], bytes((0x01, 0x04, 0x02)))
+			self.assertEqual(commands[5][0], 0x05)
+			self.assertEqual(len(commands), 6)
+			self.assertEqual(statusRegs[0x35], 0x02)
+			# None of which use more than IO0 to send on, with WP and HOLD driven high
+			for beats in transactions:
+				self.assertEqual({beat[0] for beat in beats[:8]}, {0b1101})
+				self.assertEqual({beat[1] >> 2 for beat in beats[:8]}, {0b11})
+
+			yield self.dut.beginAddr.eq(0x1000)
+			yield self.dut.endAddr.eq(0x2000)
+			yield self.dut.resetAddrs.eq(1)
+			yield
+			yield self.dut.resetAddrs.eq(0)
+			transactions.clear()
+			yield self.dut.start.eq(1)
+			yield self.dut.byteCount.eq(len(pageData))
+			yield
+			yield self.dut.start.eq(0)
+			yield from self.wait_until_high(self.dut.done, timeout = 20000)
+			yield self.dut.finish.eq(1)
+			yield
+			yield self.dut.finish.eq(0)
+			yield
+
+			# The page goes out as a Quad Page Program, with the opcode and address on IO0 and the data on all 4 lanes
+			programs = [beats for beats in transactions if self.singleLaneBytes(beats[:8]) == bytes((0x32, ))]
+			self.assertEqual(len(programs), 1)
+			beats = programs[0]
+			self.assertEqual(self.singleLaneBytes(beats[:32]), bytes((0x32, 0x00, 0x10, 0x00)))
+			self.assertEqual({beat[0] for beat in beats[:32]}, {0b1101})
+			self.assertEqual(len(beats), 32 + 2 * len(pageData))
+			self.assertEqual({beat[0] for beat in beats[32:]}, {0b1111})
+			self.assertEqual(
+				bytes((beats[index][1] << 4) | beats[index + 1][1] for index in range(32, len(beats), 2)), pageData
+			)
+			self.assertFalse(any(self.singleLaneBytes(beats[:8]) == bytes((0x02, )) for beats in transactions))
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainFlash(self: SPIFlashQuadTestCase):
+			yield from quadFlashModel(transactions, statusRegs)
+		domainFlash(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashQuadTestCase):
+			yield fifo.w_en.eq(1)
+			for byte in pageData:
+				yield fifo.w_data.eq(byte)
+				yield
+			yield fifo.w_en.eq(0)
+			yield
+		domainUSB(self)
+
+class SPIFlashDifferentialTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+		'differential': True,
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = Platform()
+
+	@ToriiTestCase.simulation
+	def testDifferential(self):
+		fifo = self.dut._fifo
+		transactions = []
+		fills = []
+		sectorData = bytes((byte * 13 + 5) & 0xFF for byte in range(256))
+		memory = {}
+		# The first sector already holds the data, the second is blank and the third holds something else
+		for offset, byte in enumerate(sectorData):
+			memory[0x1000 + offset] = byte
+			memory[0x1200 + offset] = byte ^ 0x5A
+
+		def download(beginAddr = None, endAddr = None):
+			if beginAddr is not None:
+				yield self.dut.beginAddr.eq(beginAddr)
+				yield self.dut.endAddr.eq(endAddr)
+				yield self.dut.resetAddrs.eq(1)
+				yield
+				yield self.dut.resetAddrs.eq(0)
+			fills.append(sectorData)
+			transactions.clear()
+			yield self.dut.start.eq(1)
+			yield self.dut.byteCount.eq(len(sectorData))
+			yield
+			yield self.dut.start.eq(0)
+			yield from self.wait_until_high(self.dut.done, timeout = 40000)
+			yield self.dut.finish.eq(1)
+			yield
+			yield self.dut.finish.eq(0)
+			yield
+			commands = {}
+			for data, _, _ in transactions:
+				commands.setdefault(data[0], []).append(data)
+			return commands
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashDifferentialTestCase):
+			yield from self.wait_until_high(self.dut.ready, timeout = readyTimeout)
+			yield
+			# An unchanged sector must be read back in full, then neither erased nor programmed
+			commands = yield from download(0x1000, 0x2000)
+			self.assertEqual(
+				[data[:5] for data in commands[0x0B]],
+				[bytes((0x0B, 0x00, 0x10, page, 0x00)) for page in (0x00, 0x40, 0x80, 0xC0)]
+			)
+			self.assertNotIn(0x20, commands)
+			self.assertNotIn(0x02, commands)
+			self.assertEqual((yield self.dut.writeAddr), 0x1100)
+			self.assertEqual((yield self.dut.sectorsUnchanged), 1)
+			yield from self.step(3)
+			yield Settle()
+			# All the sector's data must have been consumed from the FIFO
+			self.assertEqual((yield fifo.r_rdy), 0)
+			self.assertEqual((yield fifo.w_level), 0)
+
+			# A blank sector must be programmed with the rewound data, but not erased
+			commands = yield from download()
+			self.assertEqual(len(commands[0x0B]), 4)
+			self.assertNotIn(0x20, commands)
+			self.assertEqual(
+				[data for data in commands[0x02]],
+				[bytes((0x02, 0x00, 0x11, page * 64)) + sectorData[page * 64:(page + 1) * 64] for page in range(4)]
+			)
+			self.assertEqual((yield self.dut.sectorsBlank), 1)
+
+			# A sector holding other data must stop being compared after the first page, then be erased and programmed
+			commands = yield from download()
+			self.assertEqual(len(commands[0x0B]), 1)
+			self.assertEqual(commands[0x20], [bytes((0x20, 0x00, 0x12, 0x00))])
+			self.assertEqual(len(commands[0x02]), 4)
+			self.assertEqual(commands[0x02][0], bytes((0x02, 0x00, 0x12, 0x00)) + sectorData[:64])
+			self.assertEqual((yield self.dut.writeAddr), 0x1300)
+			self.assertEqual((yield self.dut.sectorsUnchanged), 1)
+			self.assertEqual((yield self.dut.sectorsBlank), 1)
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashDifferentialTestCase):
+			yield from spiMonitor(transactions)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainFlash(self: SPIFlashDifferentialTestCase):
+			yield from spiFlashModel(memory)
+		domainFlash(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashDifferentialTestCase):
+			yield Passive()
+			while True:
+				if fills:
+					yield fifo.w_en.eq(1)
+					for byte in fills.pop():
+						yield fifo.w_data.eq(byte)
+						yield
+					yield fifo.w_en.eq(0)
+				yield
+		domainUSB(self)
+
+class SPIFlashVerifyTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+		'verify': True,
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = Platform()
+
+	@ToriiTestCase.simulation
+	def testVerify(self):
+		fifo = self.dut._fifo
+		transactions = []
+		fills = []
+		sectorData = bytes((byte * 11 + 1) & 0xFF for byte in range(256))
+		# A byte the (ignored) erase fails to clear, so it can't be programmed to what's wanted
+		memory = {0x1100 + 10: 0x00}
+
+		def download(beginAddr = None, endAddr = None):
+			if beginAddr is not None:
+				yield self.dut.beginAddr.eq(beginAddr)
+				yield self.dut.endAddr.eq(endAddr)
+				yield self.dut.resetAddrs.eq(1)
+				yield
+				yield self.dut.resetAddrs.eq(0)
+			fills.append(sectorData)
+			transactions.clear()
+			yield self.dut.start.eq(1)
+			yield self.dut.byteCount.eq(len(sectorData))
+			yield
+			yield self.dut.start.eq(0)
+			yield from self.wait_until_high(self.dut.done, timeout = 40000)
+			verifyFailed = yield self.dut.verifyFailed
+			yield self.dut.finish.eq(1)
+			yield
+			yield self.dut.finish.eq(0)
+			yield
+			return verifyFailed
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashVerifyTestCase):
+			yield from self.wait_until_high(self.dut.ready, timeout = readyTimeout)
+			yield
+			self.assertEqual((yield from download(0x1000, 0x2000)), 0)
+			# The whole range programmed must be read back in one go after the last page is written
+			self.assertEqual(transactions[-1][0][:5], bytes((0x0B, 0x00, 0x10, 0x00, 0x00)))
+			self.assertEqual(transactions[-1][1], 8 * (5 + 256))
+			self.assertEqual(bytes(memory[0x1000 + offset] for offset in range(256)), sectorData)
+			self.assertEqual((yield from download()), 1)
+			self.assertEqual(transactions[-1][0][:5], bytes((0x0B, 0x00, 0x11, 0x00, 0x00)))
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashVerifyTestCase):
+			yield from spiMonitor(transactions)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainFlash(self: SPIFlashVerifyTestCase):
+			yield from spiFlashModel(memory)
+		domainFlash(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashVerifyTestCase):
+			yield Passive()
+			while True:
+				if fills:
+					yield fifo.w_en.eq(1)
+					for byte in fills.pop():
+						yield fifo.w_data.eq(byte)
+						yield
+					yield fifo.w_en.eq(0)
+				yield
+		domainUSB(self)
+
+class TimedPlatform(Platform):
+	flash = Flash(
+		size = 512 * 1024,
+		pageSize = 64,
+		erasePageSize = 256,
+		eraseCommand = 0x20,
+		eraseTime = 2e-3,
+		programTime = 0.5e-3,
+	)
+
+class SPIFlashBusyTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+		# Have the controller think it runs from a 1MHz clock so its milliseconds pass quickly
+		'clockFreq': 1e6,
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = TimedPlatform()
+
+	@ToriiTestCase.simulation
+	def testBusyEstimate(self):
+		fifo = self.dut._fifo
+		transactions = []
+		fills = []
+
+		def download(beginAddr = None, endAddr = None):
+			if beginAddr is not None:
+				yield self.dut.beginAddr.eq(beginAddr)
+				yield self.dut.endAddr.eq(endAddr)
+				yield self.dut.resetAddrs.eq(1)
+				yield
+				yield self.dut.resetAddrs.eq(0)
+			fills.append(256)
+			transactions.clear()
+			yield self.dut.start.eq(1)
+			yield self.dut.byteCount.eq(256)
+			yield
+			yield self.dut.start.eq(0)
+			yield Settle()
+			estimate = yield self.dut.busyEstimate
+			cycles = 1
+			while not (yield self.dut.done):
+				# The estimate must count down as the operation progresses
+				if cycles == 3000:
+					self.assertIn((yield self.dut.busyEstimate), range(estimate - 3, estimate - 1))
+				yield
+				yield Settle()
+				cycles += 1
+			self.assertEqual((yield self.dut.busyEstimate), 0)
+			yield self.dut.finish.eq(1)
+			yield
+			yield self.dut.finish.eq(0)
+			yield
+			return estimate, cycles
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashBusyTestCase):
+			yield from self.wait_until_high(self.dut.ready, timeout = readyTimeout)
+			yield
+			# Before anything has been measured, the estimate comes from the Flash's typical erase and program times
+			estimate, cycles = yield from download(0x1000, 0x2000)
+			self.assertEqual(estimate, 4)
+			# The Flash's status is polled by a single Read Status command for each erase and page program
+			statusReads = [txn for txn in transactions if txn[0][0] == 0x05]
+			self.assertEqual(len(statusReads), 5)
+			self.assertGreater(statusReads[0][1], 5000 // 2)
+			# And after, it comes from how long the last sector took
+			estimate, _ = yield from download()
+			self.assertIn(estimate, range(cycles // 1000 - 1, cycles // 1000 + 2))
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashBusyTestCase):
+			yield from spiMonitor(transactions)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainFlash(self: SPIFlashBusyTestCase):
+			yield from spiFlashModel({}, eraseCycles = 5000, programCycles = 500)
+		domainFlash(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashBusyTestCase):
+			yield Passive()
+			while True:
+				if fills:
+					yield fifo.w_en.eq(1)
+					for byte in range(fills.pop()):
+						yield fifo.w_data.eq(byte)
+						yield
+					yield fifo.w_en.eq(0)
+				yield
+		domainUSB(self)
+
+class DiscoveryPlatform(Platform):
+	flash = Flash(
+		size = 512 * 1024,
+		pageSize = 256,
+		erasePageSize = 4096,
+		eraseCommand = 0x20
+	)
+
+	flashDiscovery = True
+
+def sfdpTable(*, eraseTypes, pageSizeLog2, addressBytes = 0b11):
+	""" Builds the SFDP data for a Flash with the given erase types (size to opcode), page size and address bytes. """
+	# The SFDP header, then the parameter header pointing to a 16 DWORD Basic Flash Parameter Table at 0x30
+	header = b'SFDP' + bytes((0x06, 0x01, 0x00, 0xFF)) + bytes((0x00, 0x06, 0x01, 16, 0x30, 0x00, 0x00, 0xFF))
+	table = bytearray(b'\xFF' * 64)
+	table[2] = 0xF9 | (addressBytes << 1)
+	for index, (size, opcode) in enumerate(eraseTypes.items()):
+		table[28 + 2 * index] = size.bit_length() - 1
+		table[29 + 2 * index] = opcode
+	table[40] = (pageSizeLog2 << 4) | 0x01
+	return header + b'\xFF' * (0x30 - len(header)) + bytes(table)
+
+class SPIFlashDiscoveryTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+		'fifoDepth': DiscoveryPlatform.flash.erasePageSize,
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = DiscoveryPlatform()
+
+	@ToriiTestCase.simulation
+	def testDiscovery(self):
+		fifo = self.dut._fifo
+		transactions = []
+		# This Flash has 64 byte pages, and 32KiB and 64KiB block erases, none of which its Flash description gives
+		sfdp = sfdpTable(eraseTypes = {4096: 0x20, 32 * 1024: 0x52, 64 * 1024: 0xD8}, pageSizeLog2 = 6)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashDiscoveryTestCase):
+			yield from self.wait_until_high(self.dut.ready, timeout = readyTimeout + 1024)
+			self.assertEqual((yield self.dut.jedecID), 0xEF4016)
+			yield
+			yield self.dut.beginAddr.eq(0x10000)
+			yield self.dut.endAddr.eq(0x20000)
+			yield self.dut.resetAddrs.eq(1)
+			yield
+			yield self.dut.resetAddrs.eq(0)
+			transactions.clear()
+			yield self.dut.start.eq(1)
+			yield self.dut.byteCount.eq(256)
+			yield
+			yield self.dut.start.eq(0)
+			yield from self.wait_until_high(self.dut.done, timeout = 20000)
+			yield self.dut.finish.eq(1)
+			yield
+			yield self.dut.finish.eq(0)
+			yield
+
+			self.assertEqual([txn[0] for txn in transactions if txn[0][0] in (0x20, 0x52, 0xD8)], [
+				bytes((0xD8, 0x01, 0x00, 0x00)),
+			])
+			self.assertEqual([txn[0][:4] for txn in transactions if txn[0][0] == 0x02], [
+				bytes((0x02, 0x01, 0x00, offset)) for offset in range(0, 256, 64)
+			])
+			self.assertEqual({txn[1] for txn in transactions if txn[0][0] == 0x02}, {8 * (4 + 64)})
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashDiscoveryTestCase):
+			yield from spiMonitor(transactions)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainFlash(self: SPIFlashDiscoveryTestCase):
+			yield from spiFlashModel({}, jedecID = (0xEF, 0x40, 0x16), sfdp = sfdp)
+		domainFlash(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashDiscoveryTestCase):
+			yield fifo.w_en.eq(1)
+			for byte in range(256):
+				yield fifo.w_data.eq(byte)
+				yield
+			yield fifo.w_en.eq(0)
+			yield
+		domainUSB(self)
+
+	@ToriiTestCase.simulation
+	def testAddressMismatch(self):
+		transactions = []
+		# This Flash only takes 4-byte addresses, which the controller wasn't built for
+		sfdp = sfdpTable(eraseTypes = {4096: 0x20}, pageSizeLog2 = 8, addressBytes = 0b10)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashDiscoveryTestCase):
+			for _ in range(readyTimeout + 1024):
+				self.assertEqual((yield self.dut.ready), 0)
+				yield
+			self.assertEqual([txn for txn in transactions if txn[0][0] not in (0xAB, 0x9F, 0x5A)], [])
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashDiscoveryTestCase):
+			yield from spiMonitor(transactions)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainFlash(self: SPIFlashDiscoveryTestCase):
+			yield from spiFlashModel({}, jedecID = (0xEF, 0x40, 0x16), sfdp = sfdp)
+		domainFlash(self)
+
+class SPIFlashSkipBlankTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+		'fifoDepth': PageProgramPlatform.flash.erasePageSize,
+		'skipBlank': True,
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = PageProgramPlatform()
+
+	@ToriiTestCase.simulation
+	def testSkipBlank(self):
+		fifo = self.dut._fifo
+		transactions = []
+		memory = {}
+		# A sector with data in its first page, then blank padding, with only the very last byte of the second to
+		# last page not blank and the last page holding data again
+		sectorData = bytearray(b'\xFF' * 4096)
+		sectorData[0:256] = bytes((byte * 7 + 3) & 0xFF for byte in range(256))
+		sectorData[3839] = 0x00
+		sectorData[3840:4096] = bytes((byte * 5 + 1) & 0xFF for byte in range(256))
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashSkipBlankTestCase):
+			yield from self.wait_until_high(self.dut.ready, timeout = readyTimeout)
+			yield
+			yield self.dut.beginAddr.eq(0x10000)
+			yield self.dut.endAddr.eq(0x20000)
+			yield self.dut.resetAddrs.eq(1)
+			yield
+			yield self.dut.resetAddrs.eq(0)
+			transactions.clear()
+			yield self.dut.start.eq(1)
+			yield self.dut.byteCount.eq(4096)
+			yield
+			yield self.dut.start.eq(0)
+			yield from self.wait_until_high(self.dut.done, timeout = 100000)
+			yield self.dut.finish.eq(1)
+			yield
+			yield self.dut.finish.eq(0)
+			yield
+
+			# Only the 3 pages that aren't blank get programmed
+			self.assertEqual([txn[0][:4] for txn in transactions if txn[0][0] == 0x02], [
+				bytes((0x02, 0x01, 0x00, 0x00)),
+				bytes((0x02, 0x01, 0x0E, 0x00)),
+				bytes((0x02, 0x01, 0x0F, 0x00)),
+			])
+			# Which avoids the Write Enable, Page Program and status poll for each of the other 13
+			self.assertEqual(len(transactions), 3 * (1 + 3))
+			self.assertEqual((yield self.dut.pagesSkipped), 13)
+			self.assertEqual((yield self.dut.writeAddr), 0x11000)
+			self.assertEqual((yield fifo.r_level), 0)
+			self.assertEqual(bytes(memory.get(0x10000 + offset, 0xFF) for offset in range(4096)), sectorData)
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashSkipBlankTestCase):
+			yield from spiMonitor(transactions)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainFlash(self: SPIFlashSkipBlankTestCase):
+			yield from spiFlashModel(memory)
+		domainFlash(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashSkipBlankTestCase):
+			yield fifo.w_en.eq(1)
+			for byte in sectorData:
+				yield fifo.w_data.eq(byte)
+				yield
+			yield fifo.w_en.eq(0)
+			yield
+		domainUSB(self)
+
+class SPIFlashSubSectorTestCase(ToriiTestCase):
+	dut : DUT = DUT
+	dut_args = {
+		'resource': ('flash', 0),
+	}
+	domains = (('sync', 60e6), ('usb', 60e6))
+	platform = Platform()
+
+	@ToriiTestCase.simulation
+	def testSubSector(self):
+		fifo = self.dut._fifo
+		transactions = []
+		memory = {}
+		# Operations of less than a sector that don't start or end on page boundaries, the last crossing into the
+		# next sector
+		lengths = (20, 40, 196, 40)
+		data = bytes((byte * 7 + 3) & 0xFF for byte in range(sum(lengths)))
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SPIFlashSubSectorTestCase):
+			yield from self.wait_until_high(self.dut.ready, timeout = readyTimeout)
+			yield
+			yield self.dut.beginAddr.eq(0x10000)
+			yield self.dut.endAddr.eq(0x20000)
+			yield self.dut.resetAddrs.eq(1)
+			yield
+			yield self.dut.resetAddrs.eq(0)
+			transactions.clear()
+			erases = []
+			for length in lengths:
+				yield self.dut.start.eq(1)
+				yield self.dut.byteCount.eq(length)
+				yield
+				yield self.dut.start.eq(0)
+				yield from self.wait_until_high(self.dut.done, timeout = 100000)
+				yield self.dut.finish.eq(1)
+				yield
+				yield self.dut.finish.eq(0)
+				yield
+				erases.append([txn[0] for txn in transactions if txn[0][0] == 0x20])
+				# No Page Program may run past the end of the page it starts in
+				for txn in transactions:
+					if txn[0][0] == 0x02:
+						address = int.from_bytes(txn[0][1:4], byteorder = 'big')
+						self.assertLessEqual(address % 64 + len(txn[0]) - 4, 64)
+				transactions.clear()
+
+			# Only the operations whose data crosses into a sector not yet erased erase anything
+			self.assertEqual(erases, [[bytes((0x20, 0x01, 0x00, 0x00))], [], [], [bytes((0x20, 0x01, 0x01, 0x00))]])
+			self.assertEqual((yield self.dut.writeAddr), 0x10000 + len(data))
+			self.assertEqual((yield self.dut.eraseAddr), 0x10200)
+			self.assertEqual(bytes(memory.get(0x10000 + offset, 0xFF) for offset in range(len(data))), data)
+		domainSync(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainMonitor(self: SPIFlashSubSectorTestCase):
+			yield from spiMonitor(transactions)
+		domainMonitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainFlash(self: SPIFlashSubSectorTestCase):
+			yield from spiFlashModel(memory)
+		domainFlash(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self: SPIFlashSubSectorTestCase):
+			yield fifo.w_en.eq(1)
+			for byte in data:
+				yield fifo.w_data.eq(byte)
+				yield Settle()
+				while not (yield fifo.w_rdy):
+					yield
+					yield Settle()
+				yield
+			yield fifo.w_en.eq(0)
+			yield
+		domainUSB(self)
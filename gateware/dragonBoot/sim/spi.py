@@ -1,10 +1,11 @@
 # SPDX-License-Identifier: BSD-3-Clause
 from torii.hdl import Record
 from torii.hdl.rec import Direction
-from torii.sim import Settle
+from torii.sim import Settle, Passive
 from torii.test import ToriiTestCase
 
-from ..spi import SPIBus
+from ..platform import SBSPIBlock
+from ..spi import SPIBus, SPIBusWidth, SBSPIBus
 
 bus = Record((
 	('clk', [
@@ -81,3 +82,345 @@ class SPIBusTestCase(ToriiTestCase):
 		yield
 		yield self.dut.cs.eq(0)
 		yield from self.settle()
+
+fullRateBus = Record((
+	('clk', [
+		('o0', 1, Direction.FANOUT),
+		('o1', 1, Direction.FANOUT),
+		('o_clk', 1, Direction.FANOUT),
+	]),
+	('cs', [
+		('o', 1, Direction.FANOUT),
+		('o_clk', 1, Direction.FANOUT),
+	]),
+	('copi', [
+		('o', 1, Direction.FANOUT),
+		('o_clk', 1, Direction.FANOUT),
+	]),
+	('cipo', [
+		('i0', 1, Direction.FANIN),
+		('i1', 1, Direction.FANIN),
+		('i_clk', 1, Direction.FANOUT),
+	]),
+))
+
+class FullRatePlatform:
+	def request(self, name, number, *, xdr):
+		assert name == 'flash'
+		assert number == 0
+		assert xdr == {'cs': 1, 'clk': 2, 'copi': 1, 'cipo': 2}
+		return fullRateBus
+
+class SPIBusFullRateTestCase(ToriiTestCase):
+	dut : SPIBus = SPIBus
+	dut_args = {
+		'resource': ('flash', 0),
+		'fullRate': True,
+	}
+	domains = (('sync', 60e6), )
+	platform = FullRatePlatform()
+
+	def sendRecv(self, dataOut, dataIn):
+		self.assertEqual((yield fullRateBus.clk.o0), 1)
+		self.assertEqual((yield fullRateBus.clk.o1), 1)
+		yield self.dut.w_data.eq(dataOut)
+		yield self.dut.xfer.eq(1)
+		yield
+		yield self.dut.xfer.eq(0)
+		yield Settle()
+		# Each cycle of the transfer should produce a complete SCK cycle and new data bit
+		for bit in range(8):
+			self.assertEqual((yield fullRateBus.clk.o0), 0)
+			self.assertEqual((yield fullRateBus.clk.o1), 1)
+			self.assertEqual((yield fullRateBus.copi.o), (dataOut >> (7 - bit)) & 1)
+			self.assertEqual((yield self.dut.done), 0)
+			# The sample for the bit clocked out 2 cycles ago comes back from the input registers
+			if bit >= 2:
+				yield fullRateBus.cipo.i1.eq((dataIn >> (9 - bit)) & 1)
+			yield
+			yield Settle()
+		self.assertEqual((yield fullRateBus.clk.o0), 1)
+		self.assertEqual((yield fullRateBus.clk.o1), 1)
+		# The final two bits then arrive after the end of SCK activity
+		self.assertEqual((yield self.dut.done), 0)
+		yield fullRateBus.cipo.i1.eq((dataIn >> 1) & 1)
+		yield
+		yield fullRateBus.cipo.i1.eq(dataIn & 1)
+		yield Settle()
+		self.assertEqual((yield self.dut.done), 1)
+		self.assertEqual((yield fullRateBus.clk.o0), 1)
+		self.assertEqual((yield fullRateBus.clk.o1), 1)
+		yield
+		yield Settle()
+		self.assertEqual((yield self.dut.done), 0)
+		self.assertEqual((yield self.dut.r_data), dataIn)
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testSPIBusFullRate(self):
+		yield
+		yield Settle()
+		self.assertEqual((yield fullRateBus.cs.o), 0)
+		yield self.dut.cs.eq(1)
+		yield Settle()
+		self.assertEqual((yield fullRateBus.cs.o), 1)
+		yield
+		yield from self.sendRecv(0x0F, 0xF0)
+		yield from self.sendRecv(0xA5, 0x5A)
+		yield self.dut.cs.eq(0)
+		yield Settle()
+		self.assertEqual((yield fullRateBus.cs.o), 0)
+		yield
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testSPIBusFullRateStream(self):
+		dataOut = (0x0F, 0xA5, 0x3C)
+		dataIn = (0xF0, 0x5A, 0xC3)
+		bitsIn = [(byte >> (7 - bit)) & 1 for byte in dataIn for bit in range(8)]
+		received = []
+		stream = self.dut.stream
+		yield
+		yield self.dut.cs.eq(1)
+		yield self.dut.read.eq(1)
+		yield stream.data.eq(dataOut[0])
+		yield stream.valid.eq(1)
+		yield Settle()
+		self.assertEqual((yield stream.ready), 1)
+		yield
+		# All three bytes should go out back-to-back, with the next byte accepted on the last SCK cycle of a byte
+		for byte in range(3):
+			for bit in range(8):
+				cycle = byte * 8 + bit
+				if cycle >= 2:
+					yield fullRateBus.cipo.i1.eq(bitsIn[cycle - 2])
+				yield Settle()
+				self.assertEqual((yield fullRateBus.copi.o), (dataOut[byte] >> (7 - bit)) & 1)
+				# Line up the next byte of the burst, or end it, ready for the bus to take on the last SCK cycle
+				if bit == 7:
+					if byte < 2:
+						yield stream.data.eq(dataOut[byte + 1])
+						yield stream.last.eq(byte == 1)
+					else:
+						yield stream.valid.eq(0)
+						yield stream.last.eq(0)
+					yield Settle()
+				self.assertEqual((yield fullRateBus.clk.o0), 0)
+				self.assertEqual((yield fullRateBus.clk.o1), 1)
+				self.assertEqual((yield stream.ready), 1 if bit == 7 and byte < 2 else 0)
+				self.assertEqual((yield self.dut.done), 0)
+				if (yield self.dut.received):
+					received.append((yield self.dut.r_data))
+				yield
+		# Only the completion of the last byte of the burst is signalled
+		yield fullRateBus.cipo.i1.eq(bitsIn[-2])
+		yield Settle()
+		self.assertEqual((yield fullRateBus.clk.o0), 1)
+		self.assertEqual((yield self.dut.done), 0)
+		yield
+		yield fullRateBus.cipo.i1.eq(bitsIn[-1])
+		yield Settle()
+		self.assertEqual((yield self.dut.done), 1)
+		yield
+		yield Settle()
+		self.assertEqual((yield self.dut.done), 0)
+		self.assertEqual((yield self.dut.r_data), dataIn[2])
+		# Every byte read must have been signalled as received as it came in
+		self.assertEqual((yield self.dut.received), 1)
+		received.append((yield self.dut.r_data))
+		self.assertEqual(tuple(received), dataIn)
+		yield self.dut.read.eq(0)
+		yield self.dut.cs.eq(0)
+		yield
+
+quadBus = Record((
+	('clk', [
+		('o', 1, Direction.FANOUT),
+	]),
+	('cs', [
+		('o', 1, Direction.FANOUT),
+	]),
+	('dq', [
+		('i', 4, Direction.FANIN),
+		('o', 4, Direction.FANOUT),
+		('oe', 4, Direction.FANOUT),
+	]),
+))
+
+class QuadPlatform:
+	def request(self, name, number):
+		assert name == 'flash'
+		assert number == 0
+		return quadBus
+
+class SPIBusQuadTestCase(ToriiTestCase):
+	dut : SPIBus = SPIBus
+	dut_args = {
+		'resource': ('flash', 0),
+		'lanes': 4,
+	}
+	domains = (('sync', 60e6), )
+	platform = QuadPlatform()
+
+	def transfer(self, width, read, dataOut, dataIn):
+		bits = {SPIBusWidth.single: 1, SPIBusWidth.dual: 2, SPIBusWidth.quad: 4}[width]
+		mask = (1 << bits) - 1
+		# IO1 is CIPO for single lane transfers, and IO2 and IO3 (WP and HOLD) are only released by quad reads
+		if width == SPIBusWidth.single:
+			laneEnables = 0b1101
+		elif read:
+			laneEnables = 0b0000 if width == SPIBusWidth.quad else 0b1100
+		else:
+			laneEnables = 0b1111
+		self.assertEqual((yield quadBus.clk.o), 1)
+		yield self.dut.w_data.eq(dataOut)
+		yield self.dut.width.eq(width)
+		yield self.dut.read.eq(read)
+		yield self.dut.xfer.eq(1)
+		yield
+		yield self.dut.xfer.eq(0)
+		yield self.dut.width.eq(SPIBusWidth.single)
+		yield self.dut.read.eq(0)
+		yield
+		for beat in range(8 // bits):
+			shift = 8 - bits * (beat + 1)
+			yield Settle()
+			self.assertEqual((yield quadBus.clk.o), 0)
+			self.assertEqual((yield quadBus.dq.oe), laneEnables)
+			lanes = (yield quadBus.dq.o)
+			if width != SPIBusWidth.quad:
+				# WP and HOLD must be held high whichever way the data is going
+				self.assertEqual(lanes >> 2, 0b11)
+			if not read:
+				if bits == 1:
+					self.assertEqual(lanes & 1, (dataOut >> shift) & 1)
+				else:
+					self.assertEqual(lanes & mask, (dataOut >> shift) & mask)
+			# Single lane transfers read back on IO1, while wider ones use IO0 upwards
+			value = (dataIn >> shift) & mask
+			yield quadBus.dq.i.eq(value << 1 if bits == 1 else value)
+			yield
+			yield Settle()
+			self.assertEqual((yield quadBus.clk.o), 1)
+			self.assertEqual((yield self.dut.done), 1 if beat == 8 // bits - 1 else 0)
+			yield
+		yield Settle()
+		self.assertEqual((yield self.dut.done), 0)
+		self.assertEqual((yield self.dut.r_data), dataIn)
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testSPIBusQuad(self):
+		yield
+		yield self.dut.cs.eq(1)
+		yield
+		# Quad Page Program - command and address on one lane, then data on all four
+		yield from self.transfer(SPIBusWidth.single, False, 0x32, 0x00)
+		yield from self.transfer(SPIBusWidth.single, False, 0x12, 0x00)
+		yield from self.transfer(SPIBusWidth.quad, False, 0xA5, 0x00)
+		yield from self.transfer(SPIBusWidth.quad, False, 0x3C, 0x00)
+		yield self.dut.cs.eq(0)
+		yield
+		yield self.dut.cs.eq(1)
+		yield
+		# Reads on one, two and four lanes
+		yield from self.transfer(SPIBusWidth.single, True, 0x00, 0x96)
+		yield from self.transfer(SPIBusWidth.dual, True, 0x00, 0xC3)
+		yield from self.transfer(SPIBusWidth.quad, True, 0x00, 0x5A)
+		# The Flash drives the last bits till it is deselected, after which WP and HOLD are driven again
+		self.assertEqual((yield quadBus.dq.oe), 0b0000)
+		yield self.dut.cs.eq(0)
+		yield
+		yield Settle()
+		self.assertEqual((yield quadBus.dq.oe), 0b1101)
+		yield self.dut.cs.eq(1)
+		yield
+		# Read Status Register - WP and HOLD stay driven high while the status is read back on IO1
+		yield from self.transfer(SPIBusWidth.single, False, 0x05, 0x00)
+		yield from self.transfer(SPIBusWidth.single, True, 0x00, 0x02)
+		yield self.dut.cs.eq(0)
+		yield
+
+class SBSPIBusTestCase(ToriiTestCase):
+	dut : SBSPIBus = SBSPIBus
+	dut_args = {
+		'resource': ('flash', 0),
+		'block': SBSPIBlock.right,
+	}
+	domains = (('sync', 60e6), )
+	platform = Platform()
+
+	@ToriiTestCase.simulation
+	def testSBSPIBus(self):
+		dataOut = (0x9F, 0xA5, 0x3C, 0x0F)
+		dataIn = (0x00, 0xEF, 0x40, 0x16)
+		received = []
+		risingEdges = []
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainDevice(self: SBSPIBusTestCase):
+			# Act as the Flash, shifting out dataIn on falling edges of SCK and sampling COPI on rising edges
+			yield Passive()
+			bitsIn = [(byte >> (7 - bit)) & 1 for byte in dataIn for bit in range(8)]
+			byte = 0
+			bits = 0
+			clk = 1
+			cycle = 0
+			while True:
+				yield Settle()
+				nextClk = yield bus.clk.o
+				if (yield bus.cs.o):
+					if clk and not nextClk:
+						yield bus.cipo.i.eq(bitsIn[bits])
+					elif not clk and nextClk:
+						risingEdges.append(cycle)
+						byte = (byte << 1) | (yield bus.copi.o)
+						bits += 1
+						if bits % 8 == 0:
+							received.append(byte)
+							byte = 0
+				clk = nextClk
+				cycle += 1
+				yield
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self: SBSPIBusTestCase):
+			stream = self.dut.stream
+			# Wait for the hard block to be configured
+			yield from self.wait_until_high(stream.ready, timeout = 32)
+			yield self.dut.cs.eq(1)
+			# A single byte transfer
+			yield self.dut.w_data.eq(dataOut[0])
+			yield self.dut.xfer.eq(1)
+			yield
+			yield self.dut.xfer.eq(0)
+			yield from self.wait_until_high(self.dut.done, timeout = 64)
+			yield
+			self.assertEqual((yield self.dut.done), 0)
+			self.assertEqual((yield self.dut.r_data), dataIn[0])
+			# Followed by a burst of the rest
+			for index, byte in enumerate(dataOut[1:], start = 1):
+				yield stream.data.eq(byte)
+				yield stream.last.eq(index == len(dataOut) - 1)
+				yield stream.valid.eq(1)
+				yield Settle()
+				while not (yield stream.ready):
+					self.assertEqual((yield self.dut.done), 0)
+					yield
+					yield Settle()
+				yield
+			yield stream.valid.eq(0)
+			yield stream.last.eq(0)
+			yield from self.wait_until_high(self.dut.done, timeout = 64)
+			yield
+			yield self.dut.cs.eq(0)
+			self.assertEqual((yield self.dut.r_data), dataIn[-1])
+			yield
+
+			self.assertEqual(tuple(received), dataOut)
+			# The burst must have been clocked out with no gaps in SCK
+			burstEdges = risingEdges[8:]
+			self.assertEqual(len(burstEdges), 24)
+			self.assertEqual([b - a for a, b in zip(burstEdges, burstEdges[1:])], [2] * 23)
+		domainSync(self)
+		domainDevice(self)
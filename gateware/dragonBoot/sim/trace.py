@@ -0,0 +1,101 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from unittest import TestCase
+from torii.test import ToriiTestCase
+
+from ..trace import TraceEvent, TraceBuffer, traceEntrySize, unpackTrace, traceToChrome
+
+def traceEntry(timestamp : int, event : TraceEvent, data : int = 0) -> bytes:
+	return (timestamp | (event << 32) | (1 << 39) | (data << 40)).to_bytes(traceEntrySize, byteorder = 'little')
+
+class TraceDecoderTestCase(TestCase):
+	def testUnpackTrace(self):
+		# The buffer has wrapped around, so the oldest entry is not the first, and the last entry is not yet written
+		dump = (
+			traceEntry(30, TraceEvent.flashDone) + traceEntry(10, TraceEvent.busReset) +
+			traceEntry(20, TraceEvent.flashStart, 4096) + bytes(traceEntrySize)
+		)
+		entries = unpackTrace(dump)
+		self.assertEqual([entry['timestamp'] for entry in entries], [10, 20, 30])
+		self.assertEqual(entries[1]['event'], TraceEvent.flashStart)
+		self.assertEqual(entries[1]['data'], 4096)
+		with self.assertRaises(ValueError):
+			unpackTrace(bytes(3))
+
+	def testTraceToChrome(self):
+		from usb_construct.types import USBRequestType
+		from usb_construct.types.descriptors.dfu import DFURequests
+		from ..dfu import DFUState
+
+		dump = b''.join((
+			traceEntry(5, TraceEvent.busReset),
+			traceEntry(10, TraceEvent.dfuState, DFUState.dfuIdle),
+			traceEntry(100, TraceEvent.setup, DFURequests.DOWNLOAD | (USBRequestType.CLASS << 8) | (3 << 11)),
+			traceEntry(110, TraceEvent.dfuState, DFUState.downloadBusy),
+			traceEntry(120, TraceEvent.flashStart, 256),
+			traceEntry(400, TraceEvent.flashDone),
+			traceEntry(410, TraceEvent.dfuState, DFUState.downloadSync),
+		))
+		timeline = traceToChrome(dump)['traceEvents']
+		spans = [(event['name'], event['ts'], event['dur']) for event in timeline if event['ph'] == 'X']
+		self.assertEqual(spans, [('dfuIdle', 10, 100), ('program', 120, 280), ('downloadBusy', 110, 300),
+			('downloadSync', 410, 0)])
+		instants = [event for event in timeline if event['ph'] == 'i']
+		self.assertEqual([event['name'] for event in instants], ['bus reset', 'DOWNLOAD'])
+		self.assertEqual(instants[1]['args'], {'type': 'CLASS', 'direction': 'OUT', 'wValue': 3})
+
+class TraceBufferTestCase(ToriiTestCase):
+	dut : TraceBuffer = TraceBuffer
+	dut_args = {
+		'depth': 8,
+		'clockFreq': 4e6,
+	}
+	domains = (('sync', 4e6),)
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testTraceBuffer(self):
+		events = self.dut.events
+		data = self.dut.data
+
+		def readBack():
+			dump = bytearray()
+			for entry in range(8):
+				yield self.dut.readAddr.eq(entry)
+				yield
+				yield
+				dump += (yield self.dut.readData).to_bytes(traceEntrySize, byteorder = 'little')
+			return unpackTrace(bytes(dump))
+
+		for _ in range(8):
+			yield
+		# Events in the same cycle are all recorded, lowest first
+		yield events.eq((1 << TraceEvent.flashStart) | (1 << TraceEvent.busReset) | (1 << TraceEvent.setup))
+		yield data[TraceEvent.flashStart].eq(0x123456)
+		yield data[TraceEvent.setup].eq(0x42)
+		yield
+		yield events.eq(0)
+		yield data[TraceEvent.flashStart].eq(0)
+		for _ in range(4):
+			yield
+		entries = yield from readBack()
+		self.assertEqual([entry['event'] for entry in entries],
+			[TraceEvent.setup, TraceEvent.flashStart, TraceEvent.busReset])
+		self.assertEqual(entries[0]['data'], 0x42)
+		self.assertEqual(entries[1]['data'], 0x123456)
+		# At 4 cycles a microsecond, 8 cycles in is 2µs
+		self.assertEqual(entries[0]['timestamp'], 2)
+
+		# Once full, the oldest entries are overwritten
+		for event in range(6):
+			yield events.eq(1 << TraceEvent.flashDone)
+			yield data[TraceEvent.flashDone].eq(event)
+			yield
+			yield events.eq(0)
+			for _ in range(3):
+				yield
+		entries = yield from readBack()
+		self.assertEqual([entry['event'] for entry in entries],
+			[TraceEvent.flashStart, TraceEvent.busReset] + [TraceEvent.flashDone] * 6)
+		self.assertEqual([entry['data'] for entry in entries[2:]], list(range(6)))
+		timestamps = [entry['timestamp'] for entry in entries]
+		self.assertEqual(timestamps, sorted(timestamps))
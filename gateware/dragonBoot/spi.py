@@ -1,11 +1,32 @@
 # SPDX-License-Identifier: BSD-3-Clause
-from torii.hdl import Elaboratable, Module, Signal, Cat
+from torii.build import Attrs
+from torii.hdl import Elaboratable, Module, Signal, Cat, Const, Mux, ClockSignal, Instance, Record, Fragment
+from torii.lib.io import Pin
+from torii.lib.stream.simple import StreamInterface
+from torii.platform.vendor.lattice.ice40 import ICE40Platform
+from enum import IntEnum, unique
+from types import SimpleNamespace
 from typing import Tuple
 
+from .platform import SBSPIBlock
+
 __all__ = (
 	'SPIBus',
+	'SPIBusWidth',
+	'SBSPIBus',
+	'SBSPIModel',
 )
 
+@unique
+class SPIBusWidth(IntEnum):
+	""" An enumeration of the number of data lanes a SPI transfer is performed over. """
+	single = 0
+	""" The transfer uses the classic full-duplex 1-bit COPI and CIPO lines. """
+	dual = 1
+	""" The transfer uses IO0 and IO1 to move 2 bits per SCK cycle in a single direction. """
+	quad = 2
+	""" The transfer uses IO0 through IO3 to move 4 bits per SCK cycle in a single direction. """
+
 class SPIBus(Elaboratable):
 	""" SPI bus controller gateware for talking to the Flash.
 
@@ -16,29 +37,80 @@ class SPIBus(Elaboratable):
 	xfer : Signal(), input
 		Strobe that signals to start a SPI transfer.
 	done : Signal(), output
-		Strobe that indicates the completion of a SPI transfer.
+		Strobe that indicates the completion of a SPI transfer started by xfer, or of the byte that ended
+		a burst sent through stream.
 
 	r_data : Signal(8), output
 		Data read from the Flash in the last completed transfer.
+	received : Signal(), output
+		Strobe indicating r_data has just been updated with the data read during a byte of a stream that was
+		transferred with read set.
 	w_data : Signal(8), input
 		Data to be written to the Flash in the next transfer.
+	stream : StreamInterface(), input
+		Stream of bytes to be written to the Flash as a single burst, with the last byte of the burst
+		marked by stream.last.
+
+	width : Signal(SPIBusWidth), input
+		The number of data lanes to use for the next transfer, sampled along with the xfer strobe or
+		when a byte is accepted from stream.
+	read : Signal(), input
+		When the bus has more than one data lane, whether the next transfer reads data from the Flash
+		(leaving the lanes it uses undriven) or writes data to it. Sampled along with width.
+
+	Notes
+	-----
+	Transfers started by the xfer strobe are single bytes, each of which is acknowledged by done - if xfer
+	is asserted again in response to done, SCK idles for a cycle between the two bytes. Bytes sent using
+	stream are instead clocked out back-to-back with the next byte being accepted during the last SCK cycle
+	of the current one, so that a burst only idles SCK if stream.valid is dropped part way through it.
+	Only the completion of the byte marked with stream.last is signalled with done, at which point r_data
+	holds the data read during that byte. The xfer strobe takes priority over stream when both are asserted.
+
+	By default the bus runs SCK at half the rate of the clock domain it is in, toggling the clock line
+	on every cycle of a transfer. When constructed with :code:`fullRate = True`, the bus instead requests
+	the SPI resource with registered I/O - a DDR output register for SCK and single-rate registers for
+	CS and COPI - so SCK runs at the full domain rate and a byte is clocked out in 8 cycles rather than 16.
+	CIPO is captured using the falling edge half of a DDR input register, which lines up with the rising
+	edge of SCK on the pins. The I/O registers add two cycles of latency between clocking a bit out and
+	having the matching data bit back, so :py:attr:`done` trails the last SCK edge of a byte by this amount.
+
+	When constructed with more than one data lane, the bus expects the resource to provide a bidirectional
+	:code:`dq` subsignal (such as is built by :py:func:`torii.platform.resources.memory.QSPIFlashResource`)
+	rather than :code:`copi` and :code:`cipo`. IO0 then acts as COPI and IO1 as CIPO for single lane
+	transfers, while IO2 and IO3 (WP and HOLD) are driven high. Each lane gets its own I/O buffer and so
+	its own output enable - IO1 is only driven by dual and quad writes, and IO2 and IO3 are only released
+	by quad reads, staying undriven from then until Chip Select is deasserted as the Flash keeps driving
+	the last data bits out till then.
 	"""
 
-	def __init__(self, *, resource : Tuple[str, int]):
+	def __init__(self, *, resource : Tuple[str, int], fullRate : bool = False, lanes : int = 1):
 		"""
 		Parameters
 		----------
 		resource
 			The fully qualified identifier for the platform resource defining the SPI bus to use.
+		fullRate
+			Whether to run SCK at the full rate of the clock domain using DDR I/O registers.
+		lanes
+			The number of data lanes the bus resource provides - 1 for standard SPI, 2 for Dual SPI or 4 for Quad SPI.
 		"""
+		assert lanes in (1, 2, 4), f'SPI bus must have 1, 2 or 4 data lanes, got {lanes}'
 
 		self._spiResource = resource
+		self._fullRate = fullRate
+		self._lanes = lanes
 
 		self.cs = Signal()
 		self.xfer = Signal()
 		self.done = Signal()
 		self.r_data = Signal(8)
+		self.received = Signal()
 		self.w_data = Signal(8)
+		self.stream = StreamInterface()
+
+		self.width = Signal(SPIBusWidth)
+		self.read = Signal()
 
 	def elaborate(self, platform) -> Module:
 		""" Describes the specific gateware needed to talk SPI protocol.
@@ -54,49 +126,685 @@ class SPIBus(Elaboratable):
 			A complete description of the gateware behaviour required.
 		"""
 		m = Module()
-		bus = platform.request(*self._spiResource)
+		if self._fullRate:
+			self._elaborateFullRate(m, platform)
+			return m
+
+		bus = self._requestBus(m, platform)
 
 		bit = Signal(range(8))
 		clk = Signal(reset = 1)
-		cipo = bus.cipo.i
-		copi = bus.copi.o
+		width = Signal.like(self.width)
+		read = Signal()
+		last = Signal()
 
 		dataIn = Signal.like(self.r_data)
 		dataOut = Signal.like(self.w_data)
 
-		m.d.comb += self.done.eq(0)
+		m.d.comb += [
+			self.done.eq(0),
+			self.stream.ready.eq(0),
+		]
+		m.d.sync += self.received.eq(0)
 
 		with m.FSM(name = 'spi'):
 			with m.State('IDLE'):
 				m.d.sync += clk.eq(1)
-				with m.If(self.xfer):
-					m.d.sync += dataOut.eq(self.w_data)
-					m.next = 'TRANSFER'
+				self._deselected(m, width, read)
+				self._startTransfer(m, dataOut, width, read, last)
 			with m.State('TRANSFER'):
 				m.d.sync += clk.eq(clk ^ 1)
-				with m.If(clk):
-					m.d.sync += [
-						bit.eq(bit + 1),
-						copi.eq(dataOut[7]),
-					]
-				with m.Else():
+				with m.Switch(width):
+					for laneWidth, bits in self._widths():
+						with m.Case(laneWidth):
+							sample = Cat(self._dataIn(bus, bits), dataIn[:-bits])
+							with m.If(clk):
+								m.d.sync += [
+									bit.eq(bit + bits),
+									self._dataOut(bus, bits, dataOut),
+								]
+							with m.Else():
+								m.d.sync += [
+									dataOut.eq(dataOut.shift_left(bits)),
+									dataIn.eq(sample),
+								]
+								with m.If(bit == 0):
+									m.next = 'DONE'
+									# If we're part way through a burst, pick up the next byte without idling SCK
+									with m.If(~last):
+										m.d.comb += self.stream.ready.eq(1)
+										with m.If(self.stream.valid):
+											m.d.sync += [
+												self._loadStream(dataOut, width, read, last),
+												self.r_data.eq(sample),
+												self.received.eq(read),
+											]
+											m.next = 'TRANSFER'
+			with m.State('DONE'):
+				m.d.comb += self.done.eq(last)
+				m.d.sync += [
+					self.r_data.eq(dataIn),
+					self.received.eq(read),
+				]
+				m.next = 'IDLE'
+				self._startTransfer(m, dataOut, width, read, last)
+
+		m.d.comb += [
+			bus.cs.o.eq(self.cs),
+			bus.clk.o.eq(clk),
+		]
+		if self._lanes > 1:
+			m.d.comb += bus.dq.oe.eq(self._laneEnables(width, read))
+		return m
+
+	def _elaborateFullRate(self, m : Module, platform):
+		""" Describes the gateware for running SCK at the full clock domain rate using the I/O registers. """
+		if self._lanes == 1:
+			bus = platform.request(*self._spiResource, xdr = {'cs': 1, 'clk': 2, 'copi': 1, 'cipo': 2})
+		else:
+			bus = self._requestBus(m, platform, xdr = {'cs': 1, 'clk': 2, 'dq': 2})
+
+		bit = Signal(range(8))
+		width = Signal.like(self.width)
+		read = Signal()
+		last = Signal()
+		# Tracks which cycles clocked out a bit (and which bit was last in a byte) as these propagate through
+		# the output and input registers so we know which CIPO samples to capture, and how wide they are
+		sampleValid = Signal(2)
+		sampleLast = Signal(2)
+		sampleDone = Signal(2)
+		sampleRead = Signal(2)
+		sampleWidth = [Signal.like(self.width, name = f'sampleWidth{stage}') for stage in range(2)]
+
+		dataIn = Signal.like(self.r_data)
+		dataOut = Signal.like(self.w_data)
+		transferring = Signal()
+		lastBit = Signal()
+
+		m.d.comb += [
+			self.done.eq(0),
+			self.stream.ready.eq(0),
+			bus.clk.o0.eq(1),
+			bus.clk.o1.eq(1),
+		]
+
+		with m.FSM(name = 'spi'):
+			with m.State('IDLE'):
+				self._deselected(m, width, read)
+				self._startTransfer(m, dataOut, width, read, last)
+			with m.State('TRANSFER'):
+				# Each cycle produces a full SCK period - low for the first half, high for the second
+				m.d.comb += [
+					transferring.eq(1),
+					bus.clk.o0.eq(0),
+					bus.clk.o1.eq(1),
+				]
+				with m.Switch(width):
+					for laneWidth, bits in self._widths():
+						with m.Case(laneWidth):
+							m.d.comb += lastBit.eq(bit == 8 - bits)
+							m.d.sync += [
+								bit.eq(bit + bits),
+								dataOut.eq(dataOut.shift_left(bits)),
+							]
+				with m.If(lastBit):
+					m.next = 'IDLE'
+					# If we're part way through a burst, pick up the next byte without idling SCK
+					with m.If(~last):
+						m.d.comb += self.stream.ready.eq(1)
+						with m.If(self.stream.valid):
+							m.d.sync += self._loadStream(dataOut, width, read, last)
+							m.next = 'TRANSFER'
+
+		m.d.sync += [
+			sampleValid.eq(Cat(transferring, sampleValid[0])),
+			sampleLast.eq(Cat(transferring & lastBit, sampleLast[0])),
+			sampleDone.eq(Cat(transferring & lastBit & last, sampleDone[0])),
+			sampleRead.eq(Cat(read, sampleRead[0])),
+			self.received.eq(0),
+			sampleWidth[0].eq(width),
+			sampleWidth[1].eq(sampleWidth[0]),
+		]
+
+		# Once a bit's sample makes it out of the input registers, capture it
+		with m.If(sampleValid[1]):
+			with m.Switch(sampleWidth[1]):
+				for laneWidth, bits in self._widths():
+					with m.Case(laneWidth):
+						sample = Cat(self._dataIn(bus, bits, ddr = True), dataIn[:-bits])
+						m.d.sync += dataIn.eq(sample)
+						with m.If(sampleLast[1]):
+							m.d.comb += self.done.eq(sampleDone[1])
+							m.d.sync += [
+								self.r_data.eq(sample),
+								self.received.eq(sampleRead[1]),
+							]
+
+		with m.Switch(width):
+			for laneWidth, bits in self._widths():
+				with m.Case(laneWidth):
+					m.d.comb += self._dataOut(bus, bits, dataOut, ddr = True)
+
+		m.d.comb += [
+			bus.cs.o.eq(self.cs),
+			bus.cs.o_clk.eq(ClockSignal()),
+			bus.clk.o_clk.eq(ClockSignal()),
+		]
+		if self._lanes == 1:
+			m.d.comb += [
+				bus.copi.o_clk.eq(ClockSignal()),
+				bus.cipo.i_clk.eq(ClockSignal()),
+			]
+		else:
+			m.d.comb += [
+				bus.dq.o_clk.eq(ClockSignal()),
+				bus.dq.i_clk.eq(ClockSignal()),
+				bus.dq.oe.eq(self._laneEnables(width, read)),
+			]
+
+	def _requestBus(self, m : Module, platform, *, xdr = None):
+		""" Requests the bus resource, building an I/O buffer per data lane on iCE40 platforms for buses with
+		a dq subsignal so each lane gets its own output enable. """
+		if self._lanes == 1 or not isinstance(platform, ICE40Platform):
+			if xdr is None:
+				return platform.request(*self._spiResource)
+			return platform.request(*self._spiResource, xdr = xdr)
+
+		dqXDR = 0 if xdr is None else xdr['dq']
+		resource = platform.lookup(*self._spiResource)
+		ports = platform.request(
+			*self._spiResource, dir = {'dq': '-'}, xdr = {name: rate for name, rate in (xdr or {}).items() if name != 'dq'}
+		)
+		subsignal = next(io for io in resource.ios if io.name == 'dq')
+		attrs = Attrs(**resource.attrs, **subsignal.attrs)
+
+		if dqXDR == 0:
+			layout = [('i', self._lanes), ('o', self._lanes), ('oe', self._lanes)]
+		else:
+			layout = [
+				('i_clk', 1), ('i0', self._lanes), ('i1', self._lanes),
+				('o_clk', 1), ('o0', self._lanes), ('o1', self._lanes), ('oe', self._lanes),
+			]
+		dq = Record(layout, name = 'dq')
+
+		for lane in range(self._lanes):
+			pin = Pin(1, 'io', xdr = dqXDR, name = f'dq{lane}')
+			# The vendor I/O buffers only need the port's io, here the single pin of the lane
+			port = SimpleNamespace(io = ports.dq.io[lane])
+			m.d.comb += pin.oe.eq(dq.oe[lane])
+			if dqXDR == 0:
+				m.d.comb += [
+					pin.o.eq(dq.o[lane]),
+					dq.i[lane].eq(pin.i),
+				]
+			else:
+				m.d.comb += [
+					pin.o_clk.eq(dq.o_clk),
+					pin.i_clk.eq(dq.i_clk),
+					pin.o0.eq(dq.o0[lane]),
+					pin.o1.eq(dq.o1[lane]),
+					dq.i0[lane].eq(pin.i0),
+					dq.i1[lane].eq(pin.i1),
+				]
+			# The lanes share the port, so their buffers must all end up in this fragment
+			buffer = Fragment.get(platform.get_input_output(pin, port, attrs, False), platform)
+			buffer.flatten = True
+			m.submodules[f'dq{lane}'] = buffer
+
+		return Record([
+			('cs', ports.cs.layout), ('clk', ports.clk.layout), ('dq', dq.layout)
+		], fields = {'cs': ports.cs, 'clk': ports.clk, 'dq': dq}, name = 'bus')
+
+	def _deselected(self, m : Module, width : Signal, read : Signal):
+		""" Describes putting the lane output enables back to those of a single lane write once Chip Select is
+		deasserted, so WP and HOLD are driven high before the next command starts. """
+		if self._lanes > 1:
+			with m.If(~self.cs):
+				m.d.sync += [
+					width.eq(SPIBusWidth.single),
+					read.eq(0),
+				]
+
+	def _laneEnables(self, width : Signal, read : Signal):
+		""" Builds the per-lane output enables for transfers of the given width and direction. """
+		multiLane = width != SPIBusWidth.single
+		enables = Cat(
+			# IO0 is COPI for single lane transfers and so only released by dual and quad reads
+			~(read & multiLane),
+			# IO1 is CIPO for single lane transfers and so only driven by dual and quad writes
+			multiLane & ~read,
+		)
+		if self._lanes == 4:
+			# IO2 and IO3 are WP and HOLD for all but quad transfers, so must stay driven high otherwise
+			quadRead = read & (width == SPIBusWidth.quad)
+			enables = Cat(enables, ~quadRead, ~quadRead)
+		return enables
+
+	def _startTransfer(self, m : Module, dataOut : Signal, width : Signal, read : Signal, last : Signal):
+		""" Describes starting a new transfer from the bus idle, giving priority to xfer over the stream. """
+		with m.If(self.xfer):
+			m.d.sync += [
+				dataOut.eq(self.w_data),
+				width.eq(self.width),
+				read.eq(self.read),
+				last.eq(1),
+			]
+			m.next = 'TRANSFER'
+		with m.Else():
+			m.d.comb += self.stream.ready.eq(1)
+			with m.If(self.stream.valid):
+				m.d.sync += self._loadStream(dataOut, width, read, last)
+				m.next = 'TRANSFER'
+
+	def _loadStream(self, dataOut : Signal, width : Signal, read : Signal, last : Signal):
+		""" Builds the assignments that accept the next byte to transfer from the stream. """
+		return [
+			dataOut.eq(self.stream.data),
+			width.eq(self.width),
+			read.eq(self.read),
+			last.eq(self.stream.last),
+		]
+
+	def _widths(self):
+		""" Generates the transfer widths this bus supports, along with how many bits each moves per SCK cycle. """
+		yield SPIBusWidth.single, 1
+		if self._lanes >= 2:
+			yield SPIBusWidth.dual, 2
+		if self._lanes == 4:
+			yield SPIBusWidth.quad, 4
+
+	def _dataOut(self, bus, bits : int, dataOut : Signal, *, ddr : bool = False):
+		""" Builds the assignments that put the next bits from dataOut onto the bus for a transfer of the given width. """
+		if self._lanes == 1:
+			return bus.copi.o.eq(dataOut[7])
+
+		lanes = dataOut[8 - bits:8]
+		# In single lane mode IO1 is CIPO, and IO2 and IO3 are WP and HOLD which must be kept high
+		if bits == 1:
+			lanes = Cat(lanes, Const(0, 1))
+		if self._lanes > len(lanes):
+			lanes = Cat(lanes, Const(0b11, self._lanes - len(lanes)))
+
+		if ddr:
+			return [
+				bus.dq.o0.eq(lanes),
+				bus.dq.o1.eq(lanes),
+			]
+		return bus.dq.o.eq(lanes)
+
+	def _dataIn(self, bus, bits : int, *, ddr : bool = False):
+		""" Gets the bits sampled from the bus for a transfer of the given width. """
+		if self._lanes == 1:
+			return bus.cipo.i1 if ddr else bus.cipo.i
+
+		lanes = bus.dq.i1 if ddr else bus.dq.i
+		if bits == 1:
+			return lanes[1]
+		return lanes[0:bits]
+
+@unique
+class SBSPIRegister(IntEnum):
+	""" An enumeration of the system bus register offsets of the SB_SPI hard block. """
+	control1 = 0x9
+	control2 = 0xA
+	baudRate = 0xB
+	status = 0xC
+	txData = 0xD
+	rxData = 0xE
+
+class SBSPIBus(SPIBus):
+	""" SPI bus controller gateware for talking to the Flash through an iCE40 SB_SPI hard block.
+
+	This provides the same interface as :py:class:`SPIBus` and so may be used in its place, however the
+	hard block only supports single lane transfers, so width and read are ignored. As the block's receive
+	register is only read at the end of a transfer, received is only strobed for the last byte of a burst.
+
+	Notes
+	-----
+	The hard block is configured as a mode 3 SPI controller on startup and is then driven over its system bus,
+	with each byte being written to the block's transmit register. Bytes from stream are written as soon as
+	the block reports its transmit register empty, so the block's double-buffering keeps SCK running between
+	them. Once the last byte has been clocked out, the block's receive register is read to provide r_data.
+	CS is driven by the fabric directly as with :py:class:`SPIBus`.
+
+	When not elaborated for an iCE40 platform (such as in simulation), the block is substituted by
+	:py:class:`SBSPIModel`.
+	"""
+
+	def __init__(self, *, resource : Tuple[str, int], block : SBSPIBlock, divider : int = 1):
+		"""
+		Parameters
+		----------
+		resource
+			The fully qualified identifier for the platform resource defining the SPI bus to use.
+		block
+			Which of the device's SB_SPI blocks to use - this must be the one the resource's pins belong to.
+		divider
+			The divider the block uses to generate SCK, which runs at the clock domain rate / (divider + 1).
+		"""
+		assert 1 <= divider < 64, f'SB_SPI SCK divider must be between 1 and 63, got {divider}'
+		super().__init__(resource = resource)
+		self._block = block
+		self._divider = divider
+
+	def elaborate(self, platform) -> Module:
+		""" Describes the specific gateware needed to talk SPI protocol using the hard block.
+
+		Parameters
+		----------
+		platform
+			The Amaranth platform for which the gateware will be synthesised.
+
+		Returns
+		-------
+		:py:class:`torii.hdl.dsl.Module`
+			A complete description of the gateware behaviour required.
+		"""
+		m = Module()
+		bus = platform.request(*self._spiResource)
+
+		sbRW = Signal()
+		sbStrobe = Signal()
+		sbAddr = Signal(8)
+		sbDataIn = Signal(8)
+		sbDataOut = Signal(8)
+		sbAck = Signal()
+		sbAckSeen = Signal()
+		spiClk = Signal()
+		spiClkEn = Signal()
+		spiDataOut = Signal()
+
+		if isinstance(platform, ICE40Platform):
+			m.submodules.sbspi = Instance(
+				'SB_SPI',
+				p_BUS_ADDR74 = f'0b{self._block:04b}',
+				i_SBCLKI = ClockSignal(),
+				i_SBRWI = sbRW,
+				i_SBSTBI = sbStrobe,
+				**{f'i_SBADRI{bit}': sbAddr[bit] for bit in range(8)},
+				**{f'i_SBDATI{bit}': sbDataIn[bit] for bit in range(8)},
+				**{f'o_SBDATO{bit}': sbDataOut[bit] for bit in range(8)},
+				o_SBACKO = sbAck,
+				i_MI = bus.cipo.i,
+				i_SI = 0,
+				i_SCKI = 1,
+				i_SCSNI = 1,
+				o_MO = spiDataOut,
+				o_SCKO = spiClk,
+				o_SCKOE = spiClkEn,
+			)
+		else:
+			m.submodules.sbspi = sbspi = SBSPIModel(block = self._block)
+			m.d.comb += [
+				sbspi.rw.eq(sbRW),
+				sbspi.strobe.eq(sbStrobe),
+				sbspi.addr.eq(sbAddr),
+				sbspi.dataIn.eq(sbDataIn),
+				sbDataOut.eq(sbspi.dataOut),
+				sbAck.eq(sbspi.ack),
+				sbspi.mi.eq(bus.cipo.i),
+				spiDataOut.eq(sbspi.mo),
+				spiClk.eq(sbspi.scko),
+				spiClkEn.eq(sbspi.sckoe),
+			]
+
+		def access(register : SBSPIRegister, data = None):
+			""" Builds the assignments for a system bus access, strobing until acknowledged and idling a cycle after. """
+			return [
+				sbStrobe.eq(~sbAckSeen),
+				sbRW.eq(data is not None),
+				sbAddr.eq((self._block << 4) | register),
+				sbDataIn.eq(0 if data is None else data),
+			]
+
+		configuration = (
+			# Enable the block
+			(SBSPIRegister.control1, 0x80),
+			# Controller mode, SCK idles high (CPOL) and data is sampled on the rising edge (CPHA)
+			(SBSPIRegister.control2, 0x86),
+			(SBSPIRegister.baudRate, self._divider),
+		)
+
+		configStep = Signal(range(len(configuration)))
+		status = Signal(8)
+		dataOut = Signal.like(self.w_data)
+		width = Signal.like(self.width)
+		read = Signal()
+		last = Signal()
+
+		transmitReady = status[4]
+		transferring = status[7]
+
+		m.d.sync += [
+			sbAckSeen.eq(sbAck),
+			self.received.eq(0),
+		]
+		m.d.comb += [
+			self.done.eq(0),
+			self.stream.ready.eq(0),
+		]
+
+		with m.FSM(name = 'spi'):
+			with m.State('CONFIGURE'):
+				with m.Switch(configStep):
+					for step, (register, value) in enumerate(configuration):
+						with m.Case(step):
+							m.d.comb += access(register, value)
+							with m.If(sbAck):
+								if step == len(configuration) - 1:
+									m.next = 'IDLE'
+								else:
+									m.d.sync += configStep.eq(step + 1)
+			with m.State('IDLE'):
+				self._startTransfer(m, dataOut, width, read, last)
+			with m.State('TRANSFER'):
+				m.d.comb += access(SBSPIRegister.txData, dataOut)
+				with m.If(sbAck):
+					m.next = 'POLL'
+			with m.State('POLL'):
+				m.d.comb += access(SBSPIRegister.status)
+				with m.If(sbAck):
+					m.d.sync += status.eq(sbDataOut)
+					m.next = 'CHECK'
+			with m.State('CHECK'):
+				m.next = 'POLL'
+				with m.If(transmitReady):
+					with m.If(last):
+						# The last byte of the transfer has been clocked out, so collect what was read
+						with m.If(~transferring):
+							m.next = 'RECEIVE'
+					with m.Else():
+						# Keep the block fed with the next byte of the burst if there is one
+						m.d.comb += self.stream.ready.eq(1)
+						with m.If(self.stream.valid):
+							m.d.sync += self._loadStream(dataOut, width, read, last)
+							m.next = 'TRANSFER'
+						with m.Elif(~transferring):
+							m.next = 'IDLE'
+			with m.State('RECEIVE'):
+				m.d.comb += access(SBSPIRegister.rxData)
+				with m.If(sbAck):
 					m.d.sync += [
-						dataOut.eq(dataOut.shift_left(1)),
-						dataIn.eq(Cat(cipo, dataIn[:-1])),
+						self.r_data.eq(sbDataOut),
+						self.received.eq(read),
 					]
-					with m.If(bit == 0):
-						m.next = 'DONE'
+					m.next = 'DONE'
 			with m.State('DONE'):
 				m.d.comb += self.done.eq(1)
-				m.d.sync += self.r_data.eq(dataIn)
-				with m.If(self.xfer):
-					m.d.sync += dataOut.eq(self.w_data)
-					m.next = 'TRANSFER'
-				with m.Else():
-					m.next = 'IDLE'
+				m.next = 'IDLE'
+				self._startTransfer(m, dataOut, width, read, last)
 
 		m.d.comb += [
 			bus.cs.o.eq(self.cs),
-			bus.clk.o.eq(clk),
+			bus.clk.o.eq(Mux(spiClkEn, spiClk, 1)),
+			bus.copi.o.eq(spiDataOut),
 		]
 		return m
+
+class SBSPIModel(Elaboratable):
+	""" Simulation model of the iCE40 SB_SPI hard block, used by :py:class:`SBSPIBus` when not building for an iCE40.
+
+	Attributes
+	----------
+	rw : Signal(), input
+		System bus access direction, 1 for a write.
+	strobe : Signal(), input
+		System bus access strobe, held until ack is seen.
+	addr : Signal(8), input
+		System bus address, the upper 4 bits of which select the block.
+	dataIn : Signal(8), input
+		System bus write data.
+	dataOut : Signal(8), output
+		System bus read data, valid along with ack.
+	ack : Signal(), output
+		System bus access acknowledgement.
+
+	mi : Signal(), input
+		Controller data input (CIPO).
+	mo : Signal(), output
+		Controller data output (COPI).
+	scko : Signal(), output
+		SCK output.
+	sckoe : Signal(), output
+		SCK output enable, asserted while a transfer is in progress.
+
+	Notes
+	-----
+	Only what :py:class:`SBSPIBus` makes use of is modelled - the block acting as controller in SPI mode 3, MSB first,
+	with a double-buffered transmit register and the status register's TIP, TRDY and RRDY bits.
+	"""
+
+	def __init__(self, *, block : SBSPIBlock):
+		"""
+		Parameters
+		----------
+		block
+			Which of the device's SB_SPI blocks is being modelled, which determines the system bus addresses it responds to.
+		"""
+		self._block = block
+
+		self.rw = Signal()
+		self.strobe = Signal()
+		self.addr = Signal(8)
+		self.dataIn = Signal(8)
+		self.dataOut = Signal(8)
+		self.ack = Signal()
+
+		self.mi = Signal()
+		self.mo = Signal()
+		self.scko = Signal(reset = 1)
+		self.sckoe = Signal()
+
+	def elaborate(self, platform) -> Module:
+		""" Describes the behaviour of the hard block.
+
+		Parameters
+		----------
+		platform
+			The Amaranth platform for which the gateware will be synthesised.
+
+		Returns
+		-------
+		:py:class:`torii.hdl.dsl.Module`
+			A complete description of the gateware behaviour required.
+		"""
+		m = Module()
+
+		control1 = Signal(8)
+		control2 = Signal(8)
+		baudRate = Signal(6)
+		txData = Signal(8)
+		rxData = Signal(8)
+		transferring = Signal()
+		transmitReady = Signal(reset = 1)
+		receiveReady = Signal()
+
+		shift = Signal(8)
+		bit = Signal(range(8))
+		phaseTimer = Signal.like(baudRate)
+		# SCK runs at the clock rate / (baudRate + 1), with the low half taking the odd cycle if there is one
+		lowCycles = (baudRate + 1) >> 1
+		highCycles = (baudRate + 1) - lowCycles
+
+		m.d.sync += self.ack.eq(0)
+		with m.If(self.strobe & ~self.ack & (self.addr[4:8] == self._block)):
+			m.d.sync += self.ack.eq(1)
+			with m.If(self.rw):
+				with m.Switch(self.addr[0:4]):
+					with m.Case(SBSPIRegister.control1):
+						m.d.sync += control1.eq(self.dataIn)
+					with m.Case(SBSPIRegister.control2):
+						m.d.sync += control2.eq(self.dataIn)
+					with m.Case(SBSPIRegister.baudRate):
+						m.d.sync += baudRate.eq(self.dataIn)
+					with m.Case(SBSPIRegister.txData):
+						m.d.sync += [
+							txData.eq(self.dataIn),
+							transmitReady.eq(0),
+						]
+			with m.Else():
+				with m.Switch(self.addr[0:4]):
+					with m.Case(SBSPIRegister.control1):
+						m.d.sync += self.dataOut.eq(control1)
+					with m.Case(SBSPIRegister.control2):
+						m.d.sync += self.dataOut.eq(control2)
+					with m.Case(SBSPIRegister.baudRate):
+						m.d.sync += self.dataOut.eq(baudRate)
+					with m.Case(SBSPIRegister.status):
+						m.d.sync += self.dataOut.eq(Cat(Const(0, 3), receiveReady, transmitReady, Const(0, 2), transferring))
+					with m.Case(SBSPIRegister.rxData):
+						m.d.sync += [
+							self.dataOut.eq(rxData),
+							receiveReady.eq(0),
+						]
+					with m.Default():
+						m.d.sync += self.dataOut.eq(0)
+
+		with m.FSM(name = 'sbspi'):
+			with m.State('IDLE'):
+				with m.If(control1[7] & control2[7] & ~transmitReady):
+					m.d.sync += [
+						shift.eq(txData),
+						transmitReady.eq(1),
+						transferring.eq(1),
+						self.mo.eq(txData[7]),
+						phaseTimer.eq(lowCycles - 1),
+					]
+					m.next = 'LOW'
+			with m.State('LOW'):
+				m.d.comb += self.scko.eq(0)
+				m.d.sync += phaseTimer.dec()
+				with m.If(phaseTimer == 0):
+					# Sample on the rising edge of SCK
+					m.d.sync += [
+						shift.eq(Cat(self.mi, shift[:-1])),
+						phaseTimer.eq(highCycles - 1),
+					]
+					m.next = 'HIGH'
+			with m.State('HIGH'):
+				m.d.sync += phaseTimer.dec()
+				with m.If(phaseTimer == 0):
+					m.d.sync += [
+						bit.eq(bit + 1),
+						self.mo.eq(shift[7]),
+						phaseTimer.eq(lowCycles - 1),
+					]
+					m.next = 'LOW'
+					with m.If(bit == 7):
+						m.d.sync += [
+							rxData.eq(shift),
+							receiveReady.eq(1),
+						]
+						# Move straight on to the next byte if one has been written
+						with m.If(~transmitReady):
+							m.d.sync += [
+								shift.eq(txData),
+								transmitReady.eq(1),
+								self.mo.eq(txData[7]),
+							]
+						with m.Else():
+							m.d.sync += transferring.eq(0)
+							m.next = 'IDLE'
+
+		m.d.comb += self.sckoe.eq(transferring)
+		return m
@@ -0,0 +1,271 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from enum import IntEnum, unique
+from torii.hdl import Elaboratable, Module, Signal, Memory, Cat, Const
+from usb_construct.types import USBRequestType, USBStandardRequests
+from usb_construct.types.descriptors.dfu import DFURequests
+from typing import Any, Dict, List, Optional
+
+__all__ = (
+	'TraceEvent',
+	'TraceBuffer',
+	'traceEntrySize',
+	'unpackTrace',
+	'traceToChrome',
+)
+
+@unique
+class TraceEvent(IntEnum):
+	""" An enumeration of the events recorded by the DFU request handler's trace. """
+	dfuState = 0
+	""" The DFU state or status changed. The data holds the new state in its bottom 4 bits and the new status in the
+	4 bits above. """
+	setup = 1
+	""" A setup packet was received. The data holds bRequest in its bottom 8 bits, the request type in the 2 bits
+	above, whether it is an IN request in bit 10, and the bottom 13 bits of wValue above that. """
+	flashStart = 2
+	""" The SPI Flash engine was asked to erase and program as needed for byteCount bytes, which the data holds. """
+	flashErase = 3
+	""" The SPI Flash engine was asked to erase the rest of the slot. """
+	flashRead = 4
+	""" The SPI Flash engine was asked to read readCount bytes, which the data holds. Reads have no completion. """
+	flashDone = 5
+	""" The SPI Flash engine finished an erase or program operation. The data holds whether it failed to verify. """
+	busReset = 6
+	""" The USB device saw a bus reset, which is also what stops the connection timeout. """
+
+traceEntrySize = 8
+""" The number of bytes each trace entry is read back as. """
+
+class TraceBuffer(Elaboratable):
+	""" A ring buffer in block RAM recording timestamped events.
+
+	Attributes
+	----------
+	events : Signal(len(TraceEvent)), input
+		Strobes for the events to record, with bit :code:`n` being that of :py:class:`TraceEvent` :code:`n`.
+	data : List[Signal(24)], input
+		The data to record with each event, taken in the same cycle as its strobe.
+	readAddr : Signal(range(depth)), input
+		The entry to read back.
+	readData : Signal(64), output
+		The entry at readAddr, one cycle after it is given.
+
+	Notes
+	-----
+	Each entry is 64 bits - the time the event was recorded in microseconds in the bottom 32 bits, then the event's
+	:py:class:`TraceEvent` in 7 bits, a bit marking the entry as valid, and the event's data in the top 24 bits. The
+	microsecond timer starts at power on and wraps around after about 71 minutes.
+
+	Events occurring in the same cycle are held as pending, along with their data, and recorded one a cycle, lowest
+	first. Should an event occur again before the last of its kind has been recorded, it replaces the last one. Once
+	the buffer is full, each entry recorded overwrites the oldest, and as recording never stops the entries are best
+	put back in order by their timestamps once read back, as :py:func:`unpackTrace` does.
+	"""
+	def __init__(self, *, depth : int = 256, clockFreq : float):
+		"""
+		Parameters
+		----------
+		depth
+			The number of entries the buffer holds.
+		clockFreq
+			The frequency of the clock domain the buffer runs in, used to time the events.
+		"""
+		self._depth = depth
+		self._clockFreq = clockFreq
+
+		self.events = Signal(len(TraceEvent))
+		self.data : List[Signal] = [Signal(24, name = f'{event.name}Data') for event in TraceEvent]
+		self.readAddr = Signal(range(depth))
+		self.readData = Signal(64)
+
+	def elaborate(self, platform) -> Module:
+		""" Describes the gateware needed to record the events.
+
+		Parameters
+		----------
+		platform
+			The Amaranth platform for which the gateware will be synthesised.
+
+		Returns
+		-------
+		:py:class:`torii.hdl.dsl.Module`
+			A complete description of the gateware behaviour required.
+		"""
+		m = Module()
+		cyclesPerMicrosecond = max(round(self._clockFreq / 1e6), 1)
+
+		buffer = Memory(width = 64, depth = self._depth)
+		m.submodules.writePort = writePort = buffer.write_port()
+		m.submodules.readPort = readPort = buffer.read_port(transparent = False)
+
+		prescaler = Signal(range(cyclesPerMicrosecond), reset = cyclesPerMicrosecond - 1)
+		timestamp = Signal(32)
+		pending = Signal.like(self.events)
+		heldData = [Signal(24, name = f'{event.name}Held') for event in TraceEvent]
+		nextEvent = Signal.like(self.events)
+		writeAddr = Signal.like(self.readAddr)
+
+		# Keep the time in microseconds
+		m.d.sync += prescaler.dec()
+		with m.If(prescaler == 0):
+			m.d.sync += [
+				prescaler.eq(prescaler.reset),
+				timestamp.inc(),
+			]
+
+		m.d.comb += [
+			readPort.addr.eq(self.readAddr),
+			self.readData.eq(readPort.data),
+			# Record the lowest of the pending events first
+			nextEvent.eq(pending & -pending),
+			writePort.addr.eq(writeAddr),
+			writePort.en.eq(pending != 0),
+		]
+
+		# Hold on to each event's data till it is recorded
+		for event in TraceEvent:
+			with m.If(self.events[event]):
+				m.d.sync += heldData[event].eq(self.data[event])
+			with m.If(nextEvent[event]):
+				m.d.comb += writePort.data.eq(Cat(timestamp, Const(event, 7), Const(1, 1), heldData[event]))
+
+		m.d.sync += pending.eq((pending & ~nextEvent) | self.events)
+		with m.If(pending != 0):
+			m.d.sync += writeAddr.eq(writeAddr + 1)
+		return m
+
+def unpackTrace(dump : bytes) -> List[Dict[str, Any]]:
+	""" Unpacks the entries read back by :py:attr:`dragonBoot.dfu.VendorRequests.readTrace` requests.
+
+	Parameters
+	----------
+	dump
+		The entries read back, one after the other. Entries that have not yet been recorded are skipped, so this can
+		be the whole of the buffer.
+
+	Returns
+	-------
+	List[Dict[str, Any]]
+		The recorded events in the order they happened, each with its :code:`timestamp` in microseconds, its
+		:code:`event` as a :py:class:`TraceEvent`, and its :code:`data`.
+	"""
+	if len(dump) % traceEntrySize:
+		raise ValueError(f'Trace dumps are made of {traceEntrySize} byte entries, got {len(dump)} bytes')
+	entries = []
+	for offset in range(0, len(dump), traceEntrySize):
+		entry = int.from_bytes(dump[offset:offset + traceEntrySize], byteorder = 'little')
+		if not (entry >> 39) & 1:
+			continue
+		event = (entry >> 32) & 0x7F
+		if event not in TraceEvent.__members__.values():
+			raise ValueError(f'Unknown trace event {event} in entry at offset {offset}')
+		entries.append({
+			'timestamp': entry & 0xFFFFFFFF,
+			'event': TraceEvent(event),
+			'data': entry >> 40,
+		})
+	# Python's sort is stable, so events recorded in the same microsecond stay in the order they were recorded in
+	entries.sort(key = lambda entry: entry['timestamp'])
+	return entries
+
+def _requestName(data : int) -> str:
+	""" Names the request in the data of a setup event. """
+	from .dfu import VendorRequests
+
+	request = data & 0xFF
+	requestType = (data >> 8) & 0x3
+	names = {
+		USBRequestType.STANDARD: USBStandardRequests,
+		USBRequestType.CLASS: DFURequests,
+		USBRequestType.VENDOR: VendorRequests,
+	}.get(requestType)
+	if names is not None:
+		try:
+			return names(request).name
+		except ValueError:
+			pass
+	return f'request {request:#04x}'
+
+def traceToChrome(dump : bytes) -> Dict[str, Any]:
+	""" Turns a trace dump into a timeline in the Chrome Trace Event Format, which Perfetto and chrome://tracing
+	can load.
+
+	The DFU state and the SPI Flash engine's operations are laid out as spans on their own tracks, and setup packets
+	and bus resets as instants on a third.
+
+	Parameters
+	----------
+	dump
+		The entries read back, as for :py:func:`unpackTrace`.
+
+	Returns
+	-------
+	Dict[str, Any]
+		The timeline, ready to be written out with :py:func:`json.dump`.
+	"""
+	from .dfu import DFUState, DFUStatus
+
+	stateTrack = 1
+	flashTrack = 2
+	usbTrack = 3
+	timeline : List[Dict[str, Any]] = [
+		{'ph': 'M', 'pid': 1, 'name': 'process_name', 'args': {'name': 'dragonBoot'}},
+		{'ph': 'M', 'pid': 1, 'tid': stateTrack, 'name': 'thread_name', 'args': {'name': 'DFU state'}},
+		{'ph': 'M', 'pid': 1, 'tid': flashTrack, 'name': 'thread_name', 'args': {'name': 'SPI Flash'}},
+		{'ph': 'M', 'pid': 1, 'tid': usbTrack, 'name': 'thread_name', 'args': {'name': 'USB'}},
+	]
+
+	def span(track : int, name : str, begin : int, end : int, args : Dict[str, Any]):
+		timeline.append({'ph': 'X', 'pid': 1, 'tid': track, 'name': name, 'ts': begin, 'dur': end - begin, 'args': args})
+
+	def instant(track : int, name : str, timestamp : int, args : Dict[str, Any]):
+		timeline.append({'ph': 'i', 'pid': 1, 'tid': track, 'name': name, 'ts': timestamp, 's': 't', 'args': args})
+
+	def named(enum, value : int) -> str:
+		try:
+			return enum(value).name
+		except ValueError:
+			return str(value)
+
+	entries = unpackTrace(dump)
+	state : Optional[Dict[str, Any]] = None
+	operation : Optional[Dict[str, Any]] = None
+	for entry in entries:
+		timestamp = entry['timestamp']
+		event = entry['event']
+		data = entry['data']
+		if event == TraceEvent.dfuState:
+			if state is not None:
+				span(stateTrack, state['name'], state['timestamp'], timestamp, state['args'])
+			state = {
+				'name': named(DFUState, data & 0xF),
+				'timestamp': timestamp,
+				'args': {'status': named(DFUStatus, (data >> 4) & 0xF)},
+			}
+		elif event in (TraceEvent.flashStart, TraceEvent.flashErase):
+			name = 'program' if event == TraceEvent.flashStart else 'erase slot'
+			operation = {'name': name, 'timestamp': timestamp, 'args': {'byteCount': data} if data else {}}
+		elif event == TraceEvent.flashDone:
+			if operation is not None:
+				span(flashTrack, operation['name'], operation['timestamp'], timestamp,
+					{**operation['args'], 'verifyFailed': bool(data & 1)})
+			operation = None
+		elif event == TraceEvent.flashRead:
+			instant(flashTrack, 'read', timestamp, {'readCount': data})
+		elif event == TraceEvent.setup:
+			instant(usbTrack, _requestName(data), timestamp, {
+				'type': named(USBRequestType, (data >> 8) & 0x3),
+				'direction': 'IN' if (data >> 10) & 1 else 'OUT',
+				'wValue': data >> 11,
+			})
+		elif event == TraceEvent.busReset:
+			instant(usbTrack, 'bus reset', timestamp, {})
+
+	# Close off anything still going at the end of the trace
+	if entries:
+		end = entries[-1]['timestamp']
+		if state is not None:
+			span(stateTrack, state['name'], state['timestamp'], end, state['args'])
+		if operation is not None:
+			span(flashTrack, operation['name'], operation['timestamp'], end, operation['args'])
+	return {'traceEvents': timeline, 'displayTimeUnit': 'ms'}